@@ -1,11 +1,143 @@
-from fastapi import Depends, HTTPException, status
+import base64
+import binascii
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+from fastapi import Depends, HTTPException, Request, status
+from fastapi.concurrency import run_in_threadpool
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
 from passlib.context import CryptContext
-from db import get_db_connection
+from db import async_connection
+from logging_config import get_logger
+from statements import aexecute, register
+
+logger = get_logger("sms_sync.auth")
 
 security = HTTPBasic()
+# Lets token-authenticated requests through without a Basic header
+optional_security = HTTPBasic(auto_error=False)
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
+PASSWORD_HASH_LOOKUP = register(
+    "auth_password_hash", "SELECT password_hash FROM users WHERE username = %s;"
+)
+
+
+class CredentialCache:
+    """Bounded LRU of recently verified (username, password) pairs with a TTL.
+
+    Entries are keyed by the username plus an HMAC of the password under a
+    per-process random key, so plaintext passwords are never held. Each
+    entry remembers the password_hash it was verified against; callers
+    still look the hash up (a cheap indexed query) and an entry only counts
+    as a hit while that hash is unchanged, so password changes invalidate
+    it in every worker. Only successful verifications are cached.
+    """
+
+    def __init__(self, ttl: float, max_size: int):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._key = secrets.token_bytes(32)
+        self._entries: "OrderedDict[tuple, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0 and self.max_size > 0
+
+    def _cache_key(self, username: str, password: str) -> tuple:
+        return username, hmac.new(self._key, password.encode(), hashlib.sha256).digest()
+
+    def check(self, username: str, password: str, stored_hash: str) -> bool:
+        """True if this password was verified against `stored_hash` within the TTL."""
+        key = self._cache_key(username, password)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                verified_hash, expires_at = entry
+                if verified_hash == stored_hash and expires_at > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self._stats["hits"] += 1
+                    return True
+                del self._entries[key]
+                if verified_hash != stored_hash:
+                    self._stats["invalidations"] += 1
+            self._stats["misses"] += 1
+            return False
+
+    def add(self, username: str, password: str, stored_hash: str) -> None:
+        key = self._cache_key(username, password)
+        with self._lock:
+            self._entries[key] = (stored_hash, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self._stats["evictions"] += 1
+
+    def invalidate_user(self, username: str) -> int:
+        """Drop every cached credential for `username`; returns how many were dropped."""
+        with self._lock:
+            stale = [key for key in self._entries if key[0] == username]
+            for key in stale:
+                del self._entries[key]
+            self._stats["invalidations"] += len(stale)
+            return len(stale)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            lookups = self._stats["hits"] + self._stats["misses"]
+            return {
+                "enabled": self.enabled,
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "ttl_seconds": self.ttl,
+                **self._stats,
+                "hit_rate": round(self._stats["hits"] / lookups, 3) if lookups else None,
+            }
+
+
+credential_cache = CredentialCache(
+    ttl=float(os.getenv("AUTH_CACHE_TTL_SECONDS", "300")),
+    max_size=int(os.getenv("AUTH_CACHE_MAX_SIZE", "1024")),
+)
+
+
+# Session tokens issued by /login: base64url(JSON claims) "." base64url(HMAC-SHA256)
+SESSION_COOKIE = "session"
+TOKEN_TTL = int(os.getenv("AUTH_TOKEN_TTL_SECONDS", "3600"))
+# The value older copies of .env.example shipped with; anyone could forge tokens signed with it
+_PLACEHOLDER_SECRET = "change-me-to-a-long-random-string"
+
+
+def _token_secret(configured: str) -> bytes:
+    """AUTH_TOKEN_SECRET, or a random per-process key when it is unset or the placeholder."""
+    if configured == _PLACEHOLDER_SECRET:
+        logger.error("AUTH_TOKEN_SECRET is the .env.example placeholder; ignoring it, set a random secret")
+        configured = ""
+    if not configured:
+        logger.warning("AUTH_TOKEN_SECRET not set; session tokens will only be valid in this process")
+        return secrets.token_bytes(32)
+    return configured.encode()
+
+
+TOKEN_SECRET = _token_secret(os.getenv("AUTH_TOKEN_SECRET", ""))
+
+
+def invalidate_user(username: str) -> int:
+    """Forget cached credentials for a user (call after changing their password)."""
+    return credential_cache.invalidate_user(username)
+
+
+def get_auth_cache_stats() -> Dict:
+    return credential_cache.stats()
+
 
 def hash_password(password: str) -> str:
     return pwd_context.hash(password)
@@ -15,34 +147,112 @@ def verify_password(plain_password: str, password_hash: str) -> bool:
     return pwd_context.verify(plain_password, password_hash)
 
 
-def basic_auth(credentials: HTTPBasicCredentials = Depends(security)) -> str:
-    """Authenticate using the users table (HTTP Basic).
+def _unauthorized() -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Unauthorized",
+        headers={"WWW-Authenticate": "Basic"},
+    )
 
-    Returns the authenticated username on success.
+
+async def authenticate_password(username: str, password: str) -> bool:
+    """Check a username/password against the users table.
+
+    The lookup runs on the async pool and the bcrypt check in the
+    threadpool, so the event loop is never blocked. Credentials verified
+    recently against the same password_hash skip bcrypt (see CredentialCache).
     """
-    username = credentials.username
-    password = credentials.password
+    async with async_connection() as conn:
+        cur = await aexecute(conn, PASSWORD_HASH_LOOKUP, (username,))
+        row = await cur.fetchone()
+    if not row:
+        return False
+    stored_hash = row[0]
+    if credential_cache.enabled and credential_cache.check(username, password, stored_hash):
+        return True
+    if not await run_in_threadpool(verify_password, password, stored_hash):
+        return False
+    if credential_cache.enabled:
+        credential_cache.add(username, password, stored_hash)
+    return True
+
+
+def _b64encode(raw: bytes) -> str:
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode()
+
+
+def _b64decode(text: str) -> bytes:
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+
+def _sign(payload: str) -> str:
+    return _b64encode(hmac.new(TOKEN_SECRET, payload.encode(), hashlib.sha256).digest())
+
+
+def issue_token(username: str) -> str:
+    """Create a session token for `username` valid for AUTH_TOKEN_TTL_SECONDS."""
+    claims = {"sub": username, "exp": int(time.time()) + TOKEN_TTL}
+    payload = _b64encode(json.dumps(claims, separators=(",", ":")).encode())
+    return f"{payload}.{_sign(payload)}"
+
 
-    conn = None
+def verify_token(token: str) -> Optional[str]:
+    """Return the username of a valid, unexpired token, else None. No database access."""
+    payload, _, signature = token.partition(".")
     try:
-        conn = get_db_connection()
-        with conn.cursor() as cur:
-            cur.execute("SELECT password_hash FROM users WHERE username = %s;", (username,))
-            row = cur.fetchone()
-            if not row:
-                raise HTTPException(
-                    status_code=status.HTTP_401_UNAUTHORIZED,
-                    detail="Unauthorized",
-                    headers={"WWW-Authenticate": "Basic"},
-                )
-            stored_hash = row[0]
-            if not verify_password(password, stored_hash):
-                raise HTTPException(
-                    status_code=status.HTTP_401_UNAUTHORIZED,
-                    detail="Unauthorized",
-                    headers={"WWW-Authenticate": "Basic"},
-                )
-            return username
-    finally:
-        if conn:
-            conn.close()
+        # Compared as bytes: compare_digest raises TypeError on non-ASCII str
+        if not signature or not hmac.compare_digest(signature.encode(), _sign(payload).encode()):
+            return None
+    except UnicodeError:
+        return None
+    try:
+        claims = json.loads(_b64decode(payload))
+    except (binascii.Error, ValueError):
+        return None
+    if not isinstance(claims, dict) or claims.get("exp", 0) < time.time():
+        return None
+    return claims.get("sub")
+
+
+async def basic_auth(credentials: HTTPBasicCredentials = Depends(security)) -> str:
+    """Authenticate using the users table (HTTP Basic only).
+
+    Returns the authenticated username on success.
+    """
+    if not await authenticate_password(credentials.username, credentials.password):
+        raise _unauthorized()
+    return credentials.username
+
+
+async def optional_user(
+    request: Request,
+    credentials: Optional[HTTPBasicCredentials] = Depends(optional_security),
+) -> Optional[str]:
+    """Authenticate with a session token or Basic credentials; None if neither was sent.
+
+    Tokens are accepted as `Authorization: Bearer <token>` or in the session
+    cookie set by /login and are checked without touching the database.
+    Credentials that are present but invalid are rejected with 401.
+    """
+    scheme, _, param = request.headers.get("Authorization", "").partition(" ")
+    if scheme.lower() == "bearer":
+        token = param.strip()
+    elif credentials is None:
+        token = request.cookies.get(SESSION_COOKIE)
+    else:
+        token = None
+    if token:
+        username = verify_token(token)
+        if username is None:
+            raise _unauthorized()
+        return username
+    if credentials is None:
+        return None
+    return await basic_auth(credentials)
+
+
+async def current_user(username: Optional[str] = Depends(optional_user)) -> str:
+    """Require a session token or Basic credentials; returns the username."""
+    if username is None:
+        raise _unauthorized()
+    return username
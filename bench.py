@@ -0,0 +1,446 @@
+"""Micro-benchmarks for the hot paths, run against the database in DB_URL.
+
+    python bench.py sync --rows 50000
+    python bench.py payload --messages 20000
+    python bench.py stream --rows 200000
+    python bench.py extract --messages 50000 [--from-db]
+    python bench.py llm --messages 40 --batch-sizes 1 10 --concurrency 1 4
+
+`sync` and `stream` write only rows owned by a throwaway `bench-<pid>` user and delete
+them afterwards; `payload`, `extract` (without --from-db) and `llm` need no database.
+`llm` runs the converter against a simulated provider, so it needs no API keys either.
+"""
+import argparse
+import asyncio
+import gzip
+import json
+import os
+import random
+import re
+import statistics
+import time
+import tracemalloc
+import extraction
+from classify import BANK_SENDER_PATTERNS, CREDIT_KEYWORDS, DEBIT_KEYWORDS, EXCLUSION_KEYWORDS
+from db import async_connection, close_async_pool, close_pool, init_async_pool, setup_database
+from ingest import INGEST_MODES, SYNC_STREAM_CHUNK_SIZE, ingest_messages, ingest_stream
+from payloads import (
+    SyncStreamParser,
+    decode_sync_request,
+    iter_message_batches,
+    iter_stream_text,
+    msgpack,
+    zstandard,
+)
+from schemas import SmsSyncRequest
+
+
+def _report(label: str, rows: int, seconds: float) -> None:
+    print(f"{label:<28} {rows:>9} rows {seconds:>8.3f}s {rows / seconds if seconds else 0:>12,.0f} rows/s")
+
+
+def _iter_fake_messages(count: int):
+    """(sms_id, address, body, date_received, message_type) rows spread over the past year."""
+    now = int(time.time() * 1000)
+    senders = ["AX-HDFCBK-S", "VM-SBIINB-T", "JD-ICICIB-S", "BZ-AXISBK-S", "+919876543210"]
+    for i in range(1, count + 1):
+        yield (
+            i,
+            random.choice(senders),
+            f"Sent Rs.{random.randint(1, 5000)}.00 from A/C x{random.randint(1000, 9999)}\nTo MERCHANT {i % 500}\nRef {i}",
+            now - i * 600_000,
+            1,
+        )
+
+
+def _fake_messages(count: int) -> list:
+    return list(_iter_fake_messages(count))
+
+
+async def _delete_user(user_name: str) -> None:
+    async with async_connection() as conn:
+        await conn.execute("DELETE FROM sms_messages WHERE user_name = %s;", (user_name,))
+
+
+async def bench_sync(args) -> None:
+    """Time a first sync (all new rows) and a re-sync (all duplicates) per ingest mode."""
+    setup_database()
+    await init_async_pool()
+    rows = _fake_messages(args.rows)
+    user_name = f"bench-{os.getpid()}"
+    try:
+        for mode in args.modes:
+            await _delete_user(user_name)
+            for label in ("first sync", "re-sync (duplicates)"):
+                start = time.perf_counter()
+                async with async_connection() as conn:
+                    counts = await ingest_messages(conn, user_name, rows, mode)
+                _report(f"{mode} {label}", counts["received_count"], time.perf_counter() - start)
+                print(f"{'':<28} inserted={counts['inserted_count']} duplicates={counts['duplicate_count']}")
+    finally:
+        await _delete_user(user_name)
+        await close_async_pool()
+        close_pool()
+
+
+def _payload_variants(payload: dict) -> list:
+    """(label, wire bytes, Content-Encoding, Content-Type) for each supported body format."""
+    raw_json = json.dumps(payload).encode()
+    variants = [
+        ("json", raw_json, None, "application/json"),
+        ("json+gzip", gzip.compress(raw_json, 6), "gzip", "application/json"),
+    ]
+    if zstandard is not None:
+        variants.append(("json+zstd", zstandard.ZstdCompressor(level=3).compress(raw_json), "zstd", "application/json"))
+    if msgpack is not None:
+        packed = msgpack.packb(payload)
+        variants.append(("msgpack", packed, None, "application/msgpack"))
+        if zstandard is not None:
+            variants.append(("msgpack+zstd", zstandard.ZstdCompressor(level=3).compress(packed), "zstd", "application/msgpack"))
+    return variants
+
+
+async def bench_payload(args) -> None:
+    """Time decoding + validation of one /sync body per format (no database)."""
+    payload = {
+        "user_name": "bench",
+        "messages": [
+            {"id": sms_id, "address": address, "body": body, "date": date, "type": kind}
+            for sms_id, address, body, date, kind in _fake_messages(args.messages)
+        ],
+    }
+    raw_size = len(json.dumps(payload).encode())
+    print(f"{args.messages} messages, {raw_size / 1e6:.2f} MB as JSON, {args.repeat} runs each\n")
+    print(f"{'format':<26} {'wire MB':>8} {'MB/s':>8} {'p50 ms':>8} {'p99 ms':>8}")
+
+    def run(label: str, decode, wire_size: int) -> None:
+        timings = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            request = decode()
+            timings.append(time.perf_counter() - start)
+        assert len(request.messages) == args.messages
+        timings.sort()
+        p99 = timings[min(len(timings) - 1, int(len(timings) * 0.99))]
+        mb_per_s = raw_size / 1e6 / statistics.mean(timings)
+        print(f"{label:<26} {wire_size / 1e6:>8.2f} {mb_per_s:>8.1f} {timings[len(timings) // 2] * 1000:>8.1f} {p99 * 1000:>8.1f}")
+
+    raw_json = json.dumps(payload).encode()
+    # What FastAPI does for a `payload: SmsSyncRequest` body parameter
+    run("json (loads + validate)", lambda: SmsSyncRequest.model_validate(json.loads(raw_json)), len(raw_json))
+    for label, body, encoding, content_type in _payload_variants(payload):
+        run(label, lambda: decode_sync_request(body, encoding, content_type), len(body))
+
+
+def _json_body_chunks(user_name: str, count: int, chunk_bytes: int = 65536):
+    """A /sync JSON body for `count` fake messages, generated piece by piece."""
+    pending = [json.dumps({"user_name": user_name})[:-1] + ', "messages": [']
+    size = len(pending[0])
+    for i, (sms_id, address, body, date, kind) in enumerate(_iter_fake_messages(count)):
+        item = json.dumps({"id": sms_id, "address": address, "body": body, "date": date, "type": kind})
+        pending.append(item if i == 0 else "," + item)
+        size += len(item) + 1
+        if size >= chunk_bytes:
+            yield "".join(pending).encode()
+            pending, size = [], 0
+    pending.append("]}")
+    yield "".join(pending).encode()
+
+
+class _StreamedRequest:
+    """Just enough of a Starlette request for the payload readers."""
+
+    def __init__(self, chunks):
+        self.headers = {"content-type": "application/json"}
+        self._chunks = chunks
+
+    async def stream(self):
+        for chunk in self._chunks:
+            yield chunk
+
+
+async def bench_stream(args) -> None:
+    """Peak Python memory and time of a whole-body /sync vs a streamed /sync/stream."""
+    setup_database()
+    await init_async_pool()
+    user_name = f"bench-{os.getpid()}"
+
+    async def whole_body() -> dict:
+        body = b"".join(_json_body_chunks(user_name, args.rows))
+        payload = decode_sync_request(body, None, "application/json")
+        rows = [(msg.id, msg.address, msg.body, msg.date, msg.type) for msg in payload.messages]
+        async with async_connection() as conn:
+            return await ingest_messages(conn, user_name, rows)
+
+    async def streamed() -> dict:
+        parser = SyncStreamParser()
+        request = _StreamedRequest(_json_body_chunks(user_name, args.rows))
+        batches = iter_message_batches(parser, iter_stream_text(request), args.chunk_size)
+        await anext(batches)
+        chunks = ([(msg.id, msg.address, msg.body, msg.date, msg.type) for msg in batch] async for batch in batches)
+        return await ingest_stream(parser.user_name, chunks)
+
+    try:
+        for label, run in (("/sync (whole body)", whole_body), ("/sync/stream", streamed)):
+            await _delete_user(user_name)
+            tracemalloc.start()
+            start = time.perf_counter()
+            counts = await run()
+            seconds = time.perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            _report(label, counts["received_count"], seconds)
+            print(f"{'':<28} peak Python memory {peak / 1e6:.1f} MB, inserted={counts['inserted_count']}")
+    finally:
+        await _delete_user(user_name)
+        await close_async_pool()
+        close_pool()
+
+
+# Reference copy of the rules as convert.py had them before extraction.py,
+# kept so `extract` can prove the compiled engine returns the same results.
+def _legacy_extract(address, text) -> dict:
+    bank = None
+    if address:
+        address_upper = address.upper()
+        for bank_name, patterns in BANK_SENDER_PATTERNS.items():
+            if any(pattern in address_upper for pattern in patterns):
+                bank = bank_name
+                break
+
+    amount = None
+    for pattern in [r'Rs\.?\s*(\d+(?:,\d+)*(?:\.\d{2})?)', r'INR\s*(\d+(?:,\d+)*(?:\.\d{2})?)', r'₹\s*(\d+(?:,\d+)*(?:\.\d{2})?)']:
+        matches = re.findall(pattern, text, re.IGNORECASE)
+        if matches:
+            amount = float(matches[0].replace(',', ''))
+            break
+
+    text_lower = text.lower()
+    transaction_type = None
+    if not any(keyword in text_lower for keyword in EXCLUSION_KEYWORDS):
+        transaction_type = next((
+            kind for keywords, kind in ((DEBIT_KEYWORDS, 'debited'), (CREDIT_KEYWORDS, 'credited'))
+            if any(keyword in text_lower for keyword in keywords)
+        ), None)
+
+    merchant = None
+    for line in text.split('\n'):
+        line = line.strip()
+        if line.lower().startswith('to '):
+            merchant = re.sub(r'\s+on\s+\d+/\d+/\d+.*', '', line[3:].strip(), flags=re.IGNORECASE)
+            break
+        upi_match = re.search(r'UPI/[^/]+/[^/]+/([^/]+)/', line, re.IGNORECASE)
+        if upi_match:
+            merchant = re.sub(r'\s+', ' ', upi_match.group(1).strip())
+            break
+        if 'merchant' in line.lower():
+            parts = line.split(':')
+            if len(parts) > 1:
+                merchant = parts[1].strip()
+                break
+    return {'bank': bank, 'amount': amount, 'transaction_type': transaction_type, 'merchant': merchant}
+
+
+_SAMPLE_SMS = [
+    ("AX-HDFCBK-S", "Sent Rs.{amount}\nFrom HDFC Bank A/C *{acct}\nTo {name}\nOn 10/08/25\nRef {ref}\nNot You?\nCall 18002586161/SMS BLOCK UPI to 7308080808"),
+    ("JD-ICICIB-S", "INR {amount} credited\nA/c no. XX{acct}\n10-08-25, 00:01:25 IST\nUPI/P2A/{ref}/{name}/ICICI Ban - Axis Bank "),
+    ("VM-SBIINB-T", "Dear Customer, your a/c no. XXXXX{acct} is debited by Rs {amount} on 10Aug25 transfer to {name} Ref No {ref}. If not done by u, fwd this SMS to 9223008333"),
+    ("BZ-KOTAKB-S", "Rs.{amount} paid to {name} on 01/02/25 from Kotak Bank a/c XX{acct}\nTo {name} on 01/02/25 at 10:00\nUPI Ref {ref}"),
+    ("VK-BESCOM-S", "Dear customer, your electricity bill of Rs {amount} is generated.\nPay before due date.\nMerchant: {name}"),
+    ("AD-HDFCBK-P", "Get a pre-approved loan offer of Rs {amount}. Apply now!"),
+    ("VM-AMAZON-T", "{ref} is your OTP for txn of INR {amount} at {name}. Do not share."),
+    ("CP-CANBK-S", "₹{amount} refund credited to A/c {acct} from {name}. Consent ref {ref}"),
+    ("+919876543210", "hey, sent you ₹{amount} for dinner at {name}"),
+    ("JM-IDBIB-S", "Your FD of Rs {amount} matures on 12/10. Invest again with IDBI"),
+    ("VM-PNBSMS-S", "A/c {acct} debited INR {amount}; Rs 5 charges. Merchant:{name} İstanbul"),
+]
+
+
+def _sample_corpus(count: int) -> list:
+    """(address, body) pairs drawn from typical bank, biller, OTP, promo and personal SMS."""
+    names = ["SWIGGY", "BMTC BUS KA57F2456", "BADAL  MEHER", "AMAZON PAY", "Zomato Ltd", "RAJ KUMAR"]
+    corpus = []
+    for i in range(count):
+        address, template = _SAMPLE_SMS[i % len(_SAMPLE_SMS)]
+        corpus.append((address, template.format(
+            amount=random.choice(["36.00", "1,234.50", "5", "12,00,000.00"]),
+            acct=random.randint(1000, 9999),
+            name=random.choice(names),
+            ref=random.randint(10**11, 10**12),
+        )))
+    return corpus
+
+
+async def bench_extract(args) -> None:
+    """Rule extraction: original rules vs extraction.extract(), with an output parity check."""
+    if args.from_db:
+        setup_database()
+        async with async_connection(readonly=True) as conn:
+            cur = await conn.execute(
+                "SELECT address, body FROM sms_messages WHERE body IS NOT NULL ORDER BY created_at DESC LIMIT %s;",
+                (args.messages,),
+            )
+            corpus = await cur.fetchall()
+        await close_async_pool()
+        close_pool()
+    else:
+        corpus = _sample_corpus(args.messages)
+    print(f"{len(corpus)} messages ({'sms_messages backlog' if args.from_db else 'sample corpus'})")
+
+    timings = {}
+    for label, extract in (("original rules", _legacy_extract), ("extraction.extract", extraction.extract)):
+        start = time.perf_counter()
+        results = [extract(address, body) for address, body in corpus]
+        timings[label] = (time.perf_counter() - start, results)
+        print(f"{label:<28} {len(corpus) / timings[label][0]:>12,.0f} msgs/s")
+    legacy, engine = timings["original rules"][1], timings["extraction.extract"][1]
+    mismatches = [(corpus[i], legacy[i], engine[i]) for i in range(len(corpus)) if legacy[i] != engine[i]]
+    print(f"speedup {timings['original rules'][0] / timings['extraction.extract'][0]:.2f}x, mismatches: {len(mismatches)}")
+    for message, expected, got in mismatches[:5]:
+        print(f"  {message!r}\n    original {expected}\n    engine   {got}")
+    if mismatches:
+        raise SystemExit(1)
+
+
+# Formats the rules leave incomplete (no "To" line / merchant), so each needs the LLM
+_LLM_SMS = [
+    ("VM-HDFCBK-S", "Your A/c XX{acct} is debited for Rs.{amount} on 10-08-25 at {name}. Avl Bal Rs.{ref}", "HDFC", "debited"),
+    ("JD-ICICIB-S", "Payment of INR {amount} received from {name} in your a/c XX{acct}. Ref {ref}", "ICICI", "credited"),
+    ("BZ-AXISBK-S", "INR {amount} debited from A/c no. XX{acct} at {name} on 10-08-25. Bal INR {ref}", "AXIS", "debited"),
+]
+
+
+class _RateLimited(Exception):
+    """What an SDK raises on HTTP 429, with a Retry-After header."""
+
+    status_code = 429
+
+    def __init__(self, retry_after: float):
+        super().__init__("429 Too Many Requests")
+        self.response = type("Response", (), {"headers": {"retry-after": str(retry_after)}})()
+
+
+class _SimulatedLLM:
+    """Answers extraction prompts from a known corpus after a fixed latency, sometimes badly."""
+
+    def __init__(self, answers: dict, latency: float, per_message: float, malformed: float, rate_limited: float):
+        self.answers = answers
+        self.latency = latency
+        self.per_message = per_message
+        self.malformed = malformed
+        self.rate_limited = rate_limited
+        self.random = random.Random(7)
+
+    async def ainvoke(self, prompt: str):
+        if self.random.random() < self.rate_limited:
+            raise _RateLimited(retry_after=0.5)
+        if "JSON array:" in prompt:
+            listing = prompt.split("JSON array:", 1)[1].split("\n\nReturn ONLY", 1)[0]
+            items = json.loads(listing)
+            content = json.dumps([{"id": item["id"], **self.answers[item["message"]]} for item in items])
+            if len(items) > 1 and self.random.random() < self.malformed:
+                content = content[: len(content) // 2]  # cut off, as by an output token limit
+        else:
+            items = [None]
+            message = prompt.split("Message: ", 1)[1].split("\n\nReturn ONLY", 1)[0]
+            content = json.dumps(self.answers[message])
+        await asyncio.sleep(self.latency + self.per_message * len(items))
+        return type("Response", (), {"content": content})()
+
+
+async def bench_llm(args) -> None:
+    """LLM extraction throughput by batch size and concurrency, within a requests/tokens-per-minute quota."""
+    # Imported here: langchain is slow to import and no other benchmark needs it
+    os.environ.setdefault("GEMINI_APIKEY", "bench")
+    os.environ.setdefault("OPENAI_APIKEY", "bench")
+    import convert
+    import llm_provider
+    import shapes
+    from llm_cache import response_cache
+
+    convert.logger.setLevel("ERROR")
+    llm_provider.logger.setLevel("ERROR")
+    # Measure the LLM path itself: no learned shapes, no cached responses
+    shapes.SHAPE_CACHE_ENABLED = convert.SHAPE_CACHE_ENABLED = False
+    response_cache.ttl = 0
+
+    names = ["SWIGGY", "BMTC BUS KA57F2456", "AMAZON PAY", "Zomato Ltd", "RAJ KUMAR", "IRCTC"]
+    messages, answers = [], {}
+    for i in range(args.messages):
+        address, template, bank, transaction_type = _LLM_SMS[i % len(_LLM_SMS)]
+        amount = f"{random.randint(1, 99999)}.{random.randint(0, 99):02d}"
+        name = random.choice(names)
+        body = template.format(amount=amount, acct=random.randint(1000, 9999), name=name, ref=random.randint(10**5, 10**6))
+        messages.append({"sms_id": i, "address": address, "body": body})
+        answers[body] = {"bank": bank, "amount": amount, "transaction_type": transaction_type, "merchant": name}
+    print(f"{len(messages)} messages, {args.latency}s + {args.per_message}s/message per call, quota {args.rpm} RPM / "
+          f"{args.tpm} TPM, {args.malformed:.0%} of batch answers malformed, {args.rate_limited:.0%} of calls get a 429")
+
+    baseline = None
+    for size in args.batch_sizes:
+        for concurrency in args.concurrency:
+            convert.LLM_BATCH_SIZE = size
+            # A fresh quota per run, so runs do not eat into each other's buckets
+            limiter = llm_provider.ProviderLimiter("gemini", args.rpm, args.tpm)
+            llm_provider.PROVIDER_LIMITERS["gemini"] = limiter
+            converter = convert.SMSToTransactionConverter()
+            converter.llm_provider._semaphore = asyncio.Semaphore(concurrency)
+            converter.llm_provider.retry_delay = 0.5
+            converter.llm_provider.max_retries = 4
+            converter.llm_provider.primary_llm = _SimulatedLLM(
+                answers, args.latency, args.per_message, args.malformed, args.rate_limited
+            )
+            start = time.perf_counter()
+            results = {message["sms_id"]: data async for message, data in converter.aconvert_messages(messages)}
+            seconds = time.perf_counter() - start
+            if baseline is None:
+                baseline = (seconds, results)
+            mismatches = sum(1 for sms_id, data in results.items() if data != baseline[1][sms_id])
+            stats = limiter.stats()
+            print(f"batch {size:>3} x {concurrency:>2} in flight  {converter.ai_calls_made:>4} calls "
+                  f"{converter.batch_splits:>3} splits {stats['rate_limited']:>3} 429s {seconds:>7.2f}s "
+                  f"{len(messages) / seconds * 60:>8,.0f} msgs/min {baseline[0] / seconds:>6.1f}x  mismatches: {mismatches}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    sync = commands.add_parser("sync", help="/sync ingest: batched INSERTs vs COPY + merge")
+    sync.add_argument("--rows", type=int, default=50_000)
+    sync.add_argument("--modes", nargs="+", choices=INGEST_MODES, default=list(INGEST_MODES))
+    sync.set_defaults(run=bench_sync)
+
+    payload = commands.add_parser("payload", help="/sync body decoding: JSON vs gzip/zstd vs MessagePack")
+    payload.add_argument("--messages", type=int, default=20_000)
+    payload.add_argument("--repeat", type=int, default=30)
+    payload.set_defaults(run=bench_payload)
+
+    stream = commands.add_parser("stream", help="/sync vs /sync/stream: peak memory and throughput")
+    stream.add_argument("--rows", type=int, default=200_000)
+    stream.add_argument("--chunk-size", type=int, default=SYNC_STREAM_CHUNK_SIZE)
+    stream.set_defaults(run=bench_stream)
+
+    extract = commands.add_parser("extract", help="rule extraction throughput and parity with the original rules")
+    extract.add_argument("--messages", type=int, default=50_000)
+    extract.add_argument("--from-db", action="store_true", help="use the newest messages in sms_messages")
+    extract.set_defaults(run=bench_extract)
+
+    llm = commands.add_parser("llm", help="LLM extraction by batch size and concurrency (simulated provider)")
+    llm.add_argument("--messages", type=int, default=40)
+    llm.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 10])
+    llm.add_argument("--concurrency", type=int, nargs="+", default=[1, 4])
+    llm.add_argument("--latency", type=float, default=0.8, help="seconds per call")
+    llm.add_argument("--per-message", type=float, default=0.05, help="extra seconds per message in a call")
+    llm.add_argument("--rpm", type=int, default=120, help="provider requests per minute")
+    llm.add_argument("--tpm", type=int, default=1_000_000, help="provider tokens per minute")
+    llm.add_argument("--malformed", type=float, default=0.1, help="share of batch answers cut off mid-JSON")
+    llm.add_argument("--rate-limited", type=float, default=0.05, help="share of calls answered with a 429")
+    llm.set_defaults(run=bench_llm)
+
+    args = parser.parse_args()
+    asyncio.run(args.run(args))
+
+
+if __name__ == "__main__":
+    main()
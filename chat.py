@@ -1,10 +1,12 @@
 import os
 import json
 from typing import Optional, Dict, Any, List, Tuple
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
+from zoneinfo import ZoneInfo
 from decimal import Decimal
 from logging_config import get_logger
-from db import get_db_connection
+from db import APP_TIMEZONE, LOCAL_TIME_SQL, connection
+from statements import execute as execute_prepared, is_registered, register, sql_for
 from langchain.tools import Tool
 from langchain.agents import create_openai_functions_agent, AgentExecutor
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
@@ -14,6 +16,92 @@ from langchain_google_genai import ChatGoogleGenerativeAI
 
 logger = get_logger("sms_sync.chat")
 
+# Fixed chat tool queries, prepared once per pooled connection
+SEARCH_MERCHANTS = register(
+    "chat_search_merchants",
+    """
+    SELECT DISTINCT merchant, COUNT(*) as transaction_count
+    FROM transactions
+    WHERE user_name = %s
+    AND merchant IS NOT NULL
+    AND merchant != ''
+    AND LOWER(merchant) LIKE LOWER(%s)
+    AND transaction_type IN ('debited', 'credited')
+    GROUP BY merchant
+    ORDER BY transaction_count DESC, merchant
+    LIMIT 10;
+    """,
+)
+ALL_MERCHANTS = register(
+    "chat_all_merchants",
+    """
+    SELECT DISTINCT merchant, COUNT(*) as transaction_count
+    FROM transactions
+    WHERE user_name = %s
+    AND merchant IS NOT NULL
+    AND merchant != ''
+    AND transaction_type IN ('debited', 'credited')
+    GROUP BY merchant
+    ORDER BY transaction_count DESC
+    LIMIT 20;
+    """,
+)
+ALL_BANKS = register(
+    "chat_all_banks",
+    """
+    SELECT DISTINCT bank, COUNT(*) as transaction_count
+    FROM transactions
+    WHERE user_name = %s
+    AND bank IS NOT NULL
+    AND bank != ''
+    AND transaction_type IN ('debited', 'credited')
+    GROUP BY bank
+    ORDER BY transaction_count DESC;
+    """,
+)
+# Spending summaries read the daily_spend rollup (see rollup.py) by calendar day
+SPENDING_BY_MERCHANT = register(
+    "chat_spending_by_merchant",
+    """
+    SELECT merchant, SUM(total_amount) as total_amount, SUM(txn_count) as transaction_count
+    FROM daily_spend
+    WHERE user_name = %s
+    AND transaction_type = 'debited'
+    AND day BETWEEN %s AND %s
+    AND merchant != ''
+    GROUP BY merchant
+    ORDER BY total_amount DESC
+    LIMIT 10;
+    """,
+)
+SPENDING_BY_BANK = register(
+    "chat_spending_by_bank",
+    """
+    SELECT bank, SUM(total_amount) as total_amount, SUM(txn_count) as transaction_count
+    FROM daily_spend
+    WHERE user_name = %s
+    AND transaction_type = 'debited'
+    AND day BETWEEN %s AND %s
+    AND bank != ''
+    GROUP BY bank
+    ORDER BY total_amount DESC;
+    """,
+)
+SPENDING_TOTALS = register(
+    "chat_spending_totals",
+    """
+    SELECT
+        SUM(CASE WHEN transaction_type = 'debited' THEN total_amount ELSE 0 END) as total_spent,
+        SUM(CASE WHEN transaction_type = 'credited' THEN total_amount ELSE 0 END) as total_received,
+        COALESCE(SUM(CASE WHEN transaction_type = 'debited' THEN txn_count END), 0) as debit_count,
+        COALESCE(SUM(CASE WHEN transaction_type = 'credited' THEN txn_count END), 0) as credit_count
+    FROM daily_spend
+    WHERE user_name = %s
+    AND day BETWEEN %s AND %s
+    AND transaction_type IN ('debited', 'credited');
+    """,
+)
+
 
 class TransactionChatSystem:
     """Advanced chat system with LLM function calling for transaction queries."""
@@ -48,9 +136,9 @@ class TransactionChatSystem:
             )
             logger.info("Using Gemini LLM for chat system")
     
-    def _get_timestamp_range(self, period: str) -> Tuple[int, int]:
-        """Get timestamp range for different periods."""
-        now = datetime.now()
+    def _get_period_bounds(self, period: str) -> Tuple[datetime, datetime]:
+        """Get the start and end moments of a period in APP_TIMEZONE."""
+        now = datetime.now(ZoneInfo(APP_TIMEZONE))
         
         if period == "today":
             start = now.replace(hour=0, minute=0, second=0, microsecond=0)
@@ -90,16 +178,29 @@ class TransactionChatSystem:
             start = now.replace(hour=0, minute=0, second=0, microsecond=0)
             end = now.replace(hour=23, minute=59, second=59, microsecond=999999)
         
+        return start, end
+
+    def _get_timestamp_range(self, period: str) -> Tuple[int, int]:
+        """Get epoch millisecond range for different periods."""
+        start, end = self._get_period_bounds(period)
         return int(start.timestamp() * 1000), int(end.timestamp() * 1000)
 
+    def _get_day_range(self, period: str) -> Tuple[date, date]:
+        """Get the inclusive calendar day range for different periods (for daily_spend)."""
+        start, end = self._get_period_bounds(period)
+        return start.date(), end.date()
+
     def _execute_sql_query(self, query: str, params: tuple, user_name: str) -> List[Dict[str, Any]]:
-        """Execute SQL query and return formatted results."""
-        conn = None
+        """Execute SQL query (or a registered prepared statement name) and return formatted results."""
+        prepared = is_registered(query)
+        sql = sql_for(query) if prepared else query
         try:
-            conn = get_db_connection()
-            with conn.cursor() as cur:
-                logger.debug(f"Executing SQL for '{user_name}': {cur.mogrify(query, params).decode('utf-8')}")
-                cur.execute(query, params)
+            with connection(readonly=True) as conn, conn.cursor() as cur:
+                logger.debug(f"Executing SQL for '{user_name}': {cur.mogrify(sql, params).decode('utf-8')}")
+                if prepared:
+                    execute_prepared(cur, query, params)
+                else:
+                    cur.execute(sql, params)
                 
                 if cur.description is None:
                     return []
@@ -118,12 +219,6 @@ class TransactionChatSystem:
                         
                         if isinstance(value, Decimal):
                             row_dict[col_name] = float(value)
-                        elif col_name == 'date_received' and value:
-                            try:
-                                date_object = datetime.fromtimestamp(value / 1000)
-                                row_dict[col_name] = date_object.strftime("%Y-%m-%d %H:%M:%S")
-                            except (ValueError, TypeError):
-                                row_dict[col_name] = value
                         elif col_name == 'amount' and value is not None:
                             row_dict[col_name] = float(value)
                         else:
@@ -135,33 +230,19 @@ class TransactionChatSystem:
         except Exception as e:
             logger.error(f"Error executing query for user '{user_name}': {e}", exc_info=True)
             try:
-                with get_db_connection().cursor() as temp_cur:
-                    failed_query = temp_cur.mogrify(query, params).decode('utf-8')
+                with connection(readonly=True) as temp_conn, temp_conn.cursor() as temp_cur:
+                    failed_query = temp_cur.mogrify(sql, params).decode('utf-8')
                     logger.error(f"Failed Query: {failed_query}")
             except Exception as mogrify_error:
-                logger.error(f"Could not mogrify failing query. Raw: {query}, Params: {params}, Error: {mogrify_error}")
+                logger.error(f"Could not mogrify failing query. Raw: {sql}, Params: {params}, Error: {mogrify_error}")
             return []
-        finally:
-            if conn:
-                conn.close()
 
     def _setup_tools(self):
         """Setup tools for the LLM agent."""
         
         def search_merchants(user_name: str, search_term: str) -> str:
             """Search for merchants that match or contain the search term."""
-            query = """
-                SELECT DISTINCT merchant, COUNT(*) as transaction_count
-                FROM transactions 
-                WHERE user_name = %s 
-                AND merchant IS NOT NULL 
-                AND merchant != ''
-                AND LOWER(merchant) LIKE LOWER(%s)
-                AND transaction_type IN ('debited', 'credited')
-                GROUP BY merchant
-                ORDER BY transaction_count DESC, merchant
-                LIMIT 10;
-                """
+            query = SEARCH_MERCHANTS
             try:
                 results = self._execute_sql_query(query, (user_name, f"%{search_term}%"), user_name)
                 if not results:
@@ -173,17 +254,7 @@ class TransactionChatSystem:
         
         def get_all_merchants(user_name: str) -> str:
             """Get all unique merchants for the user."""
-            query = """
-                SELECT DISTINCT merchant, COUNT(*) as transaction_count
-                FROM transactions 
-                WHERE user_name = %s 
-                AND merchant IS NOT NULL 
-                AND merchant != ''
-                AND transaction_type IN ('debited', 'credited')
-                GROUP BY merchant
-                ORDER BY transaction_count DESC
-                LIMIT 20;
-                """
+            query = ALL_MERCHANTS
             try:
                 results = self._execute_sql_query(query, (user_name,), user_name)
                 return json.dumps(results)
@@ -193,16 +264,7 @@ class TransactionChatSystem:
 
         def get_all_banks(user_name: str) -> str:
             """Get all banks for the user."""
-            query = """
-                SELECT DISTINCT bank, COUNT(*) as transaction_count
-                FROM transactions 
-                WHERE user_name = %s 
-                AND bank IS NOT NULL 
-                AND bank != ''
-                AND transaction_type IN ('debited', 'credited')
-                GROUP BY bank
-                ORDER BY transaction_count DESC;
-                """
+            query = ALL_BANKS
             try:
                 results = self._execute_sql_query(query, (user_name,), user_name)
                 return json.dumps(results)
@@ -260,13 +322,14 @@ class TransactionChatSystem:
                 summary_results = self._execute_sql_query(summary_query, tuple(params), user_name)
                 
                 transactions_query = f"""
-                SELECT bank, amount, transaction_type, merchant, date_received, address
+                SELECT bank, amount, transaction_type, merchant,
+                       {LOCAL_TIME_SQL} AS date_received, address
                 FROM transactions 
                 WHERE {where_sql}
-                ORDER BY date_received DESC 
+                ORDER BY transactions.date_received DESC 
                 LIMIT 20;
                 """
-                transaction_list = self._execute_sql_query(transactions_query, tuple(params), user_name)
+                transaction_list = self._execute_sql_query(transactions_query, (APP_TIMEZONE, *params), user_name)
                 
                 summary = summary_results[0] if summary_results else {
                     "total_transactions": 0, "total_amount": 0, "total_debits": 0, "total_credits": 0
@@ -282,44 +345,15 @@ class TransactionChatSystem:
         def calculate_spending_summary(user_name: str, date_range: str, groupby: str = None) -> str:
             """Calculate spending summary for a date range, optionally grouped by merchant or bank."""
             try:
-                start_ts, end_ts = self._get_timestamp_range(date_range)
-                params = (user_name, start_ts, end_ts)
+                start_day, end_day = self._get_day_range(date_range)
+                params = (user_name, start_day, end_day)
 
                 if groupby == "merchant":
-                    query = """
-                    SELECT merchant, SUM(ABS(amount)) as total_amount, COUNT(*) as transaction_count
-                    FROM transactions 
-                    WHERE user_name = %s 
-                    AND transaction_type = 'debited'
-                    AND date_received BETWEEN %s AND %s
-                    AND merchant IS NOT NULL AND merchant != ''
-                    GROUP BY merchant
-                    ORDER BY total_amount DESC
-                    LIMIT 10;
-                    """
+                    query = SPENDING_BY_MERCHANT
                 elif groupby == "bank":
-                    query = """
-                    SELECT bank, SUM(ABS(amount)) as total_amount, COUNT(*) as transaction_count
-                    FROM transactions 
-                    WHERE user_name = %s 
-                    AND transaction_type = 'debited'
-                    AND date_received BETWEEN %s AND %s
-                    AND bank IS NOT NULL AND bank != ''
-                    GROUP BY bank
-                    ORDER BY total_amount DESC;
-                    """
+                    query = SPENDING_BY_BANK
                 else:
-                    query = """
-                    SELECT 
-                        SUM(CASE WHEN transaction_type = 'debited' THEN ABS(amount) ELSE 0 END) as total_spent,
-                        SUM(CASE WHEN transaction_type = 'credited' THEN ABS(amount) ELSE 0 END) as total_received,
-                        COUNT(CASE WHEN transaction_type = 'debited' THEN 1 END) as debit_count,
-                        COUNT(CASE WHEN transaction_type = 'credited' THEN 1 END) as credit_count
-                    FROM transactions 
-                    WHERE user_name = %s 
-                    AND date_received BETWEEN %s AND %s
-                    AND transaction_type IN ('debited', 'credited');
-                    """
+                    query = SPENDING_TOTALS
                 
                 results = self._execute_sql_query(query, params, user_name)
                 return json.dumps(results)
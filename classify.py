@@ -0,0 +1,149 @@
+"""Cheap ingest-time classification of SMS messages.
+
+`/sync` tags every message with a category so the convert pipeline (rules,
+then an LLM call) only looks at messages that can be transactions:
+
+- "outgoing":    not an inbox message (sent, draft, outbox, ...)
+- "financial":   money moved (debit/credit/spend wording with an amount, an
+                 account reference or a bank sender)
+- "otp":         one-time password and verification code deliveries
+- "promotional": offers and marketing
+- "personal":    from a phone number
+- "other":       everything else (service alerts, notices)
+
+The rules err towards "financial": a promotion that slips through costs one
+convert pass, a missed transaction is lost. That is also why the money check
+runs first: debit alerts often end with "do not share your OTP". Rows synced before this existed
+have a NULL category and are still converted; `python classify.py` tags them.
+
+The keyword sets are shared with the rule-based extraction in convert.py.
+"""
+import re
+from functools import lru_cache
+from typing import Optional
+from db import connection
+from logging_config import get_logger
+
+logger = get_logger("sms_sync.classify")
+
+# Android Telephony.Sms.MESSAGE_TYPE_INBOX
+MESSAGE_TYPE_INBOX = 1
+
+CATEGORIES = ("financial", "otp", "promotional", "personal", "outgoing", "other")
+# The categories the convert pipeline looks at (NULL = not classified yet)
+CONVERT_CATEGORY_SQL = "(category = 'financial' OR category IS NULL)"
+
+# Bank name -> substrings of its SMS sender IDs (e.g. AX-HDFCBK-S)
+BANK_SENDER_PATTERNS = {
+    'HDFC': ['HDFC', 'HDFCBK'],
+    'AXIS': ['AXIS', 'AXISBK'],
+    'SBI': ['SBI', 'SBIIN'],
+    'ICICI': ['ICICI', 'ICICIB'],
+    'KOTAK': ['KOTAK', 'KOTAKB'],
+    'PNB': ['PNB', 'PNBIN'],
+    'BOB': ['BOB', 'BOBCARD'],
+    'CANARA': ['CANARA', 'CANBK'],
+    'UNION': ['UNION', 'UBIN'],
+    'IDBI': ['IDBI', 'IDBIB']
+}
+
+# Non-transactional wording (offers, reminders, future or pending payments)
+EXCLUSION_KEYWORDS = [
+    "invest", "fd", "fixed deposit", "loan offer", "book now",
+    "apply now", "mandate created", "mandate has been created",
+    "towards", "scheduled", "authorization",
+    "pre-approved", "otp", "reminder"
+]
+DEBIT_KEYWORDS = ['sent', 'debited', 'paid', 'transferred', 'withdrawn', 'purchase']
+CREDIT_KEYWORDS = ['received', 'credited', 'deposited', 'refund', 'cashback']
+
+_AMOUNT = re.compile(r'(?:Rs\.?|INR|₹)\s*\d', re.IGNORECASE)
+_ACCOUNT = re.compile(r'\b(?:a/c|acct|account|card|upi|neft|imps|rtgs|atm)\b', re.IGNORECASE)
+_OTP_WORDS = r'(?:otp|one[ -]time password|verification code|security code)'
+# "OTP is 123456", "Your OTP for login: 123456", "123456 is your OTP"; not "never share your OTP"
+_OTP = re.compile(
+    rf'\b{_OTP_WORDS}\b(?:[^.\n\d]{{0,30}}?(?:\bis\b|:)|\s*)\s*\d{{4,8}}\b'
+    rf'|\b\d{{4,8}}\s+is\s+(?:your\s+|the\s+)?{_OTP_WORDS}\b',
+    re.IGNORECASE,
+)
+_PROMOTION = re.compile(
+    r'loan offer|book now|apply now|pre-approved|\boffer\b|\bsale\b|\d+% off|\bdiscount\b|\bwin\b|click here|limited period',
+    re.IGNORECASE,
+)
+_PHONE_NUMBER = re.compile(r'^\+?[\d\s-]{7,}$')
+# Card alerts say "spent" or "charged" rather than "debited"
+_MONEY_WORDS = DEBIT_KEYWORDS + CREDIT_KEYWORDS + ['spent', 'charged']
+
+
+@lru_cache(maxsize=4096)
+def bank_from_sender(address: Optional[str]) -> Optional[str]:
+    """Bank name for a sender ID, or None (cached: sender IDs repeat constantly)."""
+    if not address:
+        return None
+    address_upper = address.upper()
+    for bank_name, patterns in BANK_SENDER_PATTERNS.items():
+        for pattern in patterns:
+            if pattern in address_upper:
+                return bank_name
+    return None
+
+
+def classify(address: Optional[str], body: Optional[str], message_type: Optional[int] = MESSAGE_TYPE_INBOX) -> str:
+    """Category of one message; see the module docstring."""
+    if message_type is not None and message_type != MESSAGE_TYPE_INBOX:
+        return "outgoing"
+    text = body or ""
+    text_lower = text.lower()
+    if any(word in text_lower for word in _MONEY_WORDS) and (
+        _AMOUNT.search(text) or _ACCOUNT.search(text) or bank_from_sender(address)
+    ):
+        return "financial"
+    if _OTP.search(text):
+        return "otp"
+    if _PROMOTION.search(text):
+        return "promotional"
+    if address and _PHONE_NUMBER.match(address.strip()):
+        return "personal"
+    return "other"
+
+
+def backfill(batch_size: int = 5000) -> int:
+    """Classify rows synced before categories existed; returns rows tagged."""
+    total = 0
+    while True:
+        with connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    """
+                    SELECT sms_id, user_name, date_received, address, body, message_type
+                    FROM sms_messages WHERE category IS NULL LIMIT %s;
+                    """,
+                    (batch_size,),
+                )
+                rows = cur.fetchall()
+                if not rows:
+                    break
+                cur.executemany(
+                    """
+                    UPDATE sms_messages SET category = %s
+                    WHERE sms_id = %s AND user_name = %s AND date_received IS NOT DISTINCT FROM %s;
+                    """,
+                    [(classify(address, body, kind), sms_id, user_name, date_received)
+                     for sms_id, user_name, date_received, address, body, kind in rows],
+                )
+            conn.commit()
+        total += len(rows)
+        logger.info(f"Classified {total} messages so far")
+    return total
+
+
+if __name__ == "__main__":
+    import argparse
+    from logging_config import setup_logging
+
+    parser = argparse.ArgumentParser(description="Tag sms_messages rows that have no category yet")
+    parser.add_argument("--batch-size", type=int, default=5000)
+    args = parser.parse_args()
+
+    setup_logging()
+    print(f"messages classified: {backfill(args.batch_size)}")
@@ -1,18 +1,82 @@
 # convert.py
+import asyncio
 import os
 import json
 import re
+import threading
 import time
-from typing import Dict, List, Optional
+from typing import AsyncIterator, Dict, List, Optional, Tuple
 from dotenv import load_dotenv
 from logging_config import get_logger
-from db import get_db_connection, setup_database
+from db import connection
 from llm_provider import LLMProvider
+import rollup
+import extraction
+from sms_templates import match_template
+from shapes import SHAPE_CACHE_ENABLED, flush_shape_hits, learn_shape, lookup_shape, shape_of
+from classify import CONVERT_CATEGORY_SQL
+from statements import execute as execute_prepared, register
 
 # Load environment variables
 load_dotenv()
 logger = get_logger("sms_sync.convert")
 
+# pg_advisory_lock key held while a conversion round runs
+CONVERT_LOCK_ID = 7311_2026
+
+# Every round runs on this one event loop (started on first use, on a daemon
+# thread). Async clients that pool connections process-wide, such as
+# langchain_openai's default httpx client, stay bound to the loop that first
+# used them, so a fresh asyncio.run per round would break them from round 2.
+_round_loop: Optional[asyncio.AbstractEventLoop] = None
+_round_loop_lock = threading.Lock()
+
+INSERT_TRANSACTION = register(
+    "convert_insert_transaction",
+    """
+    INSERT INTO transactions (user_name, sms_id, address, bank, amount, transaction_type, merchant, date_received, created_at)
+    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+    ON CONFLICT DO NOTHING
+    """,
+)
+MARK_PROCESSED = register(
+    "convert_mark_processed",
+    """
+    UPDATE sms_messages
+    SET is_processed = TRUE
+    WHERE sms_id = %s AND user_name = %s AND date_received = %s
+    """,
+)
+MARK_UNDATED_PROCESSED = register(
+    "convert_mark_undated_processed",
+    """
+    UPDATE sms_messages_default
+    SET is_processed = TRUE
+    WHERE sms_id = %s AND user_name = %s AND date_received IS NULL
+    """,
+)
+
+# Messages sent to the LLM per call (1 = one prompt per message)
+LLM_BATCH_SIZE = max(1, int(os.getenv("LLM_BATCH_SIZE", "10")))
+
+# Shared by the single-message and batch prompts
+EXTRACTION_FIELDS = """    "bank": "bank name (HDFC, AXIS, SBI, etc.)",
+    "amount": "numeric amount without currency symbols",
+    "transaction_type": "debited, credited, or other",
+    "merchant": "other party involved in the transaction (shop, business, service, or individual), or null if not a transaction\""""
+EXTRACTION_RULES = """- Extract bank from address patterns (AX-HDFCBK-S means HDFC, VM-HDFCBK-S means HDFC)
+- Amount should be just the number (36.00 not Rs.36.00)
+- "transaction_type" rules:
+    * "debited" ONLY if the message clearly confirms money was sent, paid, withdrawn, deducted, or spent from the account.
+    * "credited" ONLY if the message clearly confirms money was received, deposited, or added to the account.
+    * "other" if ANY of these are true:
+        - The message is promotional, informational, or about future/potential transactions.
+        - The message contains any of these keywords (case-insensitive): 
+          ["invest", "FD", "fixed deposit", "loan offer", "book now", "apply now", "mandate created", "mandate has been created", "towards", "scheduled", "will be", "authorization", "pre-approved", "OTP", "reminder"].
+        - The message does not explicitly confirm that money has already moved.
+- Merchant should only be extracted if the message is a confirmed debit or credit transaction. For non-transaction messages, set merchant to null.
+- Use null for missing data"""
+
 
 class SMSToTransactionConverter:
     """Converts SMS messages to transaction data using LLM providers."""
@@ -20,55 +84,18 @@ class SMSToTransactionConverter:
     def __init__(self):
         """Initialize the converter with LLM provider."""
         self.llm_provider = LLMProvider()
+        self.ai_calls_made = 0
+        self.ai_calls_skipped = 0
+        self.shape_hits = 0
+        self.batch_splits = 0
     
     def extract_bank_from_address(self, address: str) -> Optional[str]:
         """Extract bank name from SMS address using pattern matching."""
-        if not address:
-            return None
-            
-        address_upper = address.upper()
-        
-        # Common bank patterns in SMS addresses
-        bank_patterns = {
-            'HDFC': ['HDFC', 'HDFCBK'],
-            'AXIS': ['AXIS', 'AXISBK'],
-            'SBI': ['SBI', 'SBIIN'],
-            'ICICI': ['ICICI', 'ICICIB'],
-            'KOTAK': ['KOTAK', 'KOTAKB'],
-            'PNB': ['PNB', 'PNBIN'],
-            'BOB': ['BOB', 'BOBCARD'],
-            'CANARA': ['CANARA', 'CANBK'],
-            'UNION': ['UNION', 'UBIN'],
-            'IDBI': ['IDBI', 'IDBIB']
-        }
-        
-        for bank_name, patterns in bank_patterns.items():
-            for pattern in patterns:
-                if pattern in address_upper:
-                    return bank_name
-        
-        return None
+        return extraction.extract_bank(address)
     
     def extract_amount(self, text: str) -> Optional[float]:
         """Extract amount from SMS text."""
-        # Pattern to match currency amounts
-        patterns = [
-            r'Rs\.?\s*(\d+(?:,\d+)*(?:\.\d{2})?)',  # Rs.36.00 or Rs 36.00
-            r'INR\s*(\d+(?:,\d+)*(?:\.\d{2})?)',    # INR 36.00
-            r'₹\s*(\d+(?:,\d+)*(?:\.\d{2})?)',      # ₹36.00
-        ]
-        
-        for pattern in patterns:
-            matches = re.findall(pattern, text, re.IGNORECASE)
-            if matches:
-                # Take the first match and clean it
-                amount_str = matches[0].replace(',', '')
-                try:
-                    return float(amount_str)
-                except ValueError:
-                    continue
-        
-        return None
+        return extraction.extract_amount(text)
     
     # def extract_transaction_type(self, text: str) -> Optional[str]:
     #     """Extract transaction type from SMS text."""
@@ -91,93 +118,57 @@ class SMSToTransactionConverter:
 
     def extract_transaction_type(self, text: str) -> Optional[str]:
         """Extract transaction type from SMS text."""
-        text_lower = text.lower()
-
-        # Exclusion keywords (non-transactional)
-        exclusion_keywords = [
-            "invest", "fd", "fixed deposit", "loan offer", "book now", 
-            "apply now", "mandate created", "mandate has been created", 
-            "towards", "scheduled", "authorization", 
-            "pre-approved", "otp", "reminder"
-        ]
-
-        # If any exclusion keyword exists, return None (treat as 'other')
-        if any(keyword in text_lower for keyword in exclusion_keywords):
-            return None
-
-        # Debit indicators
-        debit_keywords = ['sent', 'debited', 'paid', 'transferred', 'withdrawn', 'purchase']
-        # Credit indicators
-        credit_keywords = ['received', 'credited', 'deposited', 'refund', 'cashback']
-
-        for keyword in debit_keywords:
-            if keyword in text_lower:
-                return 'debited'
-                    
-        for keyword in credit_keywords:
-            if keyword in text_lower:
-                return 'credited'
-            
-        return None
+        return extraction.extract_transaction_type(text)
 
     
     def extract_merchant(self, text: str) -> Optional[str]:
         """Extract merchant/recipient from SMS text."""
-        lines = text.split('\n')
+        return extraction.extract_merchant(text)
+    
+    def _merge(self, rules: Dict, ai_result: Dict) -> Dict:
+        """Combine rule-based and AI results, preferring rule-based."""
+        return {
+            'bank': rules['bank'] or ai_result.get('bank'),
+            'amount': rules['amount'] or ai_result.get('amount'),
+            'transaction_type': rules['transaction_type'] or ai_result.get('transaction_type'),
+            'merchant': rules['merchant'] or ai_result.get('merchant')
+        }
+    
+    def _resolve_locally(self, sms_body: str, address: str) -> Tuple[Optional[Dict], Dict]:
+        """(result, rule-based fields); result is None when only the LLM can complete the message."""
+        # First try rule-based extraction for better reliability
+        rules = extraction.extract(address, sms_body)
         
-        for line in lines:
-            line = line.strip()
-            # Look for "To" patterns
-            if line.lower().startswith('to '):
-                merchant = line[3:].strip()
-                # Clean up common suffixes
-                merchant = re.sub(r'\s+on\s+\d+/\d+/\d+.*', '', merchant, flags=re.IGNORECASE)
-                return merchant
-            
-            # Look for UPI transaction patterns
-            # Pattern: UPI/P2A/reference/MERCHANT_NAME/bank
-            upi_pattern = r'UPI/[^/]+/[^/]+/([^/]+)/'
-            upi_match = re.search(upi_pattern, line, re.IGNORECASE)
-            if upi_match:
-                merchant = upi_match.group(1).strip()
-                # Clean up common suffixes and extra spaces
-                merchant = re.sub(r'\s+', ' ', merchant)
-                return merchant
-            
-            # Look for other merchant patterns
-            if 'merchant' in line.lower():
-                parts = line.split(':')
-                if len(parts) > 1:
-                    return parts[1].strip()
+        # If rule-based extraction got everything, use it (skip AI call)
+        if all(rules.values()):
+            result = dict(rules)
+            logger.info(f"Rule-based extraction successful (no AI call needed): {result}")
+            self.ai_calls_skipped += 1
+            return result, rules
+        
+        # A bank-specific template may know this format exactly
+        template_result = match_template(address, sms_body)
+        if template_result:
+            logger.info(
+                f"Template {template_result['template']} matched (no AI call needed): "
+                f"account {template_result['account']}"
+            )
+            self.ai_calls_skipped += 1
+            return {field: template_result[field] for field in ('bank', 'amount', 'transaction_type', 'merchant')}, rules
         
-        return None
+        # The LLM has already extracted a message of this shape
+        shape_result = lookup_shape(address, sms_body)
+        if shape_result:
+            final_result = self._merge(rules, shape_result)
+            logger.info(f"Learned shape matched (no AI call needed): {final_result}")
+            self.ai_calls_skipped += 1
+            self.shape_hits += 1
+            return final_result, rules
+        
+        return None, rules
     
-    def convert_sms_to_transaction(self, sms_body: str, address: str) -> Dict:
-        """Convert a single SMS to transaction data."""
-        try:
-            logger.info(f"Converting SMS from address: {address}")
-            logger.debug(f"SMS body: {sms_body[:100]}...")
-            
-            # First try rule-based extraction for better reliability
-            bank = self.extract_bank_from_address(address)
-            amount = self.extract_amount(sms_body)
-            transaction_type = self.extract_transaction_type(sms_body)
-            merchant = self.extract_merchant(sms_body)
-            
-            # If rule-based extraction got everything, use it (skip AI call)
-            if all([bank, amount, transaction_type, merchant]):
-                result = {
-                    'bank': bank,
-                    'amount': amount,
-                    'transaction_type': transaction_type,
-                    'merchant': merchant
-                }
-                logger.info(f"Rule-based extraction successful (no AI call needed): {result}")
-                return result
-            
-            # Otherwise, use AI to fill in missing parts
-            logger.info("Using AI to extract missing transaction data")
-            
+    def build_prompt(self, address: str, sms_body: str) -> str:
+        """Single-message extraction prompt."""
 #             prompt = f"""
 # Extract financial transaction information from this SMS:
 
@@ -203,8 +194,7 @@ class SMSToTransactionConverter:
 # Example: {{"bank": "HDFC", "amount": 36.00, "transaction_type": "debited", "merchant": "BMTC BUS KA57F2456"}}
 # """
 
-
-            prompt = f"""
+        return f"""
 Extract financial transaction information from this SMS:
 
 Address: {address}
@@ -212,112 +202,241 @@ Message: {sms_body}
 
 Return ONLY a JSON object with these fields:
 {{
-    "bank": "bank name (HDFC, AXIS, SBI, etc.)",
-    "amount": "numeric amount without currency symbols",
-    "transaction_type": "debited, credited, or other",
-    "merchant": "other party involved in the transaction (shop, business, service, or individual), or null if not a transaction"
+{EXTRACTION_FIELDS}
 }}
 
 Rules:
-- Extract bank from address patterns (AX-HDFCBK-S means HDFC, VM-HDFCBK-S means HDFC)
-- Amount should be just the number (36.00 not Rs.36.00)
-- "transaction_type" rules:
-    * "debited" ONLY if the message clearly confirms money was sent, paid, withdrawn, deducted, or spent from the account.
-    * "credited" ONLY if the message clearly confirms money was received, deposited, or added to the account.
-    * "other" if ANY of these are true:
-        - The message is promotional, informational, or about future/potential transactions.
-        - The message contains any of these keywords (case-insensitive): 
-          ["invest", "FD", "fixed deposit", "loan offer", "book now", "apply now", "mandate created", "mandate has been created", "towards", "scheduled", "will be", "authorization", "pre-approved", "OTP", "reminder"].
-        - The message does not explicitly confirm that money has already moved.
-- Merchant should only be extracted if the message is a confirmed debit or credit transaction. For non-transaction messages, set merchant to null.
-- Use null for missing data
+{EXTRACTION_RULES}
 - Return ONLY valid JSON, no other text
 
 Example: {{"bank": "HDFC", "amount": 36.00, "transaction_type": "debited", "merchant": "BMTC BUS KA57F2456"}}
 """
+    
+    def build_batch_prompt(self, items: List[Tuple[str, str]]) -> str:
+        """One prompt for several (address, body) pairs, numbered from 1."""
+        # One SMS per line keeps the prompt compact
+        messages = "[\n" + ",\n".join(
+            json.dumps({"id": i, "address": address, "message": sms_body}, ensure_ascii=False)
+            for i, (address, sms_body) in enumerate(items, 1)
+        ) + "\n]"
+        return f"""
+Extract financial transaction information from each SMS in this JSON array:
+
+{messages}
+
+Return ONLY a JSON array with exactly one object per SMS. Each object has the SMS "id" and these fields:
+{{
+    "id": "the id of the SMS",
+{EXTRACTION_FIELDS}
+}}
+
+Rules:
+{EXTRACTION_RULES}
+- Apply the rules to each SMS on its own
+- Return ONLY a valid JSON array, no other text
 
-            ai_response = self.llm_provider.generate_response(prompt)
+Example: [{{"id": 1, "bank": "HDFC", "amount": 36.00, "transaction_type": "debited", "merchant": "BMTC BUS KA57F2456"}}]
+"""
+    
+    def convert_sms_to_transaction(self, sms_body: str, address: str) -> Dict:
+        """Convert a single SMS to transaction data."""
+        try:
+            logger.info(f"Converting SMS from address: {address}")
+            logger.debug(f"SMS body: {sms_body[:100]}...")
+            
+            result, rules = self._resolve_locally(sms_body, address)
+            if result is not None:
+                return result
+            
+            # Otherwise, use AI to fill in missing parts
+            logger.info("Using AI to extract missing transaction data")
+            
+            self.ai_calls_made += 1
+            ai_response = self.llm_provider.generate_response(self.build_prompt(address, sms_body))
             
             if ai_response:
                 ai_result = self.parse_ai_response(ai_response)
+                if any(v is not None for v in ai_result.values()):
+                    learn_shape(address, sms_body, ai_result)
                 
-                # Combine rule-based and AI results, preferring rule-based
-                final_result = {
-                    'bank': bank or ai_result.get('bank'),
-                    'amount': amount or ai_result.get('amount'),
-                    'transaction_type': transaction_type or ai_result.get('transaction_type'),
-                    'merchant': merchant or ai_result.get('merchant')
-                }
-                
+                final_result = self._merge(rules, ai_result)
                 logger.info(f"Combined extraction result: {final_result}")
                 return final_result
             else:
                 logger.error("Failed to get response from LLM providers after retries")
                 # Fall back to rule-based extraction only
-                result = {
-                    'bank': bank,
-                    'amount': amount,
-                    'transaction_type': transaction_type,
-                    'merchant': merchant
-                }
-                logger.info(f"Using rule-based extraction only: {result}")
-                return result
+                logger.info(f"Using rule-based extraction only: {rules}")
+                return rules
                 
         except Exception as e:
             logger.error(f"Error converting SMS to transaction: {e}")
             # Fall back to rule-based extraction
-            return {
-                'bank': self.extract_bank_from_address(address),
-                'amount': self.extract_amount(sms_body),
-                'transaction_type': self.extract_transaction_type(sms_body),
-                'merchant': self.extract_merchant(sms_body)
-            }
+            return extraction.extract(address, sms_body)
+    
+    async def aextract_batch(self, items: List[Tuple[str, str]]) -> List[Optional[Dict]]:
+        """AI fields for each (address, body) pair from one LLM call.
+
+        A malformed answer is retried as two half-size batches (concurrently),
+        down to single messages. None marks messages the LLM gave no answer for.
+        """
+        if len(items) == 1:
+            address, sms_body = items[0]
+            self.ai_calls_made += 1
+            # _resolve_from_cache already counted this prompt's cache miss
+            ai_response = await self.llm_provider.agenerate_response(
+                self.build_prompt(address, sms_body), count_miss=False
+            )
+            return [self.parse_ai_response(ai_response) if ai_response else None]
+        
+        self.ai_calls_made += 1
+        ai_response = await self.llm_provider.agenerate_response(self.build_batch_prompt(items))
+        if not ai_response:
+            logger.error(f"Failed to get response from LLM providers for a batch of {len(items)}")
+            return [None] * len(items)
+        
+        results = self.parse_batch_response(ai_response, len(items))
+        if results is not None:
+            await asyncio.to_thread(self._cache_batch_results, items, results)
+            return results
+        
+        self.batch_splits += 1
+        middle = len(items) // 2
+        logger.warning(f"Malformed response for a batch of {len(items)}; retrying as {middle} + {len(items) - middle}")
+        first, second = await asyncio.gather(self.aextract_batch(items[:middle]), self.aextract_batch(items[middle:]))
+        return first + second
+    
+    def _cache_batch_results(self, items: List[Tuple[str, str]], results: List[Dict]) -> None:
+        """Cache each answer under its message's single-message prompt, whatever batch it came from."""
+        for (address, sms_body), result in zip(items, results):
+            self.llm_provider.cache_response(self.build_prompt(address, sms_body), json.dumps(result))
+    
+    def _resolve_from_cache(self, sms_body: str, address: str, rules: Dict) -> Optional[Dict]:
+        """Result from a cached LLM answer for this exact message, or None."""
+        ai_response = self.llm_provider.cached_response(self.build_prompt(address, sms_body))
+        if not ai_response:
+            return None
+        self.ai_calls_skipped += 1
+        return self._merge(rules, self.parse_ai_response(ai_response))
+    
+    async def _aconvert_batch(self, batch: List[Tuple[Dict, Dict]]) -> List[Tuple[Dict, Dict]]:
+        try:
+            ai_results = await self.aextract_batch([(message['address'], message['body']) for message, _ in batch])
+        except Exception as e:
+            logger.error(f"Error in batch extraction: {e}")
+            ai_results = [None] * len(batch)
+        
+        converted = []
+        for (message, rules), ai_result in zip(batch, ai_results):
+            if ai_result is None:
+                # Fall back to rule-based extraction only
+                converted.append((message, rules))
+                continue
+            if any(v is not None for v in ai_result.values()):
+                await asyncio.to_thread(learn_shape, message['address'], message['body'], ai_result)
+            converted.append((message, self._merge(rules, ai_result)))
+        return converted
+    
+    async def aconvert_messages(self, messages: List[Dict]) -> AsyncIterator[Tuple[Dict, Dict]]:
+        """(message, transaction data) for each message, in the order they finish.
+
+        Messages the rules, templates, learned shapes or the response
+        cache cover are yielded straight away. The rest are packed LLM_BATCH_SIZE per prompt and
+        each batch starts as soon as it is full; the provider runs up to
+        LLM_MAX_CONCURRENCY of them at once within its rate limits. A
+        message whose shape is already in flight waits for a later wave,
+        by which time the shape has usually been learned.
+        """
+        waiting = list(messages)
+        sent_shapes = set()
+        while waiting:
+            tasks, batch, wave_shapes, deferred = [], [], set(), []
+            try:
+                for message in waiting:
+                    try:
+                        result, rules = await asyncio.to_thread(self._resolve_locally, message['body'], message['address'])
+                        if result is None:
+                            result = await asyncio.to_thread(
+                                self._resolve_from_cache, message['body'], message['address'], rules
+                            )
+                    except Exception as e:
+                        logger.error(f"Error converting SMS to transaction: {e}")
+                        result = rules = extraction.extract(message['address'], message['body'])
+                    if result is not None:
+                        yield message, result
+                        continue
+                    shape = shape_of(message['address'], message['body'])[0] if SHAPE_CACHE_ENABLED else None
+                    if shape in wave_shapes and shape not in sent_shapes:
+                        deferred.append(message)
+                        continue
+                    if shape is not None:
+                        wave_shapes.add(shape)
+                    batch.append((message, rules))
+                    if len(batch) == LLM_BATCH_SIZE:
+                        tasks.append(asyncio.create_task(self._aconvert_batch(batch)))
+                        batch = []
+                if batch:
+                    tasks.append(asyncio.create_task(self._aconvert_batch(batch)))
+                
+                for finished in asyncio.as_completed(tasks):
+                    for converted in await finished:
+                        yield converted
+            finally:
+                for task in tasks:
+                    task.cancel()
+            sent_shapes |= wave_shapes
+            waiting = deferred
+    
+    def _clean_ai_result(self, result: Dict) -> Dict:
+        """Validate and clean one parsed AI result."""
+        cleaned_result = {}
+        
+        # Clean amount - convert to float if it's a string
+        if 'amount' in result:
+            amount = result['amount']
+            if isinstance(amount, str):
+                # Remove currency symbols and convert
+                amount_clean = re.sub(r'[^\d.]', '', amount)
+                try:
+                    cleaned_result['amount'] = float(amount_clean) if amount_clean else None
+                except ValueError:
+                    cleaned_result['amount'] = None
+            else:
+                cleaned_result['amount'] = amount
+        
+        # Clean other fields
+        for field in ['bank', 'transaction_type', 'merchant']:
+            if field in result:
+                value = result[field]
+                if value and value.lower() not in ['null', 'none', '']:
+                    cleaned_result[field] = str(value).strip()
+                else:
+                    cleaned_result[field] = None
+            else:
+                cleaned_result[field] = None
+        
+        return cleaned_result
+    
+    def _strip_code_fence(self, text: str) -> str:
+        # Clean the response text
+        text = text.strip()
+        
+        # Remove markdown code blocks if present
+        if text.startswith('```'):
+            text = re.sub(r'^```(?:json)?\s*', '', text)
+            text = re.sub(r'```\s*$', '', text)
+        return text
     
     def parse_ai_response(self, text: str) -> Dict:
         """Parse AI response to extract transaction data."""
         try:
-            # Clean the response text
-            text = text.strip()
-            
-            # Remove markdown code blocks if present
-            if text.startswith('```'):
-                text = re.sub(r'^```(?:json)?\s*', '', text)
-                text = re.sub(r'```\s*$', '', text)
+            text = self._strip_code_fence(text)
             
             # Try to find JSON in the text
             json_match = re.search(r'\{.*\}', text, re.DOTALL)
             if json_match:
                 json_str = json_match.group(0)
                 result = json.loads(json_str)
-                
-                # Validate and clean the result
-                cleaned_result = {}
-                
-                # Clean amount - convert to float if it's a string
-                if 'amount' in result:
-                    amount = result['amount']
-                    if isinstance(amount, str):
-                        # Remove currency symbols and convert
-                        amount_clean = re.sub(r'[^\d.]', '', amount)
-                        try:
-                            cleaned_result['amount'] = float(amount_clean) if amount_clean else None
-                        except ValueError:
-                            cleaned_result['amount'] = None
-                    else:
-                        cleaned_result['amount'] = amount
-                
-                # Clean other fields
-                for field in ['bank', 'transaction_type', 'merchant']:
-                    if field in result:
-                        value = result[field]
-                        if value and value.lower() not in ['null', 'none', '']:
-                            cleaned_result[field] = str(value).strip()
-                        else:
-                            cleaned_result[field] = None
-                    else:
-                        cleaned_result[field] = None
-                
-                return cleaned_result
+                return self._clean_ai_result(result)
             
         except json.JSONDecodeError as e:
             logger.error(f"JSON parsing error: {e}")
@@ -326,6 +445,31 @@ Example: {{"bank": "HDFC", "amount": 36.00, "transaction_type": "debited", "merc
         
         return self._get_empty_transaction()
     
+    def parse_batch_response(self, text: str, count: int) -> Optional[List[Dict]]:
+        """Results for ids 1..count in order, or None unless the answer has exactly one object per id."""
+        try:
+            text = self._strip_code_fence(text)
+            json_match = re.search(r'\[.*\]', text, re.DOTALL)
+            if not json_match:
+                return None
+            items = json.loads(json_match.group(0))
+            if not isinstance(items, list):
+                return None
+            by_id = {}
+            for item in items:
+                if not isinstance(item, dict):
+                    return None
+                item_id = int(item.get('id'))
+                if item_id in by_id:
+                    return None
+                by_id[item_id] = self._clean_ai_result(item)
+            if set(by_id) != set(range(1, count + 1)):
+                return None
+            return [by_id[item_id] for item_id in range(1, count + 1)]
+        except (json.JSONDecodeError, AttributeError, TypeError, ValueError) as e:
+            logger.warning(f"Malformed batch response: {e}")
+            return None
+    
     def _get_empty_transaction(self) -> Dict:
         """Return empty transaction data structure."""
         return {
@@ -336,17 +480,21 @@ Example: {{"bank": "HDFC", "amount": 36.00, "transaction_type": "debited", "merc
         }
 
 
-def get_unprocessed_messages() -> List[Dict]:
-    """Get all unprocessed SMS messages from the database."""
-    conn = get_db_connection()
+def get_unprocessed_messages(limit: Optional[int] = None) -> List[Dict]:
+    """Get unprocessed SMS messages that were classified as financial (or not classified yet), oldest first.
+
+    The WHERE clause matches idx_sms_messages_convert_queue, a partial index
+    holding only this queue.
+    """
     try:
-        with conn.cursor() as cur:
-            cur.execute("""
+        with connection() as conn, conn.cursor() as cur:
+            cur.execute(f"""
                 SELECT user_name, sms_id, address, body, date_received, created_at
                 FROM sms_messages
-                WHERE is_processed = FALSE
+                WHERE is_processed = FALSE AND {CONVERT_CATEGORY_SQL}
                 ORDER BY created_at ASC
-            """)
+                {"LIMIT %s" if limit else ""}
+            """, (limit,) if limit else None)
             rows = cur.fetchall()
             
             messages = []
@@ -365,77 +513,145 @@ def get_unprocessed_messages() -> List[Dict]:
     except Exception as e:
         logger.error(f"Error fetching unprocessed messages: {e}")
         raise
-    finally:
-        conn.close()
 
 
 def save_transaction(user_name: str, sms_id: int, address: str, transaction_data: Dict, date_received: int, created_at) -> bool:
-    """Save transaction data to the database."""
-    conn = get_db_connection()
+    """Save transaction data to the database and add it to the daily_spend rollup."""
     try:
-        with conn.cursor() as cur:
-            cur.execute("""
-                INSERT INTO transactions (user_name, sms_id, address, bank, amount, transaction_type, merchant, date_received, created_at)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-                ON CONFLICT (sms_id, user_name) DO NOTHING
-            """, (
-                user_name,
-                sms_id,
-                address,
-                transaction_data.get('bank'),
-                transaction_data.get('amount'),
-                transaction_data.get('transaction_type'),
-                transaction_data.get('merchant'),
-                date_received,
-                created_at
-            ))
+        with connection() as conn:
+            with conn.cursor() as cur:
+                execute_prepared(cur, INSERT_TRANSACTION, (
+                    user_name,
+                    sms_id,
+                    address,
+                    transaction_data.get('bank'),
+                    transaction_data.get('amount'),
+                    transaction_data.get('transaction_type'),
+                    transaction_data.get('merchant'),
+                    date_received,
+                    created_at
+                ))
             
-            inserted = cur.rowcount > 0
-        conn.commit()
-        return inserted
+                inserted = cur.rowcount > 0
+                if inserted and date_received is not None:
+                    execute_prepared(cur, rollup.ADD_TRANSACTION,
+                                     rollup.add_transaction_params(user_name, date_received, transaction_data))
+            conn.commit()
+            return inserted
     except Exception as e:
         logger.error(f"Error saving transaction: {e}")
-        conn.rollback()
         return False
-    finally:
-        conn.close()
 
 
-def mark_message_as_processed(sms_id: int, user_name: str) -> bool:
-    """Mark an SMS message as processed."""
-    conn = get_db_connection()
+def mark_message_as_processed(sms_id: int, user_name: str, date_received: int) -> bool:
+    """Mark an SMS message as processed.
+
+    date_received is the partition key, so including it lets Postgres touch
+    a single monthly partition instead of probing all of them. Undated
+    messages are all in the default partition.
+    """
     try:
-        with conn.cursor() as cur:
-            cur.execute("""
-                UPDATE sms_messages
-                SET is_processed = TRUE
-                WHERE sms_id = %s AND user_name = %s
-            """, (sms_id, user_name))
+        with connection() as conn:
+            with conn.cursor() as cur:
+                if date_received is None:
+                    execute_prepared(cur, MARK_UNDATED_PROCESSED, (sms_id, user_name))
+                else:
+                    execute_prepared(cur, MARK_PROCESSED, (sms_id, user_name, date_received))
             
-            updated = cur.rowcount > 0
-        conn.commit()
-        return updated
+                updated = cur.rowcount > 0
+            conn.commit()
+            return updated
     except Exception as e:
         logger.error(f"Error marking message as processed: {e}")
-        conn.rollback()
         return False
-    finally:
-        conn.close()
 
 
-def convert_all_messages() -> Dict:
-    """Convert all unprocessed SMS messages to transactions."""
+def convert_all_messages(limit: Optional[int] = None) -> Dict:
+    """Convert unprocessed SMS messages to transactions (at most `limit`, oldest first).
+
+    Only one conversion runs at a time across processes (the /convert
+    endpoint and converter_worker.py): a second caller returns straight
+    away instead of converting, and paying the LLM for, the same messages.
+    """
+    with connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_try_advisory_lock(%s);", (CONVERT_LOCK_ID,))
+            locked = cur.fetchone()[0]
+        conn.commit()
+        if not locked:
+            logger.info("Another conversion is already running; skipping")
+            return {
+                "status": "success",
+                "message": "Conversion already running",
+                "processed_count": 0,
+                "failed_count": 0,
+                "marked_count": 0,
+                "total_messages": 0
+            }
+        try:
+            return _run_on_round_loop(_convert_messages(limit))
+        finally:
+            with conn.cursor() as cur:
+                cur.execute("SELECT pg_advisory_unlock(%s);", (CONVERT_LOCK_ID,))
+            conn.commit()
+
+
+def _run_on_round_loop(coroutine):
+    """Run `coroutine` on the shared round loop and wait for its result."""
+    global _round_loop
+    with _round_loop_lock:
+        if _round_loop is None:
+            _round_loop = asyncio.new_event_loop()
+            threading.Thread(target=_round_loop.run_forever, name="convert-round-loop", daemon=True).start()
+        loop = _round_loop
+    return asyncio.run_coroutine_threadsafe(coroutine, loop).result()
+
+
+def _save_converted(message: Dict, transaction_data: Dict, position: str) -> Tuple[bool, bool]:
+    """Save one converted message and mark it processed.
+
+    Returns (saved, marked): whether a transaction was stored and whether
+    the message left the queue. A message with no extracted data is marked
+    processed without a transaction, so it is (False, True).
+    """
+    # Check if conversion was successful (at least some data extracted)
+    if any(v is not None for v in transaction_data.values()):
+        # Save transaction with date_received
+        if save_transaction(
+            message['user_name'],
+            message['sms_id'],
+            message['address'],
+            transaction_data,
+            message['date_received'],
+            message['created_at']
+        ):
+            # Mark as processed
+            if mark_message_as_processed(message['sms_id'], message['user_name'], message['date_received']):
+                logger.info(f"Successfully processed message {message['sms_id']} ({position})")
+                return True, True
+            logger.error(f"Failed to mark message {message['sms_id']} as processed")
+            return True, False
+        logger.error(f"Failed to save transaction for message {message['sms_id']}")
+        return False, False
+    logger.warning(f"No data extracted from message {message['sms_id']}, marking as processed anyway")
+    return False, mark_message_as_processed(message['sms_id'], message['user_name'], message['date_received'])
+
+
+async def _convert_messages(limit: Optional[int]) -> Dict:
+    """One conversion round as an asyncio pipeline.
+
+    The local pass, the concurrent LLM batches and the saves overlap:
+    each message is saved (in a worker thread, on the psycopg2 pool) as
+    soon as its result is ready, while other batches are still in flight.
+    """
     logger.info("Starting SMS to transaction conversion process")
     
     try:
-        # Ensure all required tables exist
-        setup_database()
-        
         # Initialize converter
         converter = SMSToTransactionConverter()
         
         # Get unprocessed messages
-        messages = get_unprocessed_messages()
+        messages = await asyncio.to_thread(get_unprocessed_messages, limit)
         
         if not messages:
             logger.info("No unprocessed messages found")
@@ -443,64 +659,51 @@ def convert_all_messages() -> Dict:
                 "status": "success",
                 "message": "No unprocessed messages found",
                 "processed_count": 0,
-                "failed_count": 0
+                "failed_count": 0,
+                "marked_count": 0,
+                "total_messages": 0
             }
         
         processed_count = 0
         failed_count = 0
-        ai_calls_made = 0
-        ai_calls_skipped = 0
-        
+        # Messages that left the queue, with or without a transaction
+        marked_count = 0
+
         logger.info(f"Starting to process {len(messages)} messages with rate limiting...")
         
-        for i, message in enumerate(messages, 1):
+        # Converted locally or in LLM batches; not necessarily in queue order
+        i = 0
+        async for message, transaction_data in converter.aconvert_messages(messages):
+            i += 1
             try:
                 logger.info(f"Processing message {i}/{len(messages)} (ID: {message['sms_id']}) for user {message['user_name']}")
-                
-                # Convert SMS to transaction
-                transaction_data = converter.convert_sms_to_transaction(
-                    message['body'],
-                    message['address']
+                saved, marked = await asyncio.to_thread(
+                    _save_converted, message, transaction_data, f"{i}/{len(messages)}"
                 )
-                
-                # Check if conversion was successful (at least some data extracted)
-                if any(v is not None for v in transaction_data.values()):
-                    # Save transaction with date_received
-                    if save_transaction(
-                        message['user_name'],
-                        message['sms_id'],
-                        message['address'],
-                        transaction_data,
-                        message['date_received'],
-                        message['created_at']
-                    ):
-                        # Mark as processed
-                        if mark_message_as_processed(message['sms_id'], message['user_name']):
-                            processed_count += 1
-                            logger.info(f"Successfully processed message {message['sms_id']} ({i}/{len(messages)})")
-                        else:
-                            logger.error(f"Failed to mark message {message['sms_id']} as processed")
-                            failed_count += 1
-                    else:
-                        logger.error(f"Failed to save transaction for message {message['sms_id']}")
-                        failed_count += 1
+                if saved and marked:
+                    processed_count += 1
                 else:
-                    logger.warning(f"No data extracted from message {message['sms_id']}, marking as processed anyway")
-                    mark_message_as_processed(message['sms_id'], message['user_name'])
                     failed_count += 1
+                if marked:
+                    marked_count += 1
                     
             except Exception as e:
                 logger.error(f"Error processing message {message['sms_id']}: {e}")
                 failed_count += 1
         
+        await asyncio.to_thread(flush_shape_hits)
+        
         result = {
             "status": "success",
             "message": f"Conversion completed. Processed: {processed_count}, Failed: {failed_count}",
             "processed_count": processed_count,
             "failed_count": failed_count,
+            "marked_count": marked_count,
             "total_messages": len(messages),
-            "ai_calls_made": ai_calls_made,
-            "ai_calls_skipped": ai_calls_skipped
+            "ai_calls_made": converter.ai_calls_made,
+            "ai_calls_skipped": converter.ai_calls_skipped,
+            "shape_hits": converter.shape_hits,
+            "batch_splits": converter.batch_splits
         }
         
         logger.info(f"Conversion process completed: {result}")
@@ -512,7 +715,8 @@ def convert_all_messages() -> Dict:
             "status": "error",
             "message": f"Conversion process failed: {str(e)}",
             "processed_count": 0,
-            "failed_count": 0
+            "failed_count": 0,
+            "marked_count": 0
         }
 
 
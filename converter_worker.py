@@ -0,0 +1,152 @@
+"""Long-running converter: turns newly synced SMS into transactions within seconds.
+
+    python converter_worker.py
+
+/sync sends NOTIFY on `ingest.SYNC_NOTIFY_CHANNEL` whenever it stores new
+messages. The worker LISTENs on a dedicated connection and, rather than
+converting once per notification, debounces them. A round starts once the
+channel has been quiet for CONVERT_DEBOUNCE_SECONDS (default 2), or
+CONVERT_MAX_DELAY_SECONDS (default 10) after the first pending
+notification, whichever comes first. So a burst of syncs from many phones
+becomes one round.
+
+A round converts the queue in batches of CONVERT_BATCH_SIZE messages
+(default 500) until it is empty. The worker also runs a round at startup
+and every CONVERT_POLL_SECONDS (default 300) without notifications, which
+covers syncs that happened while it was down. Running several workers, or
+the /convert endpoint alongside, is safe: conversion rounds take an
+advisory lock (see convert.convert_all_messages).
+"""
+import os
+import select
+import signal
+import time
+from typing import Optional, Set
+import psycopg2
+from psycopg2 import extensions
+from convert import convert_all_messages
+from db import get_db_connection, setup_database
+from ingest import SYNC_NOTIFY_CHANNEL
+from logging_config import get_logger, setup_logging
+
+logger = get_logger("sms_sync.converter_worker")
+
+CONVERT_DEBOUNCE_SECONDS = float(os.getenv("CONVERT_DEBOUNCE_SECONDS", "2"))
+CONVERT_MAX_DELAY_SECONDS = float(os.getenv("CONVERT_MAX_DELAY_SECONDS", "10"))
+CONVERT_BATCH_SIZE = int(os.getenv("CONVERT_BATCH_SIZE", "500"))
+CONVERT_POLL_SECONDS = float(os.getenv("CONVERT_POLL_SECONDS", "300"))
+# Wait between reconnect attempts when the LISTEN connection drops
+RECONNECT_DELAY_SECONDS = 5
+
+
+class ConverterWorker:
+    """LISTEN loop with debounced, batched conversion rounds."""
+
+    def __init__(self):
+        self.running = True
+        self.rounds = 0
+        self._conn = None
+
+    def stop(self, *_) -> None:
+        self.running = False
+
+    def _listen(self) -> None:
+        self._conn = get_db_connection()
+        self._conn.set_isolation_level(extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        with self._conn.cursor() as cur:
+            cur.execute(f"LISTEN {SYNC_NOTIFY_CHANNEL};")
+        logger.info(f"Listening on {SYNC_NOTIFY_CHANNEL}")
+
+    def _close(self) -> None:
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except Exception:
+                pass
+            self._conn = None
+
+    def _drain_notifications(self) -> Set[str]:
+        self._conn.poll()
+        users = {notify.payload for notify in self._conn.notifies}
+        self._conn.notifies.clear()
+        return users
+
+    def convert_round(self, reason: str) -> None:
+        """Convert the queue in CONVERT_BATCH_SIZE batches until it is empty."""
+        start = time.monotonic()
+        processed = failed = 0
+        while self.running:
+            result = convert_all_messages(limit=CONVERT_BATCH_SIZE)
+            if result["status"] != "success":
+                logger.error(f"Conversion round failed: {result['message']}")
+                break
+            processed += result["processed_count"]
+            failed += result["failed_count"]
+            # A short batch means the queue is drained. A batch that marked
+            # nothing processed would be fetched again as is, so its messages
+            # are retried next round. Messages with no extracted data count as
+            # failed but still leave the queue, so they do not stop the round.
+            if result.get("total_messages", 0) < CONVERT_BATCH_SIZE or result.get("marked_count", 0) == 0:
+                break
+        self.rounds += 1
+        logger.info(
+            f"Conversion round {self.rounds} ({reason}): {processed} processed, {failed} failed "
+            f"in {time.monotonic() - start:.1f}s"
+        )
+
+    def _wait_seconds(self, first_pending: Optional[float], last_event: float, last_round: float) -> float:
+        now = time.monotonic()
+        if first_pending is None:
+            return max(0.0, last_round + CONVERT_POLL_SECONDS - now)
+        deadline = min(last_event + CONVERT_DEBOUNCE_SECONDS, first_pending + CONVERT_MAX_DELAY_SECONDS)
+        return max(0.0, deadline - now)
+
+    def _serve(self) -> None:
+        self._listen()
+        self.convert_round("startup")
+        first_pending = None
+        last_event = last_round = time.monotonic()
+        pending_users: Set[str] = set()
+        while self.running:
+            # Wake at least once a second so stop() takes effect promptly
+            timeout = min(self._wait_seconds(first_pending, last_event, last_round), 1.0)
+            ready, _, _ = select.select([self._conn], [], [], timeout)
+            now = time.monotonic()
+            if ready:
+                users = self._drain_notifications()
+                if users:
+                    pending_users |= users
+                    last_event = now
+                    if first_pending is None:
+                        first_pending = now
+            if first_pending is not None:
+                if now - last_event >= CONVERT_DEBOUNCE_SECONDS or now - first_pending >= CONVERT_MAX_DELAY_SECONDS:
+                    logger.info(f"Syncs from {len(pending_users)} user(s) pending: {', '.join(sorted(pending_users))}")
+                    self.convert_round("notify")
+                    first_pending = None
+                    pending_users.clear()
+                    last_round = time.monotonic()
+            elif now - last_round >= CONVERT_POLL_SECONDS:
+                self.convert_round("poll")
+                last_round = time.monotonic()
+
+    def run(self) -> None:
+        """Serve until stop(); reconnects (and catches up) if the database goes away."""
+        while self.running:
+            try:
+                self._serve()
+            except (psycopg2.OperationalError, psycopg2.InterfaceError, RuntimeError) as e:
+                logger.error(f"Converter worker lost its database connection: {e}; retrying in {RECONNECT_DELAY_SECONDS}s")
+                time.sleep(RECONNECT_DELAY_SECONDS)
+            finally:
+                self._close()
+        logger.info("Converter worker stopped")
+
+
+if __name__ == "__main__":
+    setup_logging()
+    setup_database()
+    worker = ConverterWorker()
+    signal.signal(signal.SIGTERM, worker.stop)
+    signal.signal(signal.SIGINT, worker.stop)
+    worker.run()
@@ -1,119 +1,498 @@
+import asyncio
 import os
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+from typing import AsyncIterator, Dict, Iterator, Optional
+import psycopg
 import psycopg2
+from psycopg2 import extensions
+from psycopg_pool import AsyncConnectionPool
 from dotenv import load_dotenv
 from logging_config import get_logger
+from statements import PREPARED_STATEMENTS_ENABLED
 
 # Load environment variables from .env file
 load_dotenv()
 logger = get_logger("sms_sync.db")
 
-def get_db_connection():
-    """Establish a connection to the PostgreSQL database using DB_URL env var."""
+# Timezone for displaying timestamps and bucketing them into calendar days
+APP_TIMEZONE = os.getenv("APP_TIMEZONE", "UTC")
+# SQL rendering the generated received_at column as display text; pass APP_TIMEZONE for its %s
+LOCAL_TIME_SQL = "to_char(received_at AT TIME ZONE %s, 'YYYY-MM-DD HH24:MI:SS')"
+
+
+class PoolTimeoutError(RuntimeError):
+    """Raised when no pooled connection becomes available within the timeout."""
+
+
+def _get_db_url() -> str:
     db_url = os.getenv("DB_URL")
     if not db_url:
         raise ValueError("DB_URL environment variable not set.")
+    return db_url
+
+
+def get_db_connection():
+    """Open a dedicated (unpooled) connection using the DB_URL env var.
+
+    Request handlers should use `connection()` instead; this is meant for
+    long-lived sessions such as maintenance scripts.
+    """
+    db_url = _get_db_url()
     try:
         return psycopg2.connect(db_url)
     except Exception as e:
         raise RuntimeError(f"Database connection failed: {e}")
 
 
-def setup_database():
-    """Ensure all required tables exist."""
-    conn = get_db_connection()
+class ConnectionPool:
+    """Thread-safe psycopg2 connection pool with blocking checkout.
+
+    `min_size` connections are opened up front and the pool grows on demand
+    up to `max_size`; idle connections are kept for reuse. Callers wait up to
+    `timeout` seconds for a free slot. Connections idle for longer than
+    `health_check_idle` seconds are pinged on checkout and replaced if dead.
+    `connect_timeout` (whole seconds, libpq's minimum is 2) bounds each new
+    connection; None waits as long as the network does.
+    """
+
+    def __init__(self, dsn: str, min_size: int, max_size: int, timeout: float, health_check_idle: float,
+                 connect_timeout: Optional[int] = None):
+        self.dsn = dsn
+        self.connect_timeout = connect_timeout
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.health_check_idle = health_check_idle
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._lock = threading.Lock()
+        self._idle: deque = deque()
+        self._size = 0
+        self._in_use = 0
+        self._waiting = 0
+        self._checkouts = 0
+        self._timeouts = 0
+        self._health_check_failures = 0
+        self._wait_time_total = 0.0
+        self._wait_time_max = 0.0
+        for _ in range(min_size):
+            self._idle.append((self._connect(), time.monotonic()))
+
+    def _connect(self):
+        if self.connect_timeout is None:
+            conn = psycopg2.connect(self.dsn)
+        else:
+            conn = psycopg2.connect(self.dsn, connect_timeout=self.connect_timeout)
+        with self._lock:
+            self._size += 1
+        return conn
+
+    def _close(self, conn) -> None:
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self._lock:
+            self._size -= 1
+
+    def getconn(self):
+        """Check out a healthy connection, waiting for a free slot if needed."""
+        start = time.monotonic()
+        with self._lock:
+            self._waiting += 1
+        acquired = self._slots.acquire(timeout=self.timeout)
+        waited = time.monotonic() - start
+        with self._lock:
+            self._waiting -= 1
+            self._wait_time_total += waited
+            self._wait_time_max = max(self._wait_time_max, waited)
+            if not acquired:
+                self._timeouts += 1
+        if not acquired:
+            raise PoolTimeoutError(f"No database connection available after {self.timeout:.1f}s")
+
+        try:
+            conn = self._checkout_healthy()
+        except Exception:
+            self._slots.release()
+            raise
+
+        with self._lock:
+            self._in_use += 1
+            self._checkouts += 1
+        return conn
+
+    def _checkout_healthy(self):
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                conn, last_used = self._idle.pop()
+            if not conn.closed and time.monotonic() - last_used < self.health_check_idle:
+                return conn
+            try:
+                if conn.closed:
+                    raise psycopg2.InterfaceError("connection already closed")
+                with conn.cursor() as cur:
+                    cur.execute("SELECT 1;")
+                conn.rollback()
+                return conn
+            except Exception as e:
+                logger.warning(f"Discarding unhealthy pooled connection: {e}")
+                with self._lock:
+                    self._health_check_failures += 1
+                self._close(conn)
+        return self._connect()
+
+    def putconn(self, conn) -> None:
+        """Return a connection, rolling back any transaction left open."""
+        try:
+            if conn.closed:
+                self._close(conn)
+                return
+            if conn.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+            with self._lock:
+                self._idle.append((conn, time.monotonic()))
+        except Exception as e:
+            logger.warning(f"Closing connection that could not be reset: {e}")
+            self._close(conn)
+        finally:
+            with self._lock:
+                self._in_use -= 1
+            self._slots.release()
+
+    def close(self) -> None:
+        with self._lock:
+            idle, self._idle = list(self._idle), deque()
+        for conn, _ in idle:
+            self._close(conn)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            checkouts = self._checkouts
+            return {
+                "min_size": self.min_size,
+                "max_size": self.max_size,
+                "size": self._size,
+                "in_use": self._in_use,
+                "idle": len(self._idle),
+                "waiting": self._waiting,
+                "checkouts": checkouts,
+                "timeouts": self._timeouts,
+                "health_check_failures": self._health_check_failures,
+                "wait_time_total_ms": round(self._wait_time_total * 1000, 2),
+                "wait_time_avg_ms": round(self._wait_time_total * 1000 / checkouts, 3) if checkouts else 0.0,
+                "wait_time_max_ms": round(self._wait_time_max * 1000, 2),
+            }
+
+
+class ReplicaStatus:
+    """Tracks whether the read replica may serve read-only queries.
+
+    Replication lag is measured on a replica connection at most every
+    `check_interval` seconds. Reads fall back to the primary while the lag
+    exceeds `max_lag` seconds or the replica is unreachable.
+    """
+
+    LAG_SQL = """
+        SELECT CASE
+            WHEN NOT pg_is_in_recovery() THEN 0
+            WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+            ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+        END;
+    """
+    # Seconds to wait for a replica connection before declaring it unavailable
+    CHECK_TIMEOUT = 5.0
+
+    def __init__(self, max_lag: float, check_interval: float):
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._checked_at = float("-inf")
+        self._lag: Optional[float] = None
+        self._available = True
+        self._last_error: Optional[str] = None
+        self._replica_reads = 0
+        self._primary_fallbacks = 0
+
+    def needs_check(self) -> bool:
+        return time.monotonic() - self._checked_at >= self.check_interval
+
+    def usable(self) -> bool:
+        return self._available and (self._lag is None or self._lag <= self.max_lag)
+
+    def record_lag(self, lag: float) -> None:
+        with self._lock:
+            self._checked_at = time.monotonic()
+            self._lag = lag
+            self._available = True
+            self._last_error = None
+        if lag > self.max_lag:
+            logger.warning(f"Read replica lag {lag:.1f}s exceeds {self.max_lag:.1f}s; reading from primary")
+
+    def record_failure(self, error: Exception) -> None:
+        with self._lock:
+            self._checked_at = time.monotonic()
+            self._available = False
+            self._last_error = str(error)
+        logger.warning(f"Read replica unavailable, reading from primary: {error}")
+
+    def count(self, replica: bool) -> None:
+        with self._lock:
+            if replica:
+                self._replica_reads += 1
+            else:
+                self._primary_fallbacks += 1
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "available": self._available,
+                "lag_seconds": self._lag,
+                "max_lag_seconds": self.max_lag,
+                "replica_reads": self._replica_reads,
+                "primary_fallbacks": self._primary_fallbacks,
+                "last_error": self._last_error,
+            }
+
+
+def _get_read_url() -> Optional[str]:
+    return os.getenv("DB_READ_URL") or None
+
+
+_replica = ReplicaStatus(
+    max_lag=float(os.getenv("DB_READ_MAX_LAG_SECONDS", "10")),
+    check_interval=float(os.getenv("DB_READ_LAG_CHECK_INTERVAL", "5")),
+)
+
+_pool: Optional[ConnectionPool] = None
+_read_pool: Optional[ConnectionPool] = None
+_pool_lock = threading.Lock()
+
+
+def _new_pool(dsn: str, connect_timeout: Optional[int] = None) -> ConnectionPool:
+    return ConnectionPool(
+        dsn,
+        min_size=int(os.getenv("DB_POOL_MIN_SIZE", "1")),
+        max_size=int(os.getenv("DB_POOL_MAX_SIZE", "10")),
+        timeout=float(os.getenv("DB_POOL_TIMEOUT", "30")),
+        health_check_idle=float(os.getenv("DB_POOL_HEALTH_CHECK_IDLE", "30")),
+        connect_timeout=connect_timeout,
+    )
+
+
+def init_pool() -> ConnectionPool:
+    """Create the shared connection pool (idempotent).
+
+    Sizing comes from DB_POOL_MIN_SIZE / DB_POOL_MAX_SIZE, checkout wait from
+    DB_POOL_TIMEOUT and the idle threshold for health checks from
+    DB_POOL_HEALTH_CHECK_IDLE (all in seconds where applicable).
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = _new_pool(_get_db_url())
+            logger.info(f"Database pool initialized (min={_pool.min_size}, max={_pool.max_size})")
+        return _pool
+
+
+def _init_read_pool() -> ConnectionPool:
+    global _read_pool
+    with _pool_lock:
+        if _read_pool is None:
+            # An unreachable replica must fail fast: readers fall back to the primary
+            _read_pool = _new_pool(_get_read_url(), connect_timeout=max(2, int(ReplicaStatus.CHECK_TIMEOUT)))
+            logger.info(f"Read replica pool initialized (min={_read_pool.min_size}, max={_read_pool.max_size})")
+        return _read_pool
+
+
+def close_pool() -> None:
+    """Close every connection held by the shared pools."""
+    global _pool, _read_pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
+            logger.info("Database pool closed")
+        if _read_pool is not None:
+            _read_pool.close()
+            _read_pool = None
+
+
+def _checkout_replica():
+    """Return (pool, connection) on the read replica, or None to use the primary."""
+    if not _get_read_url():
+        return None
+    if not _replica.needs_check() and not _replica.usable():
+        return None
     try:
-        with conn.cursor() as cur:
-            # Users table for authentication
-            cur.execute(
-                """
-                CREATE TABLE IF NOT EXISTS users (
-                    id SERIAL PRIMARY KEY,
-                    username VARCHAR(255) UNIQUE NOT NULL,
-                    password_hash VARCHAR(255) NOT NULL,
-                    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
-                );
-                """
-            )
-           
-            # SMS messages table
-            cur.execute(
-                """
-                CREATE TABLE IF NOT EXISTS sms_messages (
-                    id SERIAL PRIMARY KEY,
-                    user_name VARCHAR(255) NOT NULL,
-                    sms_id BIGINT NOT NULL,
-                    address VARCHAR(255),
-                    body TEXT,
-                    date_received BIGINT,
-                    message_type INTEGER,
-                    is_processed BOOLEAN DEFAULT FALSE,
-                    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
-                    UNIQUE (sms_id, user_name)
-                );
-                """
-            )
-           
-            # Transactions table (UPDATED with date_received)
-            cur.execute(
-                """
-                CREATE TABLE IF NOT EXISTS transactions (
-                    id SERIAL PRIMARY KEY,
-                    user_name VARCHAR(255) NOT NULL,
-                    sms_id BIGINT NOT NULL,
-                    address VARCHAR(255),
-                    bank VARCHAR(100),
-                    amount DECIMAL(15,2),
-                    transaction_type VARCHAR(20),
-                    merchant VARCHAR(255),
-                    date_received BIGINT,
-                    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
-                    UNIQUE (sms_id, user_name)
-                );
-                """
-            )
-           
-            # Helpful indexes for user-scoped queries
-            cur.execute(
-                """
-                CREATE INDEX IF NOT EXISTS idx_sms_messages_user_created
-                ON sms_messages (user_name, created_at DESC);
-                """
-            )
-           
-            cur.execute(
-                """
-                CREATE INDEX IF NOT EXISTS idx_sms_messages_processed
-                ON sms_messages (is_processed, created_at ASC);
-                """
-            )
-           
-            cur.execute(
-                """
-                CREATE INDEX IF NOT EXISTS idx_transactions_user_created
-                ON transactions (user_name, created_at DESC);
-                """
-            )
-           
-            cur.execute(
-                """
-                CREATE INDEX IF NOT EXISTS idx_transactions_type_amount
-                ON transactions (transaction_type, amount);
-                """
-            )
-
-            # NEW: Index on date_received for better query performance
-            cur.execute(
-                """
-                CREATE INDEX IF NOT EXISTS idx_transactions_date_received
-                ON transactions (user_name, date_received DESC);
-                """
-            )
-           
-        conn.commit()
-        logger.info("Database setup completed successfully - all tables created")
+        pool = _read_pool or _init_read_pool()
+        conn = pool.getconn()
     except Exception as e:
-        logger.error(f"Database setup failed: {e}")
-        raise
+        _replica.record_failure(e)
+        return None
+    if _replica.needs_check():
+        try:
+            with conn.cursor() as cur:
+                cur.execute(ReplicaStatus.LAG_SQL)
+                lag = float(cur.fetchone()[0])
+            conn.rollback()
+            _replica.record_lag(lag)
+        except Exception as e:
+            pool.putconn(conn)
+            _replica.record_failure(e)
+            return None
+    if not _replica.usable():
+        pool.putconn(conn)
+        return None
+    return pool, conn
+
+
+@contextmanager
+def connection(readonly: bool = False) -> Iterator["extensions.connection"]:
+    """Borrow a pooled connection for the duration of a `with` block.
+
+    With `readonly=True` the connection comes from the DB_READ_URL replica
+    when one is configured, reachable and within DB_READ_MAX_LAG_SECONDS;
+    otherwise from the primary.
+    Commit explicitly; anything left uncommitted is rolled back when the
+    connection goes back to the pool.
+    """
+    replica = _checkout_replica() if readonly else None
+    if replica:
+        pool, conn = replica
+    else:
+        pool = _pool or init_pool()
+        conn = pool.getconn()
+    if readonly and _get_read_url():
+        _replica.count(replica is not None)
+    try:
+        yield conn
     finally:
-        conn.close()
+        pool.putconn(conn)
+
+
+_async_pool: Optional[AsyncConnectionPool] = None
+_async_read_pool: Optional[AsyncConnectionPool] = None
+_async_pool_lock = asyncio.Lock()
+
+
+async def _open_async_pool(dsn: str, name: str) -> AsyncConnectionPool:
+    pool = AsyncConnectionPool(
+        dsn,
+        min_size=int(os.getenv("DB_POOL_MIN_SIZE", "1")),
+        max_size=int(os.getenv("DB_POOL_MAX_SIZE", "10")),
+        timeout=float(os.getenv("DB_POOL_TIMEOUT", "30")),
+        check=AsyncConnectionPool.check_connection,
+        # prepare_threshold=None turns off psycopg's automatic server-side prepares
+        kwargs=None if PREPARED_STATEMENTS_ENABLED else {"prepare_threshold": None},
+        name=name,
+        open=False,
+    )
+    await pool.open()
+    return pool
+
+
+async def init_async_pool() -> AsyncConnectionPool:
+    """Create and open the shared async (psycopg 3) pool (idempotent).
+
+    Used by the `async def` routes so they wait on the database instead of
+    holding a threadpool thread. Sized by the same DB_POOL_* variables as
+    the sync pool; every checkout is health-checked.
+    """
+    global _async_pool
+    async with _async_pool_lock:
+        if _async_pool is None:
+            _async_pool = await _open_async_pool(_get_db_url(), "async")
+            logger.info(f"Async database pool initialized (min={_async_pool.min_size}, max={_async_pool.max_size})")
+        return _async_pool
 
+
+async def _init_async_read_pool() -> AsyncConnectionPool:
+    global _async_read_pool
+    async with _async_pool_lock:
+        if _async_read_pool is None:
+            _async_read_pool = await _open_async_pool(_get_read_url(), "async-read")
+            logger.info("Async read replica pool initialized")
+        return _async_read_pool
+
+
+async def close_async_pool() -> None:
+    """Close the shared async pools."""
+    global _async_pool, _async_read_pool
+    async with _async_pool_lock:
+        if _async_pool is not None:
+            await _async_pool.close()
+            _async_pool = None
+            logger.info("Async database pool closed")
+        if _async_read_pool is not None:
+            await _async_read_pool.close()
+            _async_read_pool = None
+
+
+async def _async_replica_usable(pool: AsyncConnectionPool) -> bool:
+    if not _replica.needs_check():
+        return _replica.usable()
+    try:
+        async with pool.connection(timeout=ReplicaStatus.CHECK_TIMEOUT) as conn:
+            cur = await conn.execute(ReplicaStatus.LAG_SQL)
+            lag = float((await cur.fetchone())[0])
+        _replica.record_lag(lag)
+    except Exception as e:
+        _replica.record_failure(e)
+    return _replica.usable()
+
+
+@asynccontextmanager
+async def async_connection(readonly: bool = False) -> AsyncIterator[psycopg.AsyncConnection]:
+    """Borrow a pooled async connection for the duration of an `async with` block.
+
+    `readonly=True` routes to the read replica under the same rules as
+    `connection()`.
+    Commit explicitly; anything left uncommitted is rolled back on error.
+    """
+    pool = None
+    if readonly and _get_read_url() and (_replica.needs_check() or _replica.usable()):
+        try:
+            read_pool = _async_read_pool or await _init_async_read_pool()
+            if await _async_replica_usable(read_pool):
+                pool = read_pool
+        except Exception as e:
+            _replica.record_failure(e)
+    if readonly and _get_read_url():
+        _replica.count(pool is not None)
+    if pool is None:
+        pool = _async_pool or await init_async_pool()
+    async with pool.connection() as conn:
+        yield conn
+
+
+def get_pool_stats() -> Dict:
+    """Return usage counters for the shared pools (empty if not started)."""
+    if _pool is None:
+        stats = {"initialized": False}
+    else:
+        stats = {"initialized": True, **_pool.stats()}
+    if _async_pool is not None:
+        stats["async"] = _async_pool.get_stats()
+    if _get_read_url():
+        stats["replica"] = _replica.stats()
+        if _read_pool is not None:
+            stats["replica"]["pool"] = _read_pool.stats()
+        if _async_read_pool is not None:
+            stats["replica"]["async_pool"] = _async_read_pool.get_stats()
+    return stats
+
+
+def setup_database() -> int:
+    """Apply pending schema migrations; returns the resulting schema version."""
+    from migrations import migrate  # local import to avoid circular
+
+    try:
+        return migrate()
+    except Exception as e:
+        logger.error(f"Database setup failed: {e}")
+        raise
@@ -0,0 +1,232 @@
+"""Bulk insert paths for synced SMS messages.
+
+Two ways to land a sync payload in sms_messages, both de-duplicating on
+(sms_id, user_name, date_received), or (sms_id, user_name) for messages
+without a date (a partial unique index on the default partition):
+
+- "batch": pipelined prepared INSERT ... ON CONFLICT DO NOTHING per row.
+  Cheapest for the small incremental syncs a phone sends most of the time.
+- "copy": COPY the rows into a per-connection temp table, then merge them
+  with one INSERT ... SELECT ... ON CONFLICT DO NOTHING. Much faster for
+  first syncs with tens of thousands of messages.
+
+`ingest_messages()` picks "copy" once a payload reaches SYNC_COPY_THRESHOLD
+rows (default 1000) unless a mode is forced. Either way the caller gets
+exact received / inserted / duplicate counts, plus the user's new sync
+cursor. Every row is tagged with its category (classify.py) on the way in.
+
+`ingest_stream()` backs /sync/stream. It takes rows in fixed-size chunks as
+the body is parsed (SYNC_STREAM_CHUNK_SIZE, default 5000) and commits each
+chunk on its own pooled connection. Memory stays flat however large the
+upload is, and a slow client never pins a connection between chunks.
+In-flight streams are listed by `get_sync_progress()`.
+
+Every commit that inserted rows also sends NOTIFY on SYNC_NOTIFY_CHANNEL
+with the user name as payload. Postgres delivers it only if the transaction
+commits, and converter_worker.py converts the new messages within seconds.
+
+The sync cursor is the per-user high-water mark: the largest date_received
+and the largest sms_id stored so far. It is only returned to the user's own
+credentials (`with_cursor`). Clients upload only messages beyond
+it instead of re-sending the inbox for ON CONFLICT to discard.
+"""
+import os
+import time
+import uuid
+from typing import AsyncIterator, Dict, List, Optional, Sequence
+from classify import classify
+from db import async_connection
+from logging_config import get_logger
+from statements import aexecute, aexecutemany, register
+
+logger = get_logger("sms_sync.ingest")
+
+INGEST_MODES = ("batch", "copy")
+SYNC_COPY_THRESHOLD = int(os.getenv("SYNC_COPY_THRESHOLD", "1000"))
+SYNC_STREAM_CHUNK_SIZE = int(os.getenv("SYNC_STREAM_CHUNK_SIZE", "5000"))
+SYNC_NOTIFY_CHANNEL = "sms_synced"
+
+# Streamed syncs running in this process, by sync_id
+_in_flight: Dict[str, Dict] = {}
+
+SYNC_INSERT_SMS = register(
+    "sync_insert_sms",
+    """
+    INSERT INTO sms_messages (user_name, sms_id, address, body, date_received, message_type, category)
+    VALUES (%s, %s, %s, %s, %s, %s, %s)
+    ON CONFLICT DO NOTHING;
+    """,
+)
+
+SYNC_CURSOR = register(
+    "sync_cursor",
+    """
+    SELECT MAX(date_received), MAX(sms_id) FROM sms_messages WHERE user_name = %s;
+    """,
+)
+
+# Created once per pooled connection and emptied at every commit, so
+# repeated syncs don't churn the system catalogs with new temp tables.
+_STAGING_DDL = """
+    CREATE TEMP TABLE IF NOT EXISTS sms_ingest (
+        sms_id BIGINT NOT NULL,
+        address VARCHAR(255),
+        body TEXT,
+        date_received BIGINT,
+        message_type INTEGER,
+        category VARCHAR(20)
+    ) ON COMMIT DELETE ROWS;
+"""
+_MERGE_SQL = """
+    INSERT INTO sms_messages (user_name, sms_id, address, body, date_received, message_type, category)
+    SELECT %s, sms_id, address, body, date_received, message_type, category FROM sms_ingest
+    ON CONFLICT DO NOTHING;
+"""
+
+
+def _category(row: tuple) -> str:
+    _, address, body, _, message_type = row
+    return classify(address, body, message_type)
+
+
+async def batch_ingest(conn, user_name: str, rows: Sequence[tuple]) -> int:
+    """Insert (sms_id, address, body, date_received, message_type) rows one statement each; returns rows inserted."""
+    async with conn.cursor() as cur:
+        await aexecutemany(cur, SYNC_INSERT_SMS, [(user_name, *row, _category(row)) for row in rows])
+        return cur.rowcount
+
+
+async def copy_ingest(conn, user_name: str, rows: Sequence[tuple]) -> int:
+    """COPY rows into the staging table and merge them in one statement; returns rows inserted."""
+    async with conn.cursor() as cur:
+        await cur.execute(_STAGING_DDL)
+        async with cur.copy(
+            "COPY sms_ingest (sms_id, address, body, date_received, message_type, category) FROM STDIN"
+        ) as copy:
+            for row in rows:
+                await copy.write_row((*row, _category(row)))
+        await cur.execute(_MERGE_SQL, (user_name,))
+        return cur.rowcount
+
+
+async def sync_cursor(conn, user_name: str) -> Dict:
+    """The user's high-water mark; both values are None before the first sync."""
+    cur = await aexecute(conn, SYNC_CURSOR, (user_name,))
+    max_date_received, max_sms_id = await cur.fetchone()
+    return {"max_date_received": max_date_received, "max_sms_id": max_sms_id}
+
+
+async def _notify_synced(conn, user_name: str) -> None:
+    """Queue a NOTIFY for the converter; sent when the current transaction commits."""
+    await conn.execute("SELECT pg_notify(%s, %s);", (SYNC_NOTIFY_CHANNEL, user_name))
+
+
+def _pick_mode(rows: Sequence[tuple], mode: Optional[str]) -> str:
+    if mode is None:
+        mode = "copy" if len(rows) >= SYNC_COPY_THRESHOLD else "batch"
+    if mode not in INGEST_MODES:
+        raise ValueError(f"Unknown ingest mode: {mode!r}")
+    return mode
+
+
+async def _ingest(conn, user_name: str, rows: Sequence[tuple], mode: str) -> int:
+    ingest = copy_ingest if mode == "copy" else batch_ingest
+    return await ingest(conn, user_name, rows)
+
+
+async def ingest_messages(
+    conn, user_name: str, rows: Sequence[tuple], mode: Optional[str] = None, with_cursor: bool = True
+) -> Dict:
+    """Insert one user's messages and commit; returns the mode used, exact counts and (`with_cursor`) the new cursor."""
+    mode = _pick_mode(rows, mode)
+    inserted = await _ingest(conn, user_name, rows, mode)
+    result = {
+        "mode": mode,
+        "received_count": len(rows),
+        "inserted_count": inserted,
+        "duplicate_count": len(rows) - inserted,
+    }
+    if with_cursor:
+        result["cursor"] = await sync_cursor(conn, user_name)
+    if inserted:
+        await _notify_synced(conn, user_name)
+    await conn.commit()
+    logger.info(f"Ingested {len(rows)} messages for {user_name} via {mode}: {inserted} new")
+    return result
+
+
+async def ingest_stream(
+    user_name: str, chunks: AsyncIterator[Sequence[tuple]], mode: Optional[str] = None, with_cursor: bool = True
+) -> Dict:
+    """Insert and commit each chunk of rows as it arrives; returns totals like `ingest_messages()`.
+
+    A failure part way through leaves the chunks already committed in
+    place; the client resumes from the sync cursor.
+    """
+    if mode is not None:
+        _pick_mode((), mode)
+    sync_id = uuid.uuid4().hex
+    progress = {
+        "sync_id": sync_id,
+        "user_name": user_name,
+        "started_at": time.time(),
+        "chunks": 0,
+        "received_count": 0,
+        "inserted_count": 0,
+    }
+    _in_flight[sync_id] = progress
+    modes = set()
+    try:
+        async for rows in chunks:
+            if not rows:
+                continue
+            chunk_mode = _pick_mode(rows, mode)
+            modes.add(chunk_mode)
+            async with async_connection() as conn:
+                inserted = await _ingest(conn, user_name, rows, chunk_mode)
+                if inserted:
+                    await _notify_synced(conn, user_name)
+                await conn.commit()
+            progress["chunks"] += 1
+            progress["received_count"] += len(rows)
+            progress["inserted_count"] += inserted
+            logger.info(
+                f"Streamed sync {sync_id[:8]} for {user_name}: chunk {progress['chunks']}, "
+                f"{progress['received_count']} received, {progress['inserted_count']} new"
+            )
+        cursor = None
+        if with_cursor:
+            async with async_connection() as conn:
+                cursor = await sync_cursor(conn, user_name)
+    except BaseException:
+        logger.warning(
+            f"Streamed sync {sync_id[:8]} for {user_name} stopped after {progress['chunks']} committed chunks "
+            f"({progress['received_count']} received, {progress['inserted_count']} new)"
+        )
+        raise
+    finally:
+        _in_flight.pop(sync_id, None)
+    result = {
+        "mode": "+".join(sorted(modes)) or "batch",
+        "chunks": progress["chunks"],
+        "received_count": progress["received_count"],
+        "inserted_count": progress["inserted_count"],
+        "duplicate_count": progress["received_count"] - progress["inserted_count"],
+    }
+    if with_cursor:
+        result["cursor"] = cursor
+    return result
+
+
+def get_sync_progress(user_name: Optional[str] = None) -> List[Dict]:
+    """Streamed syncs in flight in this process, optionally for one user."""
+    now = time.time()
+    return [
+        {
+            **progress,
+            "elapsed_seconds": round(now - progress["started_at"], 3),
+            "rows_per_second": round(progress["received_count"] / max(now - progress["started_at"], 1e-9)),
+        }
+        for progress in list(_in_flight.values())
+        if user_name is None or progress["user_name"] == user_name
+    ]
@@ -0,0 +1,322 @@
+"""Content-addressed cache of LLM responses.
+
+Identical prompts (the same SMS synced by several users, a broadcast promo
+sent to everyone, a message re-converted after a reset) used to cost one LLM
+call each. `LLMProvider.generate_response` now goes through
+`ResponseCache.get_or_generate`:
+
+- the key is a SHA-256 of the provider's model names plus the prompt with
+  whitespace runs collapsed, so a model change starts a fresh cache;
+- an in-process LRU (LLM_CACHE_MEMORY_SIZE entries) sits in front of the
+  `llm_cache` table, which every process shares;
+- entries expire LLM_CACHE_TTL_SECONDS after they were generated (default
+  30 days; 0 disables the cache). Every LLM_CACHE_EVICT_EVERY stores, expired
+  rows are deleted and the table is trimmed to the LLM_CACHE_MAX_ROWS most
+  recently used;
+- concurrent callers asking for the same key share one in-flight call: the
+  first one looks the key up and, on a miss, calls the LLM; the others wait
+  for its answer. `aget_or_generate` does the same for coroutines on one
+  event loop.
+
+Batched extraction prompts rarely repeat byte for byte, so convert.py also
+files each answer out of a batch under that message's single-message prompt
+(`put`) and looks every message up that way (`get`) before batching it.
+
+Failed calls (no response from either provider) are not cached. Counters are
+under `llm_cache` in /pool-stats; `python llm_cache.py` runs an eviction pass.
+"""
+import asyncio
+import hashlib
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Optional
+from db import connection
+from logging_config import get_logger
+from statements import execute as execute_prepared, register
+
+logger = get_logger("sms_sync.llm_cache")
+
+LLM_CACHE_TTL_SECONDS = float(os.getenv("LLM_CACHE_TTL_SECONDS", str(30 * 24 * 3600)))
+LLM_CACHE_MAX_ROWS = int(os.getenv("LLM_CACHE_MAX_ROWS", "100000"))
+LLM_CACHE_MEMORY_SIZE = int(os.getenv("LLM_CACHE_MEMORY_SIZE", "2048"))
+LLM_CACHE_EVICT_EVERY = int(os.getenv("LLM_CACHE_EVICT_EVERY", "100"))
+
+_WHITESPACE_RUN = re.compile(r"\s+")
+
+# A hit refreshes last_used_at, which size-based eviction orders by
+LLM_CACHE_LOOKUP = register(
+    "llm_cache_lookup",
+    """
+    UPDATE llm_cache SET hits = hits + 1, last_used_at = CURRENT_TIMESTAMP
+    WHERE cache_key = %s AND created_at > CURRENT_TIMESTAMP - make_interval(secs => %s)
+    RETURNING response, EXTRACT(EPOCH FROM CURRENT_TIMESTAMP - created_at)
+    """,
+)
+LLM_CACHE_STORE = register(
+    "llm_cache_store",
+    """
+    INSERT INTO llm_cache (cache_key, response) VALUES (%s, %s)
+    ON CONFLICT (cache_key) DO UPDATE
+    SET response = EXCLUDED.response, hits = 0, created_at = CURRENT_TIMESTAMP, last_used_at = CURRENT_TIMESTAMP
+    """,
+)
+
+
+def cache_key(namespace: str, prompt: str) -> str:
+    normalized = _WHITESPACE_RUN.sub(" ", prompt).strip()
+    return hashlib.sha256(f"{namespace}\n{normalized}".encode("utf-8")).hexdigest()
+
+
+class _InFlight:
+    """One pending lookup-or-generate that other callers can wait on."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.response: Optional[str] = None
+
+
+class ResponseCache:
+    """llm_cache with an in-process LRU in front and in-flight call sharing."""
+
+    def __init__(self, ttl: float, max_rows: int, memory_size: int, evict_every: int):
+        self.ttl = ttl
+        self.max_rows = max_rows
+        self.memory_size = memory_size
+        self.evict_every = evict_every
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._in_flight: Dict[str, _InFlight] = {}
+        # (event loop id, key) -> future of the first async caller's answer
+        self._async_in_flight: Dict[tuple, "asyncio.Future"] = {}
+        self._stores_since_evict = 0
+        self._lock = threading.Lock()
+        self._stats = {
+            "memory_hits": 0, "db_hits": 0, "misses": 0, "coalesced": 0,
+            "stores": 0, "evicted_rows": 0, "errors": 0,
+        }
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0
+
+    def _count(self, name: str, amount: int = 1) -> None:
+        with self._lock:
+            self._stats[name] += amount
+
+    def _memory_get(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            response, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            self._stats["memory_hits"] += 1
+            return response
+
+    def _remember(self, key: str, response: str, age: float = 0.0) -> None:
+        if self.memory_size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (response, time.monotonic() + self.ttl - age)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.memory_size:
+                self._entries.popitem(last=False)
+
+    def _load(self, key: str) -> Optional[str]:
+        try:
+            with connection() as conn:
+                with conn.cursor() as cur:
+                    execute_prepared(cur, LLM_CACHE_LOOKUP, (key, self.ttl))
+                    row = cur.fetchone()
+                conn.commit()
+        except Exception as e:
+            logger.warning(f"LLM cache lookup failed: {e}")
+            self._count("errors")
+            return None
+        if row is None:
+            return None
+        response, age = row
+        self._count("db_hits")
+        self._remember(key, response, float(age))
+        return response
+
+    def _store(self, key: str, response: str) -> None:
+        self._remember(key, response)
+        try:
+            with connection() as conn:
+                with conn.cursor() as cur:
+                    execute_prepared(cur, LLM_CACHE_STORE, (key, response))
+                conn.commit()
+        except Exception as e:
+            logger.warning(f"Could not store LLM response: {e}")
+            self._count("errors")
+            return
+        with self._lock:
+            self._stats["stores"] += 1
+            self._stores_since_evict += 1
+            due = self._stores_since_evict >= self.evict_every
+            if due:
+                self._stores_since_evict = 0
+        if due:
+            self.evict()
+
+    def evict(self) -> int:
+        """Delete expired rows and trim the table to max_rows; returns rows deleted."""
+        try:
+            with connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute(
+                        "DELETE FROM llm_cache WHERE created_at <= CURRENT_TIMESTAMP - make_interval(secs => %s);",
+                        (self.ttl,),
+                    )
+                    deleted = cur.rowcount
+                    cur.execute(
+                        """
+                        DELETE FROM llm_cache WHERE cache_key IN (
+                            SELECT cache_key FROM llm_cache ORDER BY last_used_at DESC OFFSET %s
+                        );
+                        """,
+                        (self.max_rows,),
+                    )
+                    deleted += cur.rowcount
+                conn.commit()
+        except Exception as e:
+            logger.warning(f"LLM cache eviction failed: {e}")
+            self._count("errors")
+            return 0
+        if deleted:
+            logger.info(f"Evicted {deleted} LLM cache rows")
+        self._count("evicted_rows", deleted)
+        return deleted
+
+    def get(self, namespace: str, prompt: str) -> Optional[str]:
+        """Cached response for `prompt`, or None; never generates one."""
+        if not self.enabled:
+            return None
+        key = cache_key(namespace, prompt)
+        response = self._memory_get(key) or self._load(key)
+        if response is None:
+            self._count("misses")
+        return response
+
+    def put(self, namespace: str, prompt: str, response: str) -> None:
+        """Store a response obtained without `prompt` (e.g. one answer out of a batch)."""
+        if self.enabled:
+            self._store(cache_key(namespace, prompt), response)
+
+    def get_or_generate(self, namespace: str, prompt: str, generate: Callable[[str], Optional[str]]) -> Optional[str]:
+        """Cached response for `prompt`, calling `generate(prompt)` at most once per key at a time."""
+        if not self.enabled:
+            return generate(prompt)
+        key = cache_key(namespace, prompt)
+        response = self._memory_get(key)
+        if response is not None:
+            return response
+
+        with self._lock:
+            call = self._in_flight.get(key)
+            leader = call is None
+            if leader:
+                call = self._in_flight[key] = _InFlight()
+            else:
+                self._stats["coalesced"] += 1
+        if not leader:
+            call.done.wait()
+            return call.response
+
+        try:
+            response = self._load(key)
+            if response is None:
+                self._count("misses")
+                response = generate(prompt)
+                if response:
+                    self._store(key, response)
+            call.response = response
+            return response
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+            call.done.set()
+
+    async def aget_or_generate(
+        self, namespace: str, prompt: str, agenerate: Callable[[str], Awaitable[Optional[str]]],
+        count_miss: bool = True,
+    ) -> Optional[str]:
+        """Async get_or_generate; the table is read and written from a worker thread.
+
+        Pass count_miss=False when the caller has just missed on `get` for
+        the same prompt, so one message is not counted as two misses.
+        """
+        if not self.enabled:
+            return await agenerate(prompt)
+        key = cache_key(namespace, prompt)
+        response = self._memory_get(key)
+        if response is not None:
+            return response
+
+        loop = asyncio.get_running_loop()
+        flight_key = (id(loop), key)
+        with self._lock:
+            future = self._async_in_flight.get(flight_key)
+            leader = future is None
+            if leader:
+                future = self._async_in_flight[flight_key] = loop.create_future()
+            else:
+                self._stats["coalesced"] += 1
+        if not leader:
+            return await asyncio.shield(future)
+
+        response = None
+        try:
+            response = await asyncio.to_thread(self._load, key)
+            if response is None:
+                if count_miss:
+                    self._count("misses")
+                response = await agenerate(prompt)
+                if response:
+                    await asyncio.to_thread(self._store, key, response)
+            return response
+        finally:
+            with self._lock:
+                del self._async_in_flight[flight_key]
+            if not future.done():
+                future.set_result(response)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            hits = self._stats["memory_hits"] + self._stats["db_hits"] + self._stats["coalesced"]
+            lookups = hits + self._stats["misses"]
+            return {
+                "enabled": self.enabled,
+                "memory_size": len(self._entries),
+                "memory_max_size": self.memory_size,
+                "ttl_seconds": self.ttl,
+                "max_rows": self.max_rows,
+                "in_flight": len(self._in_flight) + len(self._async_in_flight),
+                **self._stats,
+                "hit_rate": round(hits / lookups, 3) if lookups else None,
+            }
+
+
+response_cache = ResponseCache(
+    ttl=LLM_CACHE_TTL_SECONDS,
+    max_rows=LLM_CACHE_MAX_ROWS,
+    memory_size=LLM_CACHE_MEMORY_SIZE,
+    evict_every=LLM_CACHE_EVICT_EVERY,
+)
+
+
+def get_llm_cache_stats() -> Dict:
+    return response_cache.stats()
+
+
+if __name__ == "__main__":
+    from logging_config import setup_logging
+
+    setup_logging()
+    print(f"rows evicted: {response_cache.evict()}")
@@ -1,13 +1,153 @@
 # llm_provider.py
+import asyncio
 import os
+import threading
 import time
-from typing import Optional
+from typing import Dict, Optional
 from logging_config import get_logger
+from llm_cache import response_cache
 from langchain_google_genai import ChatGoogleGenerativeAI
 from langchain_openai import ChatOpenAI
 
 logger = get_logger("sms_sync.llm_provider")
 
+PRIMARY_MODEL = "gemini-2.0-flash"
+SECONDARY_MODEL = "gpt-4o-mini"
+# Response cache namespace: changing either model starts a fresh cache
+CACHE_NAMESPACE = f"{PRIMARY_MODEL}|{SECONDARY_MODEL}"
+
+# Async path (agenerate_response): calls in flight per LLMProvider, and each
+# provider's quota in requests and tokens per minute
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "4"))
+PROVIDER_QUOTAS = {
+    "gemini": (int(os.getenv("LLM_GEMINI_RPM", "15")), int(os.getenv("LLM_GEMINI_TPM", "1000000"))),
+    "openai": (int(os.getenv("LLM_OPENAI_RPM", "500")), int(os.getenv("LLM_OPENAI_TPM", "200000"))),
+}
+MAX_OUTPUT_TOKENS = {"gemini": 1000, "openai": 700}
+
+
+class TokenBucket:
+    """Holds up to `per_minute` units and refills them evenly over a minute."""
+
+    def __init__(self, per_minute: int):
+        self.capacity = float(per_minute)
+        self.available = float(per_minute)
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.available = min(self.capacity, self.available + (now - self.updated) * self.capacity / 60.0)
+        self.updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """Seconds until `amount` units are available (a request larger than the bucket waits for a full one)."""
+        self._refill(now)
+        missing = min(amount, self.capacity) - self.available
+        return max(0.0, missing * 60.0 / self.capacity) if self.capacity > 0 else 0.0
+
+    def take(self, amount: float) -> None:
+        self.available -= min(amount, self.capacity)
+
+    def give_back(self, amount: float) -> None:
+        self.available = min(self.capacity, self.available + amount)
+
+
+class ProviderLimiter:
+    """Requests/min and tokens/min buckets for one provider, plus a pause after a 429.
+
+    Shared by every LLMProvider in the process (see PROVIDER_LIMITERS). The
+    state sits behind a threading.Lock and callers wait with asyncio.sleep,
+    so one limiter serves conversion rounds on different event loops.
+    """
+
+    def __init__(self, name: str, rpm: int, tpm: int):
+        self.name = name
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.paused_until = 0.0
+        self._lock = threading.Lock()
+        self._stats = {"acquired": 0, "waits": 0, "wait_seconds": 0.0, "rate_limited": 0}
+
+    async def acquire(self, tokens: int) -> None:
+        """Wait until one request and `tokens` tokens fit in the quota, then take them."""
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                delay = max(
+                    self.paused_until - now,
+                    self.requests.wait_time(1, now),
+                    self.tokens.wait_time(tokens, now),
+                )
+                if delay <= 0:
+                    self.requests.take(1)
+                    self.tokens.take(tokens)
+                    self._stats["acquired"] += 1
+                    if waited:
+                        self._stats["waits"] += 1
+                        self._stats["wait_seconds"] += waited
+                    return
+            await asyncio.sleep(delay)
+            waited += delay
+
+    def refund(self, tokens: int) -> None:
+        """Return tokens reserved for a call but not used by it."""
+        if tokens > 0:
+            with self._lock:
+                self.tokens.give_back(tokens)
+
+    def pause(self, seconds: float) -> None:
+        """Hold every caller of this provider for `seconds` (after a 429)."""
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self._stats["rate_limited"] += 1
+
+    def stats(self) -> Dict:
+        with self._lock:
+            now = time.monotonic()
+            self.requests._refill(now)
+            self.tokens._refill(now)
+            return {
+                "rpm": int(self.requests.capacity),
+                "tpm": int(self.tokens.capacity),
+                "requests_available": int(self.requests.available),
+                "tokens_available": int(self.tokens.available),
+                "paused_for_seconds": round(max(0.0, self.paused_until - now), 1),
+                **{k: round(v, 1) if isinstance(v, float) else v for k, v in self._stats.items()},
+            }
+
+
+PROVIDER_LIMITERS = {name: ProviderLimiter(name, rpm, tpm) for name, (rpm, tpm) in PROVIDER_QUOTAS.items()}
+
+
+def get_llm_limiter_stats() -> Dict:
+    return {name: limiter.stats() for name, limiter in PROVIDER_LIMITERS.items()}
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count for quota accounting (about 4 characters per token)."""
+    return len(text) // 4 + 1
+
+
+def rate_limit_delay(error: BaseException) -> Optional[float]:
+    """None unless `error` (or its cause) is an HTTP 429; then the Retry-After seconds, or 0.0 if not given.
+
+    OpenAI errors carry `status_code` and the response headers; Google API
+    errors carry the HTTP status as `code`.
+    """
+    seen = set()
+    while error is not None and id(error) not in seen:
+        seen.add(id(error))
+        status = getattr(error, "status_code", None) or getattr(error, "code", None)
+        if status == 429:
+            headers = getattr(getattr(error, "response", None), "headers", None) or {}
+            try:
+                return max(0.0, float(headers.get("retry-after", 0)))
+            except (TypeError, ValueError):
+                return 0.0
+        error = error.__cause__ or error.__context__
+    return None
+
+
 class LLMProvider:
     """LLM provider with primary and secondary fallback support."""
     
@@ -21,10 +161,12 @@ class LLMProvider:
             raise ValueError("GEMINI_APIKEY environment variable not set.")
         
         self.primary_llm = ChatGoogleGenerativeAI(
-            model="gemini-2.0-flash",
+            model=PRIMARY_MODEL,
             google_api_key=gemini_api_key,
             temperature=0.1,
-            max_output_tokens=1000
+            max_output_tokens=MAX_OUTPUT_TOKENS["gemini"],
+            # One attempt per call: 429s come back to us instead of being retried inside the client
+            max_retries=1
         )
         
         # Secondary LLM (OpenAI GPT-4)
@@ -34,10 +176,11 @@ class LLMProvider:
             raise ValueError("OPENAI_API_KEY environment variable not set.")
         
         self.secondary_llm = ChatOpenAI(
-            model="gpt-4o-mini",
+            model=SECONDARY_MODEL,
             api_key=openai_api_key,
             temperature=0.1,
-            max_tokens=700
+            max_tokens=MAX_OUTPUT_TOKENS["openai"],
+            max_retries=0
         )
         
         # Rate limiting
@@ -45,6 +188,7 @@ class LLMProvider:
         self.max_retries = 2
         self.retry_delay = 5.0
         self.last_request_time = 0
+        self._semaphore = asyncio.Semaphore(LLM_MAX_CONCURRENCY)
     
     def _wait_for_rate_limit(self):
         """Implement rate limiting."""
@@ -59,6 +203,10 @@ class LLMProvider:
         self.last_request_time = time.time()
     
     def generate_response(self, prompt: str) -> Optional[str]:
+        """Generate response, answering repeated prompts from the response cache (llm_cache.py)."""
+        return response_cache.get_or_generate(CACHE_NAMESPACE, prompt, self._generate_uncached)
+    
+    def _generate_uncached(self, prompt: str) -> Optional[str]:
         """Generate response with primary-secondary fallback logic."""
         
         # Try primary LLM first
@@ -93,18 +241,84 @@ class LLMProvider:
                     logger.warning(f"Empty response from {provider_name} on attempt {attempt + 1}")
                     
             except Exception as e:
-                error_str = str(e).lower()
                 logger.warning(f"{provider_name} error on attempt {attempt + 1}: {e}")
                 
-                # Check for rate limit/quota errors
-                if any(keyword in error_str for keyword in ['quota', 'rate', 'limit', 'exceeded']):
+                # Back off on HTTP 429, honouring Retry-After when the provider sends it
+                retry_after = rate_limit_delay(e)
+                if retry_after is not None:
                     if attempt < self.max_retries - 1:
-                        backoff_time = self.retry_delay * (2 ** attempt)
-                        logger.info(f"Quota error, waiting {backoff_time} seconds...")
+                        backoff_time = retry_after or self.retry_delay * (2 ** attempt)
+                        logger.info(f"Rate limited, waiting {backoff_time} seconds...")
                         time.sleep(backoff_time)
                         continue
                 
                 if attempt == self.max_retries - 1:
                     logger.error(f"{provider_name} failed after {self.max_retries} attempts")
         
-        return None
\ No newline at end of file
+        return None
+    
+    async def agenerate_response(self, prompt: str, count_miss: bool = True) -> Optional[str]:
+        """Async generate_response: cached, at most LLM_MAX_CONCURRENCY calls at once, within provider quotas."""
+        return await response_cache.aget_or_generate(
+            CACHE_NAMESPACE, prompt, self._agenerate_uncached, count_miss=count_miss
+        )
+    
+    def cached_response(self, prompt: str) -> Optional[str]:
+        """Cached response for `prompt`, or None; never calls an LLM."""
+        return response_cache.get(CACHE_NAMESPACE, prompt)
+    
+    def cache_response(self, prompt: str, response: str) -> None:
+        """Cache `response` as the answer to `prompt`."""
+        response_cache.put(CACHE_NAMESPACE, prompt, response)
+    
+    async def _agenerate_uncached(self, prompt: str) -> Optional[str]:
+        response = await self._atry_llm(self.primary_llm, self.primary_provider, prompt)
+        if response:
+            return response
+        
+        logger.warning(f"Primary LLM ({self.primary_provider}) failed, trying secondary")
+        
+        response = await self._atry_llm(self.secondary_llm, self.secondary_provider, prompt)
+        if response:
+            return response
+        
+        logger.error("Both primary and secondary LLMs failed")
+        return None
+    
+    async def _atry_llm(self, llm, provider_name: str, prompt: str) -> Optional[str]:
+        """Try a specific LLM with retry logic, pacing calls by the provider's token buckets."""
+        limiter = PROVIDER_LIMITERS[provider_name]
+        reserved = estimate_tokens(prompt) + MAX_OUTPUT_TOKENS[provider_name]
+        
+        for attempt in range(self.max_retries):
+            await limiter.acquire(reserved)
+            try:
+                async with self._semaphore:
+                    logger.info(f"Trying {provider_name} (attempt {attempt + 1}/{self.max_retries})")
+                    response = await llm.ainvoke(prompt)
+                
+                usage = getattr(response, 'usage_metadata', None) or {}
+                if usage.get('total_tokens'):
+                    limiter.refund(reserved - usage['total_tokens'])
+                
+                if response and hasattr(response, 'content') and response.content:
+                    logger.info(f"{provider_name} responded successfully")
+                    return response.content
+                else:
+                    logger.warning(f"Empty response from {provider_name} on attempt {attempt + 1}")
+                    
+            except Exception as e:
+                logger.warning(f"{provider_name} error on attempt {attempt + 1}: {e}")
+                
+                # A 429 pauses every caller of this provider, not just this one
+                retry_after = rate_limit_delay(e)
+                if retry_after is not None and attempt < self.max_retries - 1:
+                    backoff_time = retry_after or self.retry_delay * (2 ** attempt)
+                    logger.info(f"{provider_name} rate limited, pausing it for {backoff_time} seconds...")
+                    limiter.pause(backoff_time)
+                    continue
+                
+                if attempt == self.max_retries - 1:
+                    logger.error(f"{provider_name} failed after {self.max_retries} attempts")
+        
+        return None
@@ -1,7 +1,8 @@
 from fastapi import FastAPI
 from contextlib import asynccontextmanager
 from routes import router  # Now imports from routes/__init__.py
-from db import setup_database
+from partitions import maintain_partitions
+from db import close_async_pool, close_pool, init_async_pool, init_pool, setup_database
 from logging_config import setup_logging, get_logger
 
 # --- FastAPI Application Initialization ---
@@ -10,10 +11,15 @@ async def lifespan(app: FastAPI):
     # Configure logging (idempotent)
     setup_logging()
     logger = get_logger("sms_sync.app")
-    # Startup: ensure DB table exists
+    # Startup: open the connection pools and apply pending migrations
+    init_pool()
+    await init_async_pool()
     setup_database()
+    maintain_partitions()
     yield
-    # Shutdown: add cleanup here if needed
+    # Shutdown: release pooled connections
+    await close_async_pool()
+    close_pool()
 
 app = FastAPI(
     title="SMS Sync Service",
@@ -0,0 +1,430 @@
+"""Versioned schema migrations.
+
+Each migration is a function registered with `@migration(version, description)`
+that receives a cursor and runs its DDL. Applied versions are recorded in
+the `schema_version` table. Startup (`migrate()`) costs a single
+`SELECT MAX(version)` when the schema is already current; otherwise the
+pending steps run in order under a Postgres advisory lock, so only one
+worker migrates while the others wait and then see the new version.
+"""
+from typing import Callable, List, Tuple
+import psycopg2
+from datetime import datetime, timezone
+from db import APP_TIMEZONE, connection
+from logging_config import get_logger
+from partitions import ensure_partitions, month_of_ms, month_start
+
+logger = get_logger("sms_sync.migrations")
+
+# Arbitrary application-wide key for pg_advisory_lock
+MIGRATION_LOCK_ID = 7311_2024
+
+MIGRATIONS: List[Tuple[int, str, Callable]] = []
+
+
+def migration(version: int, description: str):
+    """Register a migration step; versions must be unique and increasing."""
+    def register(fn: Callable) -> Callable:
+        if MIGRATIONS and version <= MIGRATIONS[-1][0]:
+            raise ValueError(f"Migration {version} registered out of order")
+        MIGRATIONS.append((version, description, fn))
+        return fn
+    return register
+
+
+@migration(1, "baseline users, sms_messages and transactions tables")
+def _baseline(cur):
+    # Users table for authentication
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            id SERIAL PRIMARY KEY,
+            username VARCHAR(255) UNIQUE NOT NULL,
+            password_hash VARCHAR(255) NOT NULL,
+            created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+        );
+        """
+    )
+
+    # SMS messages table
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS sms_messages (
+            id SERIAL PRIMARY KEY,
+            user_name VARCHAR(255) NOT NULL,
+            sms_id BIGINT NOT NULL,
+            address VARCHAR(255),
+            body TEXT,
+            date_received BIGINT,
+            message_type INTEGER,
+            is_processed BOOLEAN DEFAULT FALSE,
+            created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE (sms_id, user_name)
+        );
+        """
+    )
+
+    # Transactions table
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS transactions (
+            id SERIAL PRIMARY KEY,
+            user_name VARCHAR(255) NOT NULL,
+            sms_id BIGINT NOT NULL,
+            address VARCHAR(255),
+            bank VARCHAR(100),
+            amount DECIMAL(15,2),
+            transaction_type VARCHAR(20),
+            merchant VARCHAR(255),
+            date_received BIGINT,
+            created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE (sms_id, user_name)
+        );
+        """
+    )
+
+    # Helpful indexes for user-scoped queries
+    cur.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_sms_messages_user_created
+        ON sms_messages (user_name, created_at DESC);
+        """
+    )
+    cur.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_sms_messages_processed
+        ON sms_messages (is_processed, created_at ASC);
+        """
+    )
+    cur.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_transactions_user_created
+        ON transactions (user_name, created_at DESC);
+        """
+    )
+    cur.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_transactions_type_amount
+        ON transactions (transaction_type, amount);
+        """
+    )
+    cur.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_transactions_date_received
+        ON transactions (user_name, date_received DESC);
+        """
+    )
+
+
+_SMS_COLUMNS = "id, user_name, sms_id, address, body, date_received, message_type, is_processed, created_at"
+_TRANSACTION_COLUMNS = (
+    "id, user_name, sms_id, address, bank, amount, transaction_type, merchant, date_received, created_at"
+)
+
+
+def _copy_into_partitions(cur, table: str, columns: str) -> None:
+    """Create month partitions spanning the legacy data, copy it over and drop the legacy table."""
+    legacy = f"{table}_legacy"
+    now = datetime.now(timezone.utc)
+    current = (now.year, now.month)
+    # Ignore obviously bogus timestamps (before 2000-01-01); those rows land
+    # in the default partition instead of creating decades of empty months.
+    cur.execute(
+        f"SELECT MIN(date_received), MAX(date_received) FROM {legacy} WHERE date_received >= %s;",
+        (946684800000,),
+    )
+    low, high = cur.fetchone()
+    first = month_of_ms(low) if low is not None else current
+    last = max(month_of_ms(high) if high is not None else current, current)
+    ensure_partitions(cur, table, min(first, current), month_start(last[0], last[1] + 3))
+
+    cur.execute(f"INSERT INTO {table} ({columns}) SELECT {columns} FROM {legacy};")
+    cur.execute(
+        f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), COALESCE(MAX(id), 0) + 1, false) FROM {table};"
+    )
+    cur.execute(f"DROP TABLE {legacy};")
+
+
+@migration(2, "partition sms_messages and transactions by date_received month")
+def _partition_by_month(cur):
+    # Unique keys on a partitioned table must include the partition key,
+    # so de-duplication becomes (sms_id, user_name, date_received).
+    cur.execute("ALTER TABLE sms_messages RENAME TO sms_messages_legacy;")
+    cur.execute(
+        """
+        CREATE TABLE sms_messages (
+            id SERIAL,
+            user_name VARCHAR(255) NOT NULL,
+            sms_id BIGINT NOT NULL,
+            address VARCHAR(255),
+            body TEXT,
+            date_received BIGINT,
+            message_type INTEGER,
+            is_processed BOOLEAN DEFAULT FALSE,
+            created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE (sms_id, user_name, date_received)
+        ) PARTITION BY RANGE (date_received);
+        """
+    )
+    cur.execute("CREATE TABLE sms_messages_default PARTITION OF sms_messages DEFAULT;")
+    _copy_into_partitions(cur, "sms_messages", _SMS_COLUMNS)
+
+    cur.execute("ALTER TABLE transactions RENAME TO transactions_legacy;")
+    cur.execute(
+        """
+        CREATE TABLE transactions (
+            id SERIAL,
+            user_name VARCHAR(255) NOT NULL,
+            sms_id BIGINT NOT NULL,
+            address VARCHAR(255),
+            bank VARCHAR(100),
+            amount DECIMAL(15,2),
+            transaction_type VARCHAR(20),
+            merchant VARCHAR(255),
+            date_received BIGINT,
+            created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE (sms_id, user_name, date_received)
+        ) PARTITION BY RANGE (date_received);
+        """
+    )
+    cur.execute("CREATE TABLE transactions_default PARTITION OF transactions DEFAULT;")
+    _copy_into_partitions(cur, "transactions", _TRANSACTION_COLUMNS)
+
+    # Recreate the indexes on the partitioned parents (cascades to partitions)
+    cur.execute("CREATE INDEX idx_sms_messages_user_created ON sms_messages (user_name, created_at DESC);")
+    cur.execute("CREATE INDEX idx_sms_messages_processed ON sms_messages (is_processed, created_at ASC);")
+    cur.execute("CREATE INDEX idx_sms_messages_date_received ON sms_messages (user_name, date_received DESC);")
+    cur.execute("CREATE INDEX idx_transactions_user_created ON transactions (user_name, created_at DESC);")
+    cur.execute("CREATE INDEX idx_transactions_type_amount ON transactions (transaction_type, amount);")
+    cur.execute("CREATE INDEX idx_transactions_date_received ON transactions (user_name, date_received DESC);")
+
+
+@migration(3, "full-text search column and GIN index on sms_messages")
+def _sms_full_text_search(cur):
+    # 'simple' config: no stemming or stop words, so sender IDs, merchant
+    # names and reference numbers stay searchable as typed.
+    cur.execute(
+        """
+        ALTER TABLE sms_messages ADD COLUMN search_tsv tsvector GENERATED ALWAYS AS (
+            setweight(to_tsvector('simple', COALESCE(address, '')), 'A')
+            || setweight(to_tsvector('simple', COALESCE(body, '')), 'B')
+        ) STORED;
+        """
+    )
+    cur.execute("CREATE INDEX idx_sms_messages_search ON sms_messages USING GIN (search_tsv);")
+
+
+@migration(4, "daily_spend rollup of transactions")
+def _daily_spend_rollup(cur):
+    # Keyed for per-user date range scans; NULL dimensions are stored as ''
+    # so they can be part of the primary key.
+    cur.execute(
+        """
+        CREATE TABLE daily_spend (
+            user_name VARCHAR(255) NOT NULL,
+            day DATE NOT NULL,
+            bank VARCHAR(100) NOT NULL DEFAULT '',
+            merchant VARCHAR(255) NOT NULL DEFAULT '',
+            transaction_type VARCHAR(20) NOT NULL DEFAULT '',
+            total_amount DECIMAL(17,2) NOT NULL DEFAULT 0,
+            txn_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_name, day, bank, merchant, transaction_type)
+        );
+        """
+    )
+    # Backfill inline rather than via rollup.rebuild(), which tracks the
+    # current schema (it reads received_at, added in migration 5).
+    cur.execute(
+        """
+        INSERT INTO daily_spend (user_name, day, bank, merchant, transaction_type, total_amount, txn_count)
+        SELECT user_name, (to_timestamp(date_received / 1000.0) AT TIME ZONE %s)::date,
+               COALESCE(bank, ''), COALESCE(merchant, ''), COALESCE(transaction_type, ''),
+               SUM(ABS(COALESCE(amount, 0))), COUNT(*)
+        FROM transactions
+        WHERE date_received IS NOT NULL
+        GROUP BY 1, 2, 3, 4, 5;
+        """,
+        (APP_TIMEZONE,),
+    )
+
+
+@migration(5, "generated received_at timestamptz on sms_messages and transactions")
+def _received_at_columns(cur):
+    # date_received stays the partition key; received_at is the same instant
+    # as a real timestamp so formatting and calendar bucketing happen in SQL.
+    for table in ("sms_messages", "transactions"):
+        cur.execute(
+            f"""
+            ALTER TABLE {table} ADD COLUMN received_at TIMESTAMP WITH TIME ZONE
+            GENERATED ALWAYS AS (to_timestamp(date_received / 1000.0)) STORED;
+            """
+        )
+        cur.execute(f"CREATE INDEX idx_{table}_received_at ON {table} (user_name, received_at DESC);")
+
+
+@migration(6, "per-user sms_id index for the sync cursor")
+def _sync_cursor_index(cur):
+    # max(date_received) is served by idx_sms_messages_date_received; the
+    # unique key leads with sms_id, so max(sms_id) per user needs its own index.
+    cur.execute("CREATE INDEX idx_sms_messages_user_sms_id ON sms_messages (user_name, sms_id DESC);")
+
+
+@migration(7, "ingest-time category on sms_messages and the convert queue index")
+def _sms_category(cur):
+    # Filled in by /sync (classify.py); existing rows stay NULL until
+    # `python classify.py` tags them and are converted meanwhile.
+    cur.execute("ALTER TABLE sms_messages ADD COLUMN category VARCHAR(20);")
+    cur.execute(
+        """
+        CREATE INDEX idx_sms_messages_convert_queue ON sms_messages (created_at)
+        WHERE is_processed = FALSE AND (category = 'financial' OR category IS NULL);
+        """
+    )
+
+
+@migration(8, "learned SMS shapes for the converter")
+def _sms_shapes(cur):
+    # Written by shapes.py after an LLM extraction; shape_key is the SHA-1
+    # of the sender header plus the masked text.
+    cur.execute(
+        """
+        CREATE TABLE sms_shapes (
+            shape_key CHAR(40) PRIMARY KEY,
+            sender_header VARCHAR(255),
+            template TEXT NOT NULL,
+            pattern TEXT NOT NULL,
+            bank VARCHAR(100),
+            transaction_type VARCHAR(20),
+            merchant VARCHAR(255),
+            hits BIGINT NOT NULL DEFAULT 0,
+            created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+            last_hit_at TIMESTAMP WITH TIME ZONE
+        );
+        """
+    )
+
+
+@migration(9, "LLM response cache")
+def _llm_cache(cur):
+    # Written by llm_cache.py; cache_key is a SHA-256 of the models and the
+    # normalized prompt. Size-based eviction keeps the most recently used rows.
+    cur.execute(
+        """
+        CREATE TABLE llm_cache (
+            cache_key CHAR(64) PRIMARY KEY,
+            response TEXT NOT NULL,
+            hits BIGINT NOT NULL DEFAULT 0,
+            created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+            last_used_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+        );
+        """
+    )
+    cur.execute("CREATE INDEX idx_llm_cache_last_used_at ON llm_cache (last_used_at);")
+
+
+@migration(10, "unique key for sms_messages and transactions rows without a date_received")
+def _undated_unique(cur):
+    # NULLs never conflict in UNIQUE (sms_id, user_name, date_received), so
+    # re-synced undated messages were stored again. Undated rows always live
+    # in the default partition, where a partial unique index covers them;
+    # inserts use a bare ON CONFLICT DO NOTHING so it takes effect.
+    cur.execute(
+        """
+        UPDATE sms_messages_default kept SET is_processed = TRUE
+        WHERE kept.date_received IS NULL AND kept.is_processed IS NOT TRUE AND EXISTS (
+            SELECT 1 FROM sms_messages_default dup
+            WHERE dup.date_received IS NULL AND dup.sms_id = kept.sms_id
+              AND dup.user_name = kept.user_name AND dup.is_processed
+        );
+        """
+    )
+    for table in ("sms_messages", "transactions"):
+        cur.execute(
+            f"""
+            DELETE FROM {table}_default dup USING {table}_default kept
+            WHERE dup.date_received IS NULL AND kept.date_received IS NULL
+              AND dup.sms_id = kept.sms_id AND dup.user_name = kept.user_name AND dup.id > kept.id;
+            """
+        )
+        cur.execute(
+            f"""
+            CREATE UNIQUE INDEX idx_{table}_undated_unique ON {table}_default (sms_id, user_name)
+            WHERE date_received IS NULL;
+            """
+        )
+
+
+@migration(11, "sender header index on sms_shapes")
+def _sms_shapes_header_index(cur):
+    # shapes.py falls back to a sender's learned shapes, busiest first, when
+    # a message's exact shape is unknown (same wording, another payee)
+    cur.execute("CREATE INDEX idx_sms_shapes_sender_header ON sms_shapes (sender_header, hits DESC);")
+
+
+def latest_version() -> int:
+    return MIGRATIONS[-1][0] if MIGRATIONS else 0
+
+
+def _current_version(conn) -> int:
+    """Return the applied schema version (0 if never migrated)."""
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version;")
+            version = cur.fetchone()[0]
+        conn.rollback()
+        return version
+    except psycopg2.errors.UndefinedTable:
+        conn.rollback()
+        return 0
+
+
+def migrate() -> int:
+    """Bring the schema up to date and return the resulting version."""
+    target = latest_version()
+    with connection() as conn:
+        version = _current_version(conn)
+        if version >= target:
+            logger.debug(f"Schema already at version {version}")
+            return version
+
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_advisory_lock(%s);", (MIGRATION_LOCK_ID,))
+        conn.commit()
+        try:
+            # Another worker may have migrated while we waited for the lock
+            version = _current_version(conn)
+            with conn.cursor() as cur:
+                cur.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS schema_version (
+                        version INTEGER PRIMARY KEY,
+                        description TEXT NOT NULL,
+                        applied_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+                    );
+                    """
+                )
+            conn.commit()
+
+            for step_version, description, fn in MIGRATIONS:
+                if step_version <= version:
+                    continue
+                logger.info(f"Applying migration {step_version}: {description}")
+                try:
+                    with conn.cursor() as cur:
+                        fn(cur)
+                        cur.execute(
+                            "INSERT INTO schema_version (version, description) VALUES (%s, %s);",
+                            (step_version, description),
+                        )
+                    conn.commit()
+                except Exception as e:
+                    conn.rollback()
+                    logger.error(f"Migration {step_version} failed: {e}")
+                    raise
+                version = step_version
+            logger.info(f"Schema migrated to version {version}")
+            return version
+        finally:
+            with conn.cursor() as cur:
+                cur.execute("SELECT pg_advisory_unlock(%s);", (MIGRATION_LOCK_ID,))
+            conn.commit()
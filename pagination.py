@@ -0,0 +1,41 @@
+"""Keyset pagination cursors for the list endpoints.
+
+Pages are ordered by (date_received DESC, sms_id DESC). The cursor handed
+to clients is the key of the last row served, JSON-encoded and base64url'd
+so it stays opaque; the next page continues strictly after it.
+"""
+import base64
+import binascii
+import json
+from typing import Optional, Tuple
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+
+def encode_cursor(date_received: int, sms_id: int) -> str:
+    raw = json.dumps([date_received, sms_id], separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode()
+
+
+def decode_cursor(token: str) -> Tuple[int, int]:
+    """Return (date_received, sms_id); raises ValueError for a malformed token."""
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        date_received, sms_id = json.loads(raw)
+    except (binascii.Error, ValueError, TypeError) as e:
+        raise ValueError("Invalid cursor") from e
+    if not isinstance(date_received, int) or not isinstance(sms_id, int):
+        raise ValueError("Invalid cursor")
+    return date_received, sms_id
+
+
+def keyset_page(rows: list, limit: int, key) -> Tuple[list, Optional[str]]:
+    """Trim a `limit + 1` row fetch to one page and build the next cursor.
+
+    `key(row)` returns the (date_received, sms_id) of a row.
+    """
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, encode_cursor(*key(rows[-1]))
@@ -0,0 +1,179 @@
+"""Monthly range partitions for sms_messages and transactions.
+
+Both tables are partitioned on `date_received` (epoch milliseconds), one
+partition per calendar month (UTC) named `<table>_pYYYY_MM`, plus a
+`<table>_default` partition that catches NULL or out-of-range dates.
+
+`maintain_partitions()` creates partitions for the coming months and,
+when PARTITION_RETENTION_MONTHS is set, detaches partitions older than
+that so they can be archived or dropped without touching live data.
+Run it on startup (done in the app lifespan) or from cron via
+`python partitions.py`.
+"""
+import os
+import re
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+from db import connection
+from logging_config import get_logger
+
+logger = get_logger("sms_sync.partitions")
+
+PARTITIONED_TABLES = ("sms_messages", "transactions")
+# Serializes partition maintenance across workers (pg_advisory_xact_lock key)
+PARTITION_LOCK_ID = 7311_2025
+_PARTITION_NAME = re.compile(r"_p(\d{4})_(\d{2})$")
+
+
+def month_start(year: int, month: int) -> Tuple[int, int]:
+    """Normalize (year, month) allowing month overflow/underflow."""
+    year += (month - 1) // 12
+    month = (month - 1) % 12 + 1
+    return year, month
+
+
+def month_bounds_ms(year: int, month: int) -> Tuple[int, int]:
+    """Return [start, end) of a UTC calendar month in epoch milliseconds."""
+    start = datetime(year, month, 1, tzinfo=timezone.utc)
+    next_year, next_month = month_start(year, month + 1)
+    end = datetime(next_year, next_month, 1, tzinfo=timezone.utc)
+    return int(start.timestamp() * 1000), int(end.timestamp() * 1000)
+
+
+def month_of_ms(ts_ms: int) -> Tuple[int, int]:
+    moment = datetime.fromtimestamp(ts_ms / 1000, tz=timezone.utc)
+    return moment.year, moment.month
+
+
+def partition_name(table: str, year: int, month: int) -> str:
+    return f"{table}_p{year:04d}_{month:02d}"
+
+
+def _insertable_columns(cur, table: str) -> List[str]:
+    cur.execute(
+        """
+        SELECT column_name FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = %s AND is_generated = 'NEVER'
+        ORDER BY ordinal_position;
+        """,
+        (table,),
+    )
+    return [row[0] for row in cur.fetchall()]
+
+
+def list_partitions(cur, table: str) -> List[Tuple[str, int, int]]:
+    """Return (name, year, month) for every monthly partition attached to `table`."""
+    cur.execute(
+        """
+        SELECT child.relname
+        FROM pg_inherits
+        JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+        JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+        WHERE parent.relname = %s;
+        """,
+        (table,),
+    )
+    partitions = []
+    for (name,) in cur.fetchall():
+        match = _PARTITION_NAME.search(name)
+        if match:
+            partitions.append((name, int(match.group(1)), int(match.group(2))))
+    return sorted(partitions, key=lambda p: (p[1], p[2]))
+
+
+def create_month_partition(cur, table: str, year: int, month: int) -> bool:
+    """Create the partition for one month if missing; returns True if created.
+
+    Rows that already landed in the default partition for that month are
+    moved into the new partition (Postgres refuses to create it otherwise).
+    """
+    name = partition_name(table, year, month)
+    cur.execute("SELECT to_regclass(%s);", (name,))
+    if cur.fetchone()[0] is not None:
+        return False
+    start_ms, end_ms = month_bounds_ms(year, month)
+    default = f"{table}_default"
+
+    cur.execute(
+        f"SELECT EXISTS (SELECT 1 FROM {default} WHERE date_received >= %s AND date_received < %s);",
+        (start_ms, end_ms),
+    )
+    has_stray_rows = cur.fetchone()[0]
+    if has_stray_rows:
+        cols = ", ".join(_insertable_columns(cur, table))
+        cur.execute(f"CREATE TEMP TABLE _partition_move (LIKE {table}) ON COMMIT DROP;")
+        cur.execute(
+            f"""
+            WITH moved AS (
+                DELETE FROM {default} WHERE date_received >= %s AND date_received < %s
+                RETURNING {cols}
+            )
+            INSERT INTO _partition_move ({cols}) SELECT {cols} FROM moved;
+            """,
+            (start_ms, end_ms),
+        )
+    cur.execute(
+        f"CREATE TABLE {name} PARTITION OF {table} FOR VALUES FROM (%s) TO (%s);",
+        (start_ms, end_ms),
+    )
+    if has_stray_rows:
+        cur.execute(f"INSERT INTO {table} ({cols}) SELECT {cols} FROM _partition_move;")
+        cur.execute("DROP TABLE _partition_move;")
+    logger.info(f"Created partition {name}")
+    return True
+
+
+def ensure_partitions(cur, table: str, first: Tuple[int, int], last: Tuple[int, int]) -> int:
+    """Create every monthly partition between `first` and `last` (inclusive)."""
+    created = 0
+    year, month = first
+    while (year, month) <= last:
+        created += create_month_partition(cur, table, year, month)
+        year, month = month_start(year, month + 1)
+    return created
+
+
+def detach_old_partitions(cur, table: str, retention_months: int) -> List[str]:
+    """Detach partitions whose whole month is older than the retention window."""
+    now = datetime.now(timezone.utc)
+    cutoff = month_start(now.year, now.month - retention_months)
+    detached = []
+    for name, year, month in list_partitions(cur, table):
+        if (year, month) < cutoff:
+            cur.execute(f"ALTER TABLE {table} DETACH PARTITION {name};")
+            detached.append(name)
+            logger.info(f"Detached partition {name} (older than {retention_months} months)")
+    return detached
+
+
+def maintain_partitions(months_ahead: Optional[int] = None, retention_months: Optional[int] = None) -> Dict:
+    """Create upcoming partitions and detach expired ones for all partitioned tables.
+
+    Defaults come from PARTITION_MONTHS_AHEAD (3) and PARTITION_RETENTION_MONTHS
+    (unset = keep everything attached).
+    """
+    if months_ahead is None:
+        months_ahead = int(os.getenv("PARTITION_MONTHS_AHEAD", "3"))
+    if retention_months is None and os.getenv("PARTITION_RETENTION_MONTHS"):
+        retention_months = int(os.getenv("PARTITION_RETENTION_MONTHS"))
+
+    now = datetime.now(timezone.utc)
+    first = (now.year, now.month)
+    last = month_start(now.year, now.month + months_ahead)
+    summary = {"created": 0, "detached": []}
+    with connection() as conn:
+        for table in PARTITIONED_TABLES:
+            with conn.cursor() as cur:
+                cur.execute("SELECT pg_advisory_xact_lock(%s);", (PARTITION_LOCK_ID,))
+                summary["created"] += ensure_partitions(cur, table, first, last)
+                if retention_months is not None:
+                    summary["detached"].extend(detach_old_partitions(cur, table, retention_months))
+            conn.commit()
+    return summary
+
+
+if __name__ == "__main__":
+    from logging_config import setup_logging
+
+    setup_logging()
+    print(maintain_partitions())
@@ -0,0 +1,317 @@
+"""Decoding of raw /sync request bodies.
+
+Sync payloads are large and repetitive (the same sender IDs and near-identical
+bodies thousands of times), so clients may compress them and/or send
+MessagePack instead of JSON:
+
+- Content-Encoding: identity, gzip (or deflate) and zstd
+- Content-Type: application/json, or application/msgpack / application/x-msgpack
+
+JSON bytes are validated straight into `SmsSyncRequest` with pydantic's
+`model_validate_json`, which parses and validates in one pass without
+building an intermediate dict tree. zstd needs the optional `zstandard`
+package and MessagePack the optional `msgpack` package; without them those
+formats are rejected with 415.
+
+Decompression is capped at SYNC_MAX_DECOMPRESSED_BYTES so a small
+compressed body cannot expand without bound.
+
+`SyncStreamParser` and `iter_stream_text()` serve /sync/stream instead. They
+take the same JSON document incrementally and hand back the messages as
+they complete, so memory does not grow with the size of the upload.
+"""
+import codecs
+import io
+import json
+import os
+import re
+import zlib
+from typing import AsyncIterator, List, Optional
+from pydantic import ValidationError
+from schemas import SmsData, SmsSyncRequest
+
+try:
+    import zstandard
+except ImportError:  # optional dependency
+    zstandard = None
+
+try:
+    import msgpack
+except ImportError:  # optional dependency
+    msgpack = None
+
+SYNC_MAX_BODY_BYTES = int(os.getenv("SYNC_MAX_BODY_BYTES", str(50 * 1024 * 1024)))
+SYNC_MAX_DECOMPRESSED_BYTES = int(os.getenv("SYNC_MAX_DECOMPRESSED_BYTES", str(200 * 1024 * 1024)))
+# Largest single message (or other top-level value) /sync/stream will buffer
+SYNC_STREAM_MAX_ITEM_BYTES = int(os.getenv("SYNC_STREAM_MAX_ITEM_BYTES", str(1024 * 1024)))
+
+MSGPACK_TYPES = ("application/msgpack", "application/x-msgpack", "application/vnd.msgpack")
+
+
+class PayloadError(ValueError):
+    """A request body that cannot be decoded; `status_code` is the HTTP status to answer with."""
+
+    def __init__(self, status_code: int, detail):
+        super().__init__(str(detail))
+        self.status_code = status_code
+        self.detail = detail
+
+
+def _too_large() -> PayloadError:
+    return PayloadError(413, f"Decompressed payload exceeds {SYNC_MAX_DECOMPRESSED_BYTES} bytes")
+
+
+def decompress(body: bytes, content_encoding: Optional[str]) -> bytes:
+    """Undo Content-Encoding (identity, gzip, deflate, zstd) within the size cap."""
+    encoding = (content_encoding or "identity").strip().lower()
+    if encoding in ("", "identity"):
+        return body
+    if encoding in ("gzip", "x-gzip", "deflate"):
+        # wbits=47 auto-detects gzip and zlib headers
+        decompressor = zlib.decompressobj(wbits=47)
+        try:
+            data = decompressor.decompress(body, SYNC_MAX_DECOMPRESSED_BYTES + 1)
+        except zlib.error as e:
+            raise PayloadError(400, f"Invalid {encoding} body: {e}")
+        if len(data) > SYNC_MAX_DECOMPRESSED_BYTES:
+            raise _too_large()
+        return data
+    if encoding == "zstd":
+        if zstandard is None:
+            raise PayloadError(415, "zstd encoding requires the 'zstandard' package on the server")
+        try:
+            with zstandard.ZstdDecompressor().stream_reader(io.BytesIO(body)) as reader:
+                data = reader.read(SYNC_MAX_DECOMPRESSED_BYTES + 1)
+        except zstandard.ZstdError as e:
+            raise PayloadError(400, f"Invalid zstd body: {e}")
+        if len(data) > SYNC_MAX_DECOMPRESSED_BYTES:
+            raise _too_large()
+        return data
+    raise PayloadError(415, f"Unsupported Content-Encoding: {content_encoding}")
+
+
+def parse_sync_request(body: bytes, content_type: Optional[str]) -> SmsSyncRequest:
+    """Validate decoded bytes (JSON or MessagePack) into a SmsSyncRequest."""
+    media_type = (content_type or "application/json").split(";")[0].strip().lower()
+    try:
+        if media_type in MSGPACK_TYPES:
+            if msgpack is None:
+                raise PayloadError(415, "MessagePack bodies require the 'msgpack' package on the server")
+            try:
+                data = msgpack.unpackb(body, raw=False)
+            except (ValueError, TypeError, msgpack.UnpackException) as e:
+                raise PayloadError(400, f"Invalid MessagePack body: {e}")
+            return SmsSyncRequest.model_validate(data)
+        if media_type == "application/json" or media_type.endswith("+json"):
+            return SmsSyncRequest.model_validate_json(body)
+    except ValidationError as e:
+        # No `input`: for a malformed body it is the raw bytes, which are
+        # not JSON serializable and could be the whole upload
+        raise PayloadError(422, e.errors(include_url=False, include_context=False, include_input=False))
+    raise PayloadError(415, f"Unsupported Content-Type: {content_type}")
+
+
+def decode_sync_request(body: bytes, content_encoding: Optional[str], content_type: Optional[str]) -> SmsSyncRequest:
+    return parse_sync_request(decompress(body, content_encoding), content_type)
+
+
+async def read_body(request) -> bytes:
+    """Read a request body, refusing anything over SYNC_MAX_BODY_BYTES before buffering it all."""
+    declared = request.headers.get("content-length")
+    if declared and declared.isdigit() and int(declared) > SYNC_MAX_BODY_BYTES:
+        raise PayloadError(413, f"Request body exceeds {SYNC_MAX_BODY_BYTES} bytes")
+    chunks = []
+    size = 0
+    async for chunk in request.stream():
+        size += len(chunk)
+        if size > SYNC_MAX_BODY_BYTES:
+            raise PayloadError(413, f"Request body exceeds {SYNC_MAX_BODY_BYTES} bytes")
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+_decoder = json.JSONDecoder()
+
+
+class SyncStreamParser:
+    """Incremental parser for a `{"user_name": ..., "messages": [...]}` document.
+
+    `feed()` takes text as it arrives and returns the validated messages
+    completed so far; only the unparsed tail is kept between calls. The
+    user name has to come before the messages array unless the caller
+    already knows it (`user_name=`), since rows are written as they arrive.
+    """
+
+    def __init__(self, user_name: Optional[str] = None):
+        self.user_name = user_name
+        self.message_count = 0
+        self._buf = ""
+        self._pos = 0
+        self._state = "start"
+        self._key = None
+        self._seen_messages = False
+
+    def _skip_ws(self) -> bool:
+        """Advance past whitespace; False when the buffer ran out."""
+        self._pos = _WHITESPACE.match(self._buf, self._pos).end()
+        return self._pos < len(self._buf)
+
+    def _value(self, final: bool):
+        """Decode the JSON value at the cursor, or return (None, False) if it may be incomplete."""
+        try:
+            value, end = _decoder.raw_decode(self._buf, self._pos)
+        except json.JSONDecodeError as e:
+            if final:
+                raise PayloadError(400, f"Invalid JSON body: {e}")
+            if len(self._buf) - self._pos > SYNC_STREAM_MAX_ITEM_BYTES:
+                raise PayloadError(413, f"A single value exceeds {SYNC_STREAM_MAX_ITEM_BYTES} bytes")
+            return None, False
+        # A number or literal ending exactly at the buffer edge may continue in the next chunk
+        if end == len(self._buf) and not final:
+            return None, False
+        self._pos = end
+        return value, True
+
+    def _expect(self, allowed: str) -> str:
+        char = self._buf[self._pos]
+        if char not in allowed:
+            raise PayloadError(400, f"Invalid JSON body: unexpected {char!r}, expected one of {allowed!r}")
+        self._pos += 1
+        return char
+
+    def _message(self, item) -> SmsData:
+        try:
+            message = SmsData.model_validate(item)
+        except ValidationError as e:
+            errors = e.errors(include_url=False, include_context=False, include_input=False)
+            for error in errors:
+                error["loc"] = ("messages", self.message_count, *error["loc"])
+            raise PayloadError(422, errors)
+        self.message_count += 1
+        return message
+
+    def feed(self, text: str, final: bool = False) -> List[SmsData]:
+        """Consume more of the body; `final=True` marks the end of it."""
+        self._buf = self._buf[self._pos:] + text
+        self._pos = 0
+        messages = []
+        while self._state != "done" and self._skip_ws():
+            state = self._state
+            if state == "start":
+                self._expect("{")
+                self._state = "first_key"
+            elif state in ("first_key", "key"):
+                if state == "first_key" and self._buf[self._pos] == "}":
+                    self._pos += 1
+                    self._state = "done"
+                    continue
+                key, ok = self._value(final)
+                if not ok:
+                    break
+                if not isinstance(key, str):
+                    raise PayloadError(400, "Invalid JSON body: object keys must be strings")
+                self._key = key
+                self._state = "colon"
+            elif state == "colon":
+                self._expect(":")
+                self._state = "messages" if self._key == "messages" else "value"
+            elif state == "value":
+                value, ok = self._value(final)
+                if not ok:
+                    break
+                if self._key == "user_name":
+                    if not isinstance(value, str):
+                        raise PayloadError(422, [{"type": "string_type", "loc": ["user_name"], "msg": "Input should be a valid string"}])
+                    if self.user_name is not None and value != self.user_name:
+                        raise PayloadError(400, "user_name in the body does not match the user_name query parameter")
+                    self.user_name = value
+                self._state = "after_value"
+            elif state == "messages":
+                if self.user_name is None:
+                    raise PayloadError(400, "user_name must come before messages in a streamed body (or pass ?user_name=)")
+                self._expect("[")
+                self._seen_messages = True
+                self._state = "first_item"
+            elif state in ("first_item", "item"):
+                if state == "first_item" and self._buf[self._pos] == "]":
+                    self._pos += 1
+                    self._state = "after_value"
+                    continue
+                item, ok = self._value(final)
+                if not ok:
+                    break
+                messages.append(self._message(item))
+                self._state = "after_item"
+            elif state == "after_item":
+                self._state = "item" if self._expect(",]") == "," else "after_value"
+            elif state == "after_value":
+                self._state = "key" if self._expect(",}") == "," else "done"
+        if final:
+            if self._state != "done":
+                raise PayloadError(400, "Invalid JSON body: unexpected end of data")
+            if self._skip_ws():
+                raise PayloadError(400, "Invalid JSON body: extra data after the document")
+            if not self._seen_messages:
+                raise PayloadError(422, [{"type": "missing", "loc": ["messages"], "msg": "Field required"}])
+            if self.user_name is None:
+                raise PayloadError(422, [{"type": "missing", "loc": ["user_name"], "msg": "Field required"}])
+        return messages
+
+
+async def iter_stream_text(request) -> AsyncIterator[str]:
+    """Yield the request body as text, decompressed (identity/gzip/deflate) piece by piece.
+
+    zstd is not offered here: its incremental decompressor cannot bound the
+    output of a single input chunk.
+    """
+    encoding = (request.headers.get("content-encoding") or "identity").strip().lower()
+    media_type = (request.headers.get("content-type") or "application/json").split(";")[0].strip().lower()
+    if media_type != "application/json" and not media_type.endswith("+json"):
+        raise PayloadError(415, f"Unsupported Content-Type for streaming: {media_type}")
+    if encoding in ("", "identity"):
+        decompressor = None
+    elif encoding in ("gzip", "x-gzip", "deflate"):
+        decompressor = zlib.decompressobj(wbits=47)
+    else:
+        raise PayloadError(415, f"Unsupported Content-Encoding for streaming: {encoding}")
+    text = codecs.getincrementaldecoder("utf-8")()
+    try:
+        async for chunk in request.stream():
+            if decompressor is None:
+                yield text.decode(chunk)
+                continue
+            data = decompressor.decompress(chunk, SYNC_STREAM_MAX_ITEM_BYTES)
+            yield text.decode(data)
+            while decompressor.unconsumed_tail:
+                data = decompressor.decompress(decompressor.unconsumed_tail, SYNC_STREAM_MAX_ITEM_BYTES)
+                yield text.decode(data)
+        yield text.decode(b"", final=True)
+    except zlib.error as e:
+        raise PayloadError(400, f"Invalid {encoding} body: {e}")
+    except UnicodeDecodeError as e:
+        raise PayloadError(400, f"Invalid UTF-8 in body: {e}")
+
+
+async def iter_message_batches(parser: SyncStreamParser, texts: AsyncIterator[str], size: int) -> AsyncIterator[List[SmsData]]:
+    """Group the parser's messages into batches of `size`.
+
+    The first batch is always empty and arrives as soon as the user name is
+    known, so callers can authorize the request before any rows are written.
+    """
+    pending: List[SmsData] = []
+    announced = False
+    async for text in texts:
+        pending.extend(parser.feed(text))
+        if not announced and parser.user_name is not None:
+            announced = True
+            yield []
+        while len(pending) >= size:
+            yield pending[:size]
+            del pending[:size]
+    pending.extend(parser.feed("", final=True))
+    if not announced:
+        yield []
+    while pending:
+        yield pending[:size]
+        del pending[:size]
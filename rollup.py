@@ -0,0 +1,101 @@
+"""Daily spend rollup maintained alongside the transactions ledger.
+
+`daily_spend` holds one row per (user_name, day, bank, merchant,
+transaction_type) with the summed absolute amount and the transaction
+count. `convert.save_transaction()` adds each new transaction to it in the
+same database transaction, so summaries for any date range read a handful
+of rollup rows instead of scanning the ledger.
+
+Days are calendar days in APP_TIMEZONE (default UTC). NULL bank, merchant
+and transaction_type are stored as ''. After changing APP_TIMEZONE, or if
+transactions were written without going through `save_transaction()`,
+rebuild the table with `python rollup.py [--user NAME]`.
+"""
+from datetime import date, datetime
+from typing import Optional
+from zoneinfo import ZoneInfo
+from db import APP_TIMEZONE, connection
+from logging_config import get_logger
+from statements import register
+
+logger = get_logger("sms_sync.rollup")
+
+ADD_TRANSACTION = register(
+    "rollup_add_transaction",
+    """
+    INSERT INTO daily_spend (user_name, day, bank, merchant, transaction_type, total_amount, txn_count)
+    VALUES (
+        %s, (to_timestamp(%s / 1000.0) AT TIME ZONE %s)::date,
+        COALESCE(%s, ''), COALESCE(%s, ''), COALESCE(%s, ''), ABS(COALESCE(%s::numeric, 0)), 1
+    )
+    ON CONFLICT (user_name, day, bank, merchant, transaction_type)
+    DO UPDATE SET total_amount = daily_spend.total_amount + EXCLUDED.total_amount,
+                  txn_count = daily_spend.txn_count + 1
+    """,
+)
+
+_REBUILD_SQL = """
+    INSERT INTO daily_spend (user_name, day, bank, merchant, transaction_type, total_amount, txn_count)
+    SELECT user_name, (received_at AT TIME ZONE %s)::date,
+           COALESCE(bank, ''), COALESCE(merchant, ''), COALESCE(transaction_type, ''),
+           SUM(ABS(COALESCE(amount, 0))), COUNT(*)
+    FROM transactions
+    WHERE date_received IS NOT NULL{user_filter}
+    GROUP BY 1, 2, 3, 4, 5;
+"""
+
+
+def add_transaction_params(user_name: str, date_received: int, transaction_data: dict) -> tuple:
+    """Parameters for ADD_TRANSACTION from a converted transaction."""
+    return (
+        user_name,
+        date_received,
+        APP_TIMEZONE,
+        transaction_data.get("bank"),
+        transaction_data.get("merchant"),
+        transaction_data.get("transaction_type"),
+        transaction_data.get("amount"),
+    )
+
+
+def today() -> date:
+    """Current calendar day in APP_TIMEZONE."""
+    return datetime.now(ZoneInfo(APP_TIMEZONE)).date()
+
+
+def rebuild(cur, user_name: Optional[str] = None) -> int:
+    """Recompute daily_spend from transactions (one user or everyone); returns rollup rows written.
+
+    The table lock makes concurrent save_transaction() upserts wait until the
+    rebuild commits, so none of them is lost or counted twice.
+    """
+    cur.execute("LOCK TABLE daily_spend IN SHARE ROW EXCLUSIVE MODE;")
+    if user_name is None:
+        cur.execute("DELETE FROM daily_spend;")
+        cur.execute(_REBUILD_SQL.format(user_filter=""), (APP_TIMEZONE,))
+    else:
+        cur.execute("DELETE FROM daily_spend WHERE user_name = %s;", (user_name,))
+        cur.execute(_REBUILD_SQL.format(user_filter=" AND user_name = %s"), (APP_TIMEZONE, user_name))
+    return cur.rowcount
+
+
+def rebuild_daily_spend(user_name: Optional[str] = None) -> int:
+    """Backfill daily_spend in its own transaction."""
+    with connection() as conn:
+        with conn.cursor() as cur:
+            rows = rebuild(cur, user_name)
+        conn.commit()
+    logger.info(f"Rebuilt daily_spend for {user_name or 'all users'}: {rows} rollup rows")
+    return rows
+
+
+if __name__ == "__main__":
+    import argparse
+    from logging_config import setup_logging
+
+    parser = argparse.ArgumentParser(description="Rebuild the daily_spend rollup from transactions")
+    parser.add_argument("--user", help="only rebuild this user's rows")
+    args = parser.parse_args()
+
+    setup_logging()
+    print(f"daily_spend rows written: {rebuild_daily_spend(args.user)}")
@@ -1,7 +1,7 @@
 from fastapi import APIRouter, Depends, HTTPException, status, Request
 from pydantic import BaseModel
 from typing import Optional, List, Dict, Any
-from auth import basic_auth
+from auth import current_user
 from chat import chat_system
 from logging_config import get_logger
 from fastapi.templating import Jinja2Templates
@@ -41,7 +41,7 @@ class ChatResponse(BaseModel):
                   response_model=ChatResponse)
 def chat_with_transactions(
     request: ChatRequest,
-    auth_user: str = Depends(basic_auth)
+    auth_user: str = Depends(current_user)
 ):
     """
     Chat with your transaction data using natural language.
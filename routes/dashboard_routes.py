@@ -1,26 +1,39 @@
 from fastapi import APIRouter, Request, status, HTTPException, Depends
 from fastapi.templating import Jinja2Templates
-from db import get_db_connection, setup_database
-from auth import basic_auth
+from db import APP_TIMEZONE, LOCAL_TIME_SQL, async_connection
+from auth import current_user
 from logging_config import get_logger
+import rollup
 from typing import Optional
+from markupsafe import Markup, escape
+from psycopg.rows import dict_row
 import datetime
+import re
 
 dash_router = APIRouter()
 logger = get_logger("sms_sync.api")
 templates = Jinja2Templates(directory="templates")
 
-@dash_router.post("/setup-db", summary="Setup Database", status_code=status.HTTP_200_OK)
-def setup_db_api(_: str = Depends(basic_auth)):
-    try:
-        setup_database()
-        return {"message": "Database setup completed successfully."}
-    except Exception as e:
-        logger.error(f"Database setup failed: {e}")
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Database setup failed: {e}",
-        )
+# ts_headline markers; swapped for <mark> tags after the snippet is HTML-escaped
+HIGHLIGHT_START, HIGHLIGHT_STOP = "\x02", "\x03"
+HEADLINE_OPTIONS = (
+    f"StartSel={HIGHLIGHT_START}, StopSel={HIGHLIGHT_STOP}, MaxWords=30, MinWords=10, MaxFragments=2"
+)
+
+
+def build_prefix_tsquery(q: str) -> Optional[str]:
+    """Turn free text into a prefix-matching tsquery ('swig upi' -> 'swig:* & upi:*')."""
+    terms = re.findall(r"\w+", q.lower())
+    return " & ".join(f"{term}:*" for term in terms) or None
+
+
+def render_snippet(snippet: Optional[str]) -> Optional[Markup]:
+    """HTML-escape a ts_headline snippet and turn its markers into <mark> tags."""
+    if snippet is None:
+        return None
+    return Markup(
+        str(escape(snippet)).replace(HIGHLIGHT_START, "<mark>").replace(HIGHLIGHT_STOP, "</mark>")
+    )
 
 @dash_router.get("/", summary="Root Endpoint")
 def read_root(request: Request):
@@ -28,39 +41,21 @@ def read_root(request: Request):
     return templates.TemplateResponse("index.html", {"request": request})
 
 @dash_router.get("/dashboard", summary="User Dashboard")
-def user_dashboard(request: Request, auth_user: str = Depends(basic_auth)):
+async def user_dashboard(request: Request, auth_user: str = Depends(current_user)):
     logger.debug("Dashboard requested - rendering transactions dashboard")
-    conn = None
     try:
-        conn = get_db_connection()
-        with conn.cursor() as cur:
-            cur.execute(
-                """
-                SELECT user_name, bank, amount, transaction_type, merchant, date_received
+        async with async_connection(readonly=True) as conn, conn.cursor(row_factory=dict_row) as cur:
+            await cur.execute(
+                f"""
+                SELECT user_name, bank, amount::float8 AS amount, transaction_type, merchant,
+                       {LOCAL_TIME_SQL} AS date_received
                 FROM transactions
                 WHERE user_name = %s AND transaction_type NOT IN ('null', 'other')
-                ORDER BY date_received DESC;
+                ORDER BY transactions.date_received DESC;
                 """,
-                (auth_user,),
-            )
-            rows = cur.fetchall()
-        transactions = []
-        for r in rows:
-            # r[5] is date_received in milliseconds
-            try:
-                date_str = datetime.datetime.fromtimestamp(r[5] / 1000).strftime("%Y-%m-%d %H:%M:%S") if r[5] else None
-            except Exception:
-                date_str = None
-            transactions.append(
-                {
-                    "user_name": r[0],
-                    "bank": r[1],
-                    "amount": float(r[2]) if r[2] is not None else None,
-                    "transaction_type": r[3],
-                    "merchant": r[4],
-                    "date_received": date_str,
-                }
+                (APP_TIMEZONE, auth_user),
             )
+            transactions = await cur.fetchall()
         context = {
             "request": request,
             "transactions": transactions,
@@ -70,30 +65,95 @@ def user_dashboard(request: Request, auth_user: str = Depends(basic_auth)):
     except Exception as e:
         logger.exception("Error building transactions dashboard")
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Error building dashboard: {e}")
-    finally:
-        if conn:
-            conn.close()
+
+# groupby value -> daily_spend column
+SUMMARY_DIMENSIONS = {"day": "day", "bank": "bank", "merchant": "merchant", "type": "transaction_type"}
+
+
+@dash_router.get("/dashboard/summary", summary="Spending Summary")
+async def dashboard_summary(
+    start: Optional[datetime.date] = None,
+    end: Optional[datetime.date] = None,
+    groupby: str = "day",
+    transaction_type: Optional[str] = None,
+    auth_user: str = Depends(current_user),
+):
+    """Totals per day/bank/merchant/type for a date range, read from the daily_spend rollup.
+
+    Defaults to the last 30 days. Without `transaction_type`, covers the same
+    rows as the dashboard (everything except 'null'/'other').
+    """
+    column = SUMMARY_DIMENSIONS.get(groupby)
+    if column is None:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"groupby must be one of: {', '.join(SUMMARY_DIMENSIONS)}",
+        )
+    end = end or rollup.today()
+    start = start or end - datetime.timedelta(days=29)
+    where = ["user_name = %s", "day BETWEEN %s AND %s"]
+    params = [auth_user, start, end]
+    if transaction_type:
+        where.append("transaction_type = %s")
+        params.append(transaction_type)
+    else:
+        where.append("transaction_type NOT IN ('', 'null', 'other')")
+    order = "day" if column == "day" else "total_amount DESC"
+    try:
+        async with async_connection(readonly=True) as conn:
+            cur = await conn.execute(
+                f"SELECT {column}, SUM(total_amount) AS total_amount, SUM(txn_count) AS txn_count "
+                f"FROM daily_spend WHERE {' AND '.join(where)} GROUP BY {column} ORDER BY {order};",
+                params,
+            )
+            rows = await cur.fetchall()
+    except Exception as e:
+        logger.exception("Error building spending summary")
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Error building summary: {e}")
+    return {
+        "start": start.isoformat(),
+        "end": end.isoformat(),
+        "groupby": groupby,
+        "total_amount": float(sum(r[1] for r in rows)),
+        "txn_count": int(sum(r[2] for r in rows)),
+        "rows": [
+            {
+                groupby: r[0].isoformat() if column == "day" else (r[0] or None),
+                "total_amount": float(r[1]),
+                "txn_count": int(r[2]),
+            }
+            for r in rows
+        ],
+    }
 
 @dash_router.get("/db", summary="Database Browser")
-def view_db(
+async def view_db(
     request: Request,
     q: Optional[str] = None,
+    mode: str = "fts",
     address: Optional[str] = None,
     message_type: Optional[int] = None,
     start: Optional[str] = None,
     end: Optional[str] = None,
     page: int = 1,
     page_size: int = 25,
-    auth_user: str = Depends(basic_auth),
+    auth_user: str = Depends(current_user),
 ):
     logger.debug("DB browser requested - querying data for server render")
     if page < 1:
         page = 1
     if page_size < 1:
         page_size = 25
+    # "fts" uses the GIN-indexed search_tsv column; "substring" keeps the old ILIKE scan
+    if mode not in ("fts", "substring"):
+        mode = "fts"
+    tsquery = build_prefix_tsquery(q) if q and mode == "fts" else None
     where = ["user_name = %s"]
     params = [auth_user]
-    if q:
+    if tsquery:
+        where.append("search_tsv @@ to_tsquery('simple', %s)")
+        params.append(tsquery)
+    elif q:
         where.append("(address ILIKE %s OR body ILIKE %s)")
         like = f"%{q}%"
         params.extend([like, like])
@@ -111,21 +171,33 @@ def view_db(
         params.append(end)
     where_sql = (" WHERE " + " AND ".join(where)) if where else ""
     count_sql = f"SELECT COUNT(*) FROM sms_messages{where_sql};"
-    data_sql = (
-        "SELECT user_name, sms_id, address, body, date_received, message_type, created_at "
-        f"FROM sms_messages{where_sql} ORDER BY created_at DESC LIMIT %s OFFSET %s;"
-    )
     offset = (page - 1) * page_size
-    conn = None
+    if tsquery:
+        # Rank and page in the inner query so ts_headline only runs on the visible rows
+        data_sql = (
+            f"SELECT user_name, sms_id, address, body, {LOCAL_TIME_SQL}, message_type, created_at, "
+            "ts_headline('simple', COALESCE(body, ''), to_tsquery('simple', %s), %s) AS snippet "
+            "FROM ("
+            "SELECT user_name, sms_id, address, body, received_at, message_type, created_at, "
+            "ts_rank(search_tsv, to_tsquery('simple', %s)) AS rank "
+            f"FROM sms_messages{where_sql} ORDER BY rank DESC, created_at DESC LIMIT %s OFFSET %s"
+            ") ranked ORDER BY rank DESC, created_at DESC;"
+        )
+        data_params = [APP_TIMEZONE, tsquery, HEADLINE_OPTIONS, tsquery] + params + [page_size, offset]
+    else:
+        data_sql = (
+            f"SELECT user_name, sms_id, address, body, {LOCAL_TIME_SQL}, message_type, created_at, NULL AS snippet "
+            f"FROM sms_messages{where_sql} ORDER BY created_at DESC LIMIT %s OFFSET %s;"
+        )
+        data_params = [APP_TIMEZONE] + params + [page_size, offset]
     total = 0
     items = []
     try:
-        conn = get_db_connection()
-        with conn.cursor() as cur:
-            cur.execute(count_sql, params)
-            total = cur.fetchone()[0]
-            cur.execute(data_sql, params + [page_size, offset])
-            rows = cur.fetchall()
+        async with async_connection(readonly=True) as conn:
+            cur = await conn.execute(count_sql, params)
+            total = (await cur.fetchone())[0]
+            cur = await conn.execute(data_sql, data_params)
+            rows = await cur.fetchall()
         for row in rows:
             created_iso = row[6].isoformat() if row[6] else None
             items.append(
@@ -137,6 +209,7 @@ def view_db(
                     "date_received": row[4],
                     "message_type": row[5],
                     "created_at": created_iso,
+                    "snippet": render_snippet(row[7]),
                 }
             )
     except Exception as e:
@@ -145,9 +218,6 @@ def view_db(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"An error occurred while fetching DB data: {e}",
         )
-    finally:
-        if conn:
-            conn.close()
     pages = (total + page_size - 1) // page_size if page_size else 1
     context = {
         "request": request,
@@ -157,6 +227,7 @@ def view_db(
         "total": total,
         "pages": pages,
         "q": q or "",
+        "mode": mode,
         "address": address or "",
         "message_type": message_type,
         "start": start or "",
@@ -1,102 +1,191 @@
-from fastapi import APIRouter, status, HTTPException, Depends
-from db import get_db_connection
+from fastapi import APIRouter, status, HTTPException, Depends, Query
+from fastapi.responses import StreamingResponse
+from typing import AsyncIterator, Optional, Tuple
+from decimal import Decimal
+from psycopg.rows import dict_row
+from db import APP_TIMEZONE, LOCAL_TIME_SQL, async_connection, connection
 from schemas import SmsSyncRequest
-from auth import basic_auth
+from auth import current_user
+from pagination import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, decode_cursor, keyset_page
 from convert import convert_all_messages
 from psycopg2.extras import execute_batch
+import csv
 import datetime
+import io
+import json
+import os
 from logging_config import get_logger
 
 sms_transaction_router = APIRouter()
 logger = get_logger("sms_sync.api")
 
-@sms_transaction_router.get("/messages", summary="Get All SMS Messages")
-def get_all_messages(auth_user: str = Depends(basic_auth)):
-    """Fetch all SMS messages from the database and format the timestamp."""
-    conn = None
+
+def _keyset_filter(cursor: Optional[str]) -> Tuple[str, list]:
+    """SQL condition and params continuing after `cursor` (empty for the first page)."""
+    if not cursor:
+        return "", []
     try:
-        conn = get_db_connection()
-        with conn.cursor() as cur:
-            cur.execute(
-                "SELECT user_name, sms_id, address, body, date_received, message_type, created_at "
-                "FROM sms_messages WHERE user_name = %s ORDER BY created_at DESC;",
-                (auth_user,),
+        date_received, sms_id = decode_cursor(cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    return " AND (date_received, sms_id) < (%s, %s)", [date_received, sms_id]
+
+
+def _row_key(row: dict) -> Tuple[int, int]:
+    return row["date_received_ms"], row["sms_id"]
+
+
+@sms_transaction_router.get("/messages", summary="Get SMS Messages")
+async def get_all_messages(
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    auth_user: str = Depends(current_user),
+):
+    """Fetch one page of SMS messages, newest first.
+
+    Pass the returned `next_cursor` as `cursor` to get the following page;
+    it is null on the last page.
+    """
+    keyset_sql, keyset_params = _keyset_filter(cursor)
+    try:
+        async with async_connection(readonly=True) as conn, conn.cursor(row_factory=dict_row) as cur:
+            await cur.execute(
+                "SELECT user_name, sms_id, address, body, "
+                f"{LOCAL_TIME_SQL} AS date_received, date_received AS date_received_ms, "
+                "message_type, category, created_at "
+                f"FROM sms_messages WHERE user_name = %s AND date_received IS NOT NULL{keyset_sql} "
+                "ORDER BY sms_messages.date_received DESC, sms_id DESC LIMIT %s;",
+                [APP_TIMEZONE, auth_user, *keyset_params, limit + 1],
             )
-            rows = cur.fetchall()
-            messages = []
-            for row in rows:
-                timestamp_ms = row[4]
-                date_object = datetime.datetime.fromtimestamp(timestamp_ms / 1000)
-                formatted_date = date_object.strftime("%Y-%m-%d %H:%M:%S")
-
-                messages.append(
-                    {
-                        "user_name": row[0],
-                        "sms_id": row[1],
-                        "address": row[2],
-                        "body": row[3],
-                        "date_received": formatted_date,
-                        "message_type": row[5],
-                        "created_at": row[6].isoformat() if row[6] else None,
-                    }
-                )
-        return {"messages": messages, "count": len(messages)}
+            messages, next_cursor = keyset_page(await cur.fetchall(), limit, _row_key)
+        return {"messages": messages, "count": len(messages), "next_cursor": next_cursor}
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"An error occurred while fetching messages: {e}",
         )
-    finally:
-        if conn:
-            conn.close()
-
-@sms_transaction_router.get("/transactions", summary="Get All Transactions")
-def get_all_transactions(auth_user: str = Depends(basic_auth)):
-    """Fetch all transactions from the database for the authenticated user."""
-    conn = None
+
+@sms_transaction_router.get("/transactions", summary="Get Transactions")
+async def get_all_transactions(
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    auth_user: str = Depends(current_user),
+):
+    """Fetch one page of transactions for the authenticated user, newest first.
+
+    Paginated like GET /messages via `limit`, `cursor` and `next_cursor`.
+    """
+    keyset_sql, keyset_params = _keyset_filter(cursor)
     try:
-        conn = get_db_connection()
-        with conn.cursor() as cur:
-            cur.execute(
-                """
-                SELECT user_name, sms_id, address, bank, amount, transaction_type, 
-                       merchant, created_at, date_received
+        async with async_connection(readonly=True) as conn, conn.cursor(row_factory=dict_row) as cur:
+            await cur.execute(
+                f"""
+                SELECT user_name, sms_id, bank, amount::float8 AS amount, transaction_type, merchant,
+                       {LOCAL_TIME_SQL} AS date_received, date_received AS date_received_ms
                 FROM transactions 
                 WHERE user_name = %s and transaction_type not in ('null', 'other')
-                ORDER BY created_at DESC;
+                AND date_received IS NOT NULL{keyset_sql}
+                ORDER BY transactions.date_received DESC, sms_id DESC
+                LIMIT %s;
                 """,
-                (auth_user,),
+                [APP_TIMEZONE, auth_user, *keyset_params, limit + 1],
             )
-            rows = cur.fetchall()
-            transactions = []
-            for row in rows:
-                date_object = datetime.datetime.fromtimestamp(row[8] / 1000)
-                transactions.append({
-                    "user_name": row[0],
-                    "bank": row[3],
-                    "amount": float(row[4]) if row[4] else None,
-                    "transaction_type": row[5],
-                    "merchant": row[6],
-                    "date_received": date_object.strftime("%Y-%m-%d %H:%M:%S")
-                })
-        return {"transactions": transactions, "count": len(transactions)}
+            transactions, next_cursor = keyset_page(await cur.fetchall(), limit, _row_key)
+        return {"transactions": transactions, "count": len(transactions), "next_cursor": next_cursor}
     except Exception as e:
         logger.error(f"Error fetching transactions: {e}")
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"An error occurred while fetching transactions: {e}",
         )
-    finally:
-        if conn:
-            conn.close()
+
+EXPORT_FORMATS = {"csv": "text/csv", "ndjson": "application/x-ndjson"}
+EXPORT_COLUMNS = [
+    "user_name", "sms_id", "address", "bank", "amount", "transaction_type",
+    "merchant", "date_received", "received_at", "created_at",
+]
+# Rows fetched from the server-side cursor per round trip / response chunk
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "2000"))
+
+
+def _export_value(value):
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    return value
+
+
+def _encode_batch(rows: list, fmt: str) -> bytes:
+    if fmt == "csv":
+        buf = io.StringIO()
+        csv.writer(buf).writerows([[_export_value(v) for v in row] for row in rows])
+        return buf.getvalue().encode()
+    return "".join(
+        json.dumps(dict(zip(EXPORT_COLUMNS, map(_export_value, row))), ensure_ascii=False) + "\n"
+        for row in rows
+    ).encode()
+
+
+async def _stream_export(sql: str, params: list, fmt: str) -> AsyncIterator[bytes]:
+    """Yield an export chunk per batch read from a named (server-side) cursor.
+
+    Only one batch is in memory at a time. The CSV header goes out before
+    the query runs, so the client sees the first byte immediately.
+    """
+    if fmt == "csv":
+        yield (",".join(EXPORT_COLUMNS) + "\r\n").encode()
+    rows_sent = 0
+    try:
+        async with async_connection(readonly=True) as conn:
+            async with conn.cursor(name="transactions_export") as cur:
+                await cur.execute(sql, params)
+                while True:
+                    rows = await cur.fetchmany(EXPORT_BATCH_SIZE)
+                    if not rows:
+                        break
+                    rows_sent += len(rows)
+                    yield _encode_batch(rows, fmt)
+    except Exception:
+        # Headers are already sent; all we can do is cut the stream short
+        logger.exception(f"Transaction export aborted after {rows_sent} rows")
+        raise
+    logger.info(f"Transaction export finished: {rows_sent} rows as {fmt}")
+
+
+def _export_response(sql: str, params: list, fmt: str, filename: str) -> StreamingResponse:
+    if fmt not in EXPORT_FORMATS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"format must be one of: {', '.join(EXPORT_FORMATS)}",
+        )
+    return StreamingResponse(
+        _stream_export(sql, params, fmt),
+        media_type=EXPORT_FORMATS[fmt],
+        headers={"Content-Disposition": f'attachment; filename="{filename}.{fmt}"'},
+    )
+
+
+@sms_transaction_router.get("/transactions/export", summary="Export Transactions")
+async def export_transactions(format: str = "csv", auth_user: str = Depends(current_user)):
+    """Stream every transaction of the authenticated user as CSV or NDJSON, newest first."""
+    return _export_response(
+        f"""
+        SELECT {", ".join(EXPORT_COLUMNS)}
+        FROM transactions
+        WHERE user_name = %s and transaction_type not in ('null', 'other')
+        ORDER BY date_received DESC, sms_id DESC;
+        """,
+        [auth_user],
+        format,
+        "transactions",
+    )
 
 @sms_transaction_router.get("/admin/transactions", summary="Get All Transactions (Admin)")
-def get_all_transactions_admin(_: str = Depends(basic_auth)):
+def get_all_transactions_admin(_: str = Depends(current_user)):
     """Admin endpoint to fetch all transactions from all users."""
-    conn = None
     try:
-        conn = get_db_connection()
-        with conn.cursor() as cur:
+        with connection(readonly=True) as conn, conn.cursor() as cur:
             cur.execute(
                 """
                 SELECT user_name, sms_id, address, bank, amount, transaction_type, 
@@ -125,6 +214,18 @@ def get_all_transactions_admin(_: str = Depends(basic_auth)):
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"An error occurred while fetching transactions: {e}",
         )
-    finally:
-        if conn:
-            conn.close()
+
+@sms_transaction_router.get("/admin/transactions/export", summary="Export All Transactions (Admin)")
+async def export_transactions_admin(format: str = "csv", _: str = Depends(current_user)):
+    """Stream the transactions of all users as CSV or NDJSON."""
+    # Index order, so rows start flowing without sorting the whole table first
+    return _export_response(
+        f"""
+        SELECT {", ".join(EXPORT_COLUMNS)}
+        FROM transactions
+        ORDER BY user_name, date_received DESC;
+        """,
+        [],
+        format,
+        "transactions-all",
+    )
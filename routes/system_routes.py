@@ -1,19 +1,36 @@
-from fastapi import APIRouter, status, HTTPException, Depends
-from db import get_db_connection, setup_database
-from schemas import SmsSyncRequest
-from auth import basic_auth
+from fastapi import APIRouter, status, HTTPException, Depends, Request
+from fastapi.concurrency import run_in_threadpool
+from typing import Optional
+import os
+from db import async_connection, get_pool_stats, setup_database
+from statements import get_statement_stats
+from ingest import INGEST_MODES, SYNC_STREAM_CHUNK_SIZE, get_sync_progress, ingest_messages, ingest_stream, sync_cursor
+from payloads import (
+    PayloadError,
+    SyncStreamParser,
+    decode_sync_request,
+    iter_message_batches,
+    iter_stream_text,
+    read_body,
+)
+from auth import current_user, get_auth_cache_stats, optional_user
 from convert import convert_all_messages
-from psycopg2.extras import execute_batch
+from sms_templates import get_template_stats
+from shapes import get_shape_stats
+from llm_cache import get_llm_cache_stats
+from llm_provider import get_llm_limiter_stats
 from logging_config import get_logger
 
 system_router = APIRouter()
 logger = get_logger("sms_sync.api")
 
+SYNC_REQUIRE_AUTH = os.getenv("SYNC_REQUIRE_AUTH", "0").lower() in ("1", "true", "yes")
+
 @system_router.post("/setup-db", summary="Setup Database", status_code=status.HTTP_200_OK)
-def setup_db_api(_: str = Depends(basic_auth)):
+def setup_db_api(_: str = Depends(current_user)):
     try:
-        setup_database()
-        return {"message": "Database setup completed successfully."}
+        version = setup_database()
+        return {"message": "Database setup completed successfully.", "schema_version": version}
     except Exception as e:
         logger.error(f"Database setup failed: {e}")
         raise HTTPException(
@@ -21,51 +38,164 @@ def setup_db_api(_: str = Depends(basic_auth)):
             detail=f"Database setup failed: {e}",
         )
 
+@system_router.get("/pool-stats", summary="Database Pool Statistics")
+def pool_stats_api(_: str = Depends(current_user)):
+    """Report connection pool usage (in-use, idle, waiting, wait times), prepared statement, auth cache, SMS template, learned shape, LLM cache and LLM quota counters."""
+    return {
+        **get_pool_stats(),
+        "prepared_statements": get_statement_stats(),
+        "auth_cache": get_auth_cache_stats(),
+        "sms_templates": get_template_stats(),
+        "sms_shapes": get_shape_stats(),
+        "llm_cache": get_llm_cache_stats(),
+        "llm_limits": get_llm_limiter_stats(),
+    }
+
+def _check_sync_user(auth_user: Optional[str], user_name: str) -> None:
+    """Apply the /sync credential rules to a request for `user_name`'s data."""
+    if auth_user is None and SYNC_REQUIRE_AUTH:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Unauthorized",
+            headers={"WWW-Authenticate": "Basic"},
+        )
+    if auth_user is not None and auth_user != user_name:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Cannot sync messages for another user")
+
+def _check_read_user(auth_user: str, user_name: str) -> None:
+    """Sync state is only readable by its own user, whatever SYNC_REQUIRE_AUTH says."""
+    if auth_user != user_name:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Cannot read another user's sync state")
+
+@system_router.get("/sync/cursor", summary="Sync Cursor")
+async def get_sync_cursor(user_name: str, auth_user: str = Depends(current_user)):
+    """
+    Returns the user's high-water mark: the largest date_received and sms_id
+    already stored (null before the first sync). Clients upload only newer
+    messages. Reads the primary, never the replica, so a lagging replica
+    can't make the client re-send rows. Requires credentials for `user_name`.
+    """
+    _check_read_user(auth_user, user_name)
+    try:
+        async with async_connection() as conn:
+            cursor = await sync_cursor(conn, user_name)
+        return {"user_name": user_name, **cursor}
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"An error occurred while reading the sync cursor: {e}",
+        )
+
 @system_router.post("/sync", status_code=status.HTTP_202_ACCEPTED, summary="Sync SMS Messages")
-def sync_sms_messages(payload: SmsSyncRequest):
+async def sync_sms_messages(
+    request: Request,
+    mode: Optional[str] = None,
+    auth_user: Optional[str] = Depends(optional_user),
+):
     """
     Receives a list of SMS messages and inserts new ones into the database.
     It uses 'ON CONFLICT DO NOTHING' to efficiently ignore duplicates.
+    Large payloads are loaded with COPY and merged in a single statement
+    (`mode=copy|batch` overrides the automatic choice).
+    The body is a SmsSyncRequest as JSON or MessagePack, optionally gzip or
+    zstd compressed (see payloads.py).
+    A session token or Basic credentials, when sent, must belong to
+    `payload.user_name`; SYNC_REQUIRE_AUTH=1 makes them mandatory.
+    With credentials, the response carries the user's new sync cursor
+    (see GET /sync/cursor); anonymous syncs don't get one.
+    """
+    try:
+        body = await read_body(request)
+        payload = await run_in_threadpool(
+            decode_sync_request,
+            body,
+            request.headers.get("content-encoding"),
+            request.headers.get("content-type"),
+        )
+    except PayloadError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+    _check_sync_user(auth_user, payload.user_name)
+    if mode is not None and mode not in INGEST_MODES:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"mode must be one of: {', '.join(INGEST_MODES)}",
+        )
+    rows = [(msg.id, msg.address, msg.body, msg.date, msg.type) for msg in payload.messages]
+    with_cursor = auth_user is not None and auth_user == payload.user_name
+    try:
+        if not rows:
+            result = {
+                "message": "No new messages to sync.",
+                "received_count": 0,
+                "inserted_count": 0,
+                "duplicate_count": 0,
+            }
+            if with_cursor:
+                async with async_connection() as conn:
+                    result["cursor"] = await sync_cursor(conn, payload.user_name)
+            return result
+        async with async_connection() as conn:
+            counts = await ingest_messages(conn, payload.user_name, rows, mode, with_cursor=with_cursor)
+        return {"message": "Sync completed successfully.", **counts}
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"An error occurred while syncing data: {e}",
+        )
+
+@system_router.post("/sync/stream", status_code=status.HTTP_202_ACCEPTED, summary="Streamed Sync of SMS Messages")
+async def stream_sync_sms_messages(
+    request: Request,
+    user_name: Optional[str] = None,
+    mode: Optional[str] = None,
+    auth_user: Optional[str] = Depends(optional_user),
+):
     """
-    insert_sql = """
-        INSERT INTO sms_messages (user_name, sms_id, address, body, date_received, message_type)
-        VALUES (%s, %s, %s, %s, %s, %s)
-        ON CONFLICT (sms_id, user_name) DO NOTHING;
+    Same JSON body as /sync (identity or gzip), parsed incrementally and
+    written in chunks of SYNC_STREAM_CHUNK_SIZE messages, each committed on
+    its own. Memory use does not grow with the upload. `user_name` must come
+    before `messages` in the body, or be passed as a query parameter.
+    If the upload fails part way, the chunks already committed stay; resume
+    from GET /sync/cursor. Progress is visible at GET /sync/progress.
     """
-    data_to_insert = [
-        (payload.user_name, msg.id, msg.address, msg.body, msg.date, msg.type)
-        for msg in payload.messages
-    ]
-    if not data_to_insert:
-        return {"message": "No new messages to sync.", "inserted_count": 0}
-    conn = None
+    if mode is not None and mode not in INGEST_MODES:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"mode must be one of: {', '.join(INGEST_MODES)}",
+        )
+    parser = SyncStreamParser(user_name)
+    batches = iter_message_batches(parser, iter_stream_text(request), SYNC_STREAM_CHUNK_SIZE)
     try:
-        conn = get_db_connection()
-        with conn.cursor() as cur:
-            execute_batch(cur, insert_sql, data_to_insert)
-            inserted_count = cur.rowcount
-            conn.commit()
-        return {
-            "message": "Sync completed successfully.",
-            "received_count": len(payload.messages),
-            "inserted_count": inserted_count,
-        }
+        await anext(batches)  # empty; the user name is known from here on
+        _check_sync_user(auth_user, parser.user_name)
+        chunks = ([(msg.id, msg.address, msg.body, msg.date, msg.type) for msg in batch] async for batch in batches)
+        counts = await ingest_stream(parser.user_name, chunks, mode, with_cursor=auth_user is not None and auth_user == parser.user_name)
+    except PayloadError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+    except HTTPException:
+        raise
     except Exception as e:
-        if conn:
-            conn.rollback()
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"An error occurred while syncing data: {e}",
         )
     finally:
-        if conn:
-            conn.close()
+        await batches.aclose()
+    return {"message": "Sync completed successfully.", **counts}
+
+@system_router.get("/sync/progress", summary="Streamed Sync Progress")
+def sync_progress(user_name: str, auth_user: str = Depends(current_user)):
+    """Streamed syncs of `user_name` currently running in this worker process."""
+    _check_read_user(auth_user, user_name)
+    return {"user_name": user_name, "in_flight": get_sync_progress(user_name)}
 
-@system_router.api_route("/convert", methods=["GET", "POST"], summary="Convert SMS Messages to Transactions", status_code=status.HTTP_200_OK)
-def convert_sms_to_transactions(_: str = Depends(basic_auth)):
+@system_router.post("/convert", summary="Convert SMS Messages to Transactions", status_code=status.HTTP_200_OK)
+def convert_sms_to_transactions(_: str = Depends(current_user)):
     """
     Admin API endpoint to convert all unprocessed SMS messages to transaction data.
     This processes all users' data, not just the authenticated user's data.
+    POST only: it starts a paid LLM run, and the SameSite=Lax session cookie
+    is still sent on cross-site GET navigations.
     """
     logger.info("Convert API called - starting SMS to transaction conversion")
     try:
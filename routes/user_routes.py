@@ -1,7 +1,7 @@
-from fastapi import APIRouter, status, HTTPException, Depends
-from db import get_db_connection
-from schemas import UserCreate
-from auth import basic_auth
+from fastapi import APIRouter, status, HTTPException, Depends, Response
+from db import connection
+from schemas import UserCreate, UserLogin
+from auth import SESSION_COOKIE, TOKEN_TTL, authenticate_password, issue_token
 from logging_config import get_logger
 
 user_router = APIRouter()
@@ -18,26 +18,47 @@ def register_user(payload: UserCreate):
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Username and password are required")
 
     pw_hash = hash_password(password)
-    conn = None
     try:
-        conn = get_db_connection()
-        with conn.cursor() as cur:
-            cur.execute(
-                """
-                INSERT INTO users (username, password_hash)
-                VALUES (%s, %s)
-                ON CONFLICT (username) DO NOTHING;
-                """,
-                (username, pw_hash),
-            )
-            if cur.rowcount == 0:
-                raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Username already exists")
-        conn.commit()
+        with connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    """
+                    INSERT INTO users (username, password_hash)
+                    VALUES (%s, %s)
+                    ON CONFLICT (username) DO NOTHING;
+                    """,
+                    (username, pw_hash),
+                )
+                if cur.rowcount == 0:
+                    raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Username already exists")
+            conn.commit()
         return {"message": "User registered successfully"}
     except HTTPException:
         raise
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Registration failed: {e}")
-    finally:
-        if conn:
-            conn.close()
+
+
+@user_router.post("/login", summary="Get a session token")
+async def login(payload: UserLogin, response: Response):
+    """Verify the password once and return a signed session token.
+
+    Send it as `Authorization: Bearer <token>` (or rely on the `session`
+    cookie set here) instead of Basic credentials until it expires; token
+    requests skip the database lookup and bcrypt entirely.
+    """
+    if not await authenticate_password(payload.username, payload.password):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid username or password",
+        )
+    token = issue_token(payload.username)
+    response.set_cookie(SESSION_COOKIE, token, max_age=TOKEN_TTL, httponly=True, samesite="lax")
+    logger.info(f"Issued session token for {payload.username}")
+    return {"access_token": token, "token_type": "bearer", "expires_in": TOKEN_TTL}
+
+
+@user_router.post("/logout", summary="Clear the session cookie")
+def logout(response: Response):
+    response.delete_cookie(SESSION_COOKIE)
+    return {"message": "Logged out"}
@@ -25,6 +25,12 @@ class UserCreate(BaseModel):
     password: str
 
 
+class UserLogin(BaseModel):
+    """Schema for exchanging credentials for a session token."""
+    username: str
+    password: str
+
+
 # Transaction schemas
 class Transaction(BaseModel):
     """Schema representing a single parsed transaction."""
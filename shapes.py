@@ -0,0 +1,429 @@
+"""Learned SMS "shapes": reuse one LLM extraction for every repeat of a template.
+
+Banks send the same wording millions of times; only amounts, dates,
+reference numbers and sometimes the payee change. A message's shape key is
+its sender header plus its text with those parts masked:
+
+    AX-HDFCBK-S  "Sent Rs.36.00 From HDFC Bank A/C *1234 To BMTC BUS KA57F2456 On 01/05/24 Ref 412345678901"
+    -> HDFCBK|Sent <AMT> From HDFC Bank A/C *<NUM> To BMTC BUS KA<NUM>F<NUM> On <DATE> Ref <REF>
+
+When the LLM has extracted a message, `learn()` turns that instance into a
+regex over the same shape: masked parts become wildcards, the amount the
+LLM returned becomes the `amount` group and the merchant's span becomes the
+`merchant` group. Bank and transaction type are fixed wording, so they are
+stored as constants. The mapping is only kept if re-applying it to the
+instance reproduces the LLM's answer; otherwise the shape stays unlearned
+and the next instance is sent to the LLM again.
+
+The payee is not masked in the key (where it is in the text is only known
+once the LLM has said what it is), so "To SWIGGY" and "To BMTC BUS" have
+different keys. When the exact key is unknown, the learned regexes with a
+`merchant` group for the same sender header are tried instead, busiest
+first (at most SHAPE_HEADER_CANDIDATES; the list is reread from the table
+every SHAPE_HEADER_REFRESH_SECONDS).
+
+Shapes live in `sms_shapes` (shared by every process) with an in-process
+LRU in front. Hit counts are flushed to the table once per conversion
+round. `get_shape_stats()` (under `sms_shapes` in /pool-stats) reports the
+hit rate and LLM calls avoided; `python shapes.py` lists the busiest shapes.
+"""
+import hashlib
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+from db import connection
+from logging_config import get_logger
+from sms_templates import sender_header
+from statements import execute as execute_prepared, register
+
+logger = get_logger("sms_sync.shapes")
+
+SHAPE_CACHE_ENABLED = os.getenv("SHAPE_CACHE_ENABLED", "1").lower() not in ("0", "false", "no")
+SHAPE_CACHE_MAX_SIZE = int(os.getenv("SHAPE_CACHE_MAX_SIZE", "10000"))
+SHAPE_HEADER_CANDIDATES = int(os.getenv("SHAPE_HEADER_CANDIDATES", "200"))
+SHAPE_HEADER_REFRESH_SECONDS = float(os.getenv("SHAPE_HEADER_REFRESH_SECONDS", "60"))
+
+# Masked parts of a message, tried in this order at each position
+_AMOUNT = r"(?:Rs\.?|INR|₹)\s*\d[\d,]*(?:\.\d+)?"
+_DATE = r"\d{1,4}[-/.](?:\d{1,2}|[A-Za-z]{3})[-/.]\d{2,4}(?:[ :T,]+\d{1,2}:\d{2}(?::\d{2})?)?"
+# UPI / UTR / IMPS references: long alphanumeric runs with a digit in them
+_REF = r"\b(?=[A-Za-z]*\d)[A-Za-z0-9]{10,}\b"
+_NUMBER = r"\d+"
+_SLOTS = (("AMT", _AMOUNT), ("DATE", _DATE), ("REF", _REF), ("NUM", _NUMBER))
+_SLOT = re.compile("|".join(f"(?P<{kind}>{pattern})" for kind, pattern in _SLOTS), re.IGNORECASE)
+_SLOT_PATTERNS = dict(_SLOTS)
+_AMOUNT_GROUP = r"(?:Rs\.?|INR|₹)\s*(?P<amount>\d[\d,]*(?:\.\d+)?)"
+_AMOUNT_DIGITS = re.compile(r"\d[\d,]*(?:\.\d+)?")
+_WHITESPACE_RUN = re.compile(r"\s+")
+
+SHAPE_LOOKUP = register(
+    "shape_lookup",
+    """
+    SELECT template, pattern, bank, transaction_type, merchant
+    FROM sms_shapes WHERE shape_key = %s
+    """,
+)
+# Served by idx_sms_shapes_sender_header
+SHAPE_HEADER_LOOKUP = register(
+    "shape_header_lookup",
+    """
+    SELECT shape_key, template, pattern, bank, transaction_type, merchant
+    FROM sms_shapes WHERE sender_header = %s
+    ORDER BY hits DESC LIMIT %s
+    """,
+)
+SHAPE_INSERT = register(
+    "shape_insert",
+    """
+    INSERT INTO sms_shapes (shape_key, sender_header, template, pattern, bank, transaction_type, merchant)
+    VALUES (%s, %s, %s, %s, %s, %s, %s)
+    ON CONFLICT (shape_key) DO NOTHING
+    """,
+)
+
+
+def _normalize(text: str) -> str:
+    return _WHITESPACE_RUN.sub(" ", text or "").strip()
+
+
+def _segments(text: str) -> List[Tuple[Optional[str], int, int]]:
+    """(slot kind or None for literal text, start, end) covering all of `text`."""
+    segments = []
+    pos = 0
+    for match in _SLOT.finditer(text):
+        if match.start() > pos:
+            segments.append((None, pos, match.start()))
+        segments.append((match.lastgroup, match.start(), match.end()))
+        pos = match.end()
+    if pos < len(text):
+        segments.append((None, pos, len(text)))
+    return segments
+
+
+def shape_of(address: Optional[str], text: str) -> Tuple[str, str]:
+    """(shape_key, masked template) of a message."""
+    text = _normalize(text)
+    masked = "".join(text[start:end] if kind is None else f"<{kind}>" for kind, start, end in _segments(text))
+    template = f"{sender_header(address or '')}|{masked}"
+    return hashlib.sha1(template.encode("utf-8")).hexdigest(), template
+
+
+def _amount_value(raw: str) -> Optional[float]:
+    try:
+        return float(raw.replace(",", ""))
+    except ValueError:
+        return None
+
+
+def _slot_amount(raw: str) -> Optional[float]:
+    """Value of an <AMT> part such as "Rs.1,250.00"."""
+    match = _AMOUNT_DIGITS.search(raw)
+    return _amount_value(match.group(0)) if match else None
+
+
+def _same_amount(a: Optional[float], b: Optional[float]) -> bool:
+    return a is not None and b is not None and abs(a - b) < 0.005
+
+
+class Shape:
+    """A learned mapping from one message shape to transaction fields."""
+
+    def __init__(self, key: str, template: str, pattern: str, bank: Optional[str],
+                 transaction_type: Optional[str], merchant: Optional[str]):
+        self.key = key
+        self.template = template
+        self.pattern = pattern
+        self.regex = re.compile(pattern, re.IGNORECASE)
+        self.bank = bank
+        self.transaction_type = transaction_type
+        self.merchant = merchant
+
+    @property
+    def payee_varies(self) -> bool:
+        """True if the merchant is read from the text, so the shape fits other payees too."""
+        return "merchant" in self.regex.groupindex
+
+    def apply(self, text: str) -> Optional[Dict]:
+        """Fields of a message with this shape, or None if it does not fit."""
+        match = self.regex.fullmatch(_normalize(text))
+        if not match:
+            return None
+        fields = match.groupdict()
+        amount = _amount_value(fields["amount"]) if fields.get("amount") else None
+        merchant = fields["merchant"].strip() if fields.get("merchant") else self.merchant
+        return {
+            "bank": self.bank,
+            "amount": amount,
+            "transaction_type": self.transaction_type,
+            "merchant": merchant,
+        }
+
+
+def derive(address: Optional[str], text: str, fields: Dict) -> Optional[Shape]:
+    """Shape learned from one extracted instance, or None if it cannot be generalized."""
+    key, template = shape_of(address, text)
+    text = _normalize(text)
+    amount = fields.get("amount")
+    if amount is not None:
+        try:
+            amount = float(amount)
+        except (TypeError, ValueError):
+            return None
+    merchant = _normalize(fields.get("merchant") or "") or None
+    merchant_span = None
+    merchant_constant = None
+    if merchant:
+        start = text.lower().find(merchant.lower())
+        if start >= 0:
+            merchant_span = (start, start + len(merchant))
+        else:
+            # Not copied from the text (e.g. normalized by the LLM): the
+            # fixed wording implies it, so it is the same for the whole shape
+            merchant_constant = fields.get("merchant")
+
+    parts = []
+    amount_found = amount is None
+    in_merchant = False
+    for kind, start, end in _segments(text):
+        if merchant_span:
+            span_start, span_end = merchant_span
+            if kind is not None and (start < span_start < end or start < span_end < end):
+                return None  # merchant boundary inside a masked part
+            if kind is None and start < span_start < end:
+                parts.append(re.escape(text[start:span_start]))
+                start = span_start
+            if start >= span_start and end <= span_end:
+                if not in_merchant:
+                    parts.append(r"(?P<merchant>.+?)")
+                    in_merchant = True
+                continue
+            if kind is None and start < span_end < end:
+                if not in_merchant:
+                    parts.append(r"(?P<merchant>.+?)")
+                    in_merchant = True
+                start = span_end
+        if kind is None:
+            parts.append(re.escape(text[start:end]))
+        elif kind == "AMT" and not amount_found and _same_amount(_slot_amount(text[start:end]), amount):
+            parts.append(_AMOUNT_GROUP)
+            amount_found = True
+        else:
+            parts.append(f"(?:{_SLOT_PATTERNS[kind]})")
+    if not amount_found:
+        return None
+
+    shape = Shape(key, template, "".join(parts), fields.get("bank"), fields.get("transaction_type"), merchant_constant)
+    # Only keep mappings that reproduce the extraction they were learned from
+    replay = shape.apply(text)
+    if (
+        replay is None
+        or (amount is not None and not _same_amount(replay["amount"], amount))
+        or (replay["merchant"] or "").lower() != (merchant or "").lower()
+    ):
+        return None
+    return shape
+
+
+class ShapeCache:
+    """sms_shapes with an in-process LRU in front, plus hit counters."""
+
+    def __init__(self, max_size: int = SHAPE_CACHE_MAX_SIZE):
+        self.max_size = max_size
+        self._shapes: "OrderedDict[str, Shape]" = OrderedDict()
+        # sender header -> (loaded at, shapes with a merchant group)
+        self._headers: "OrderedDict[str, Tuple[float, List[Shape]]]" = OrderedDict()
+        self._pending_hits: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._stats = {"lookups": 0, "hits": 0, "header_hits": 0, "learned": 0, "unlearnable": 0, "errors": 0}
+
+    def _remember(self, shape: Shape) -> None:
+        with self._lock:
+            self._shapes[shape.key] = shape
+            self._shapes.move_to_end(shape.key)
+            while len(self._shapes) > self.max_size:
+                self._shapes.popitem(last=False)
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self._stats[name] += 1
+
+    def _load(self, key: str) -> Optional[Shape]:
+        with connection() as conn:
+            with conn.cursor() as cur:
+                execute_prepared(cur, SHAPE_LOOKUP, (key,))
+                row = cur.fetchone()
+            conn.commit()
+        if row is None:
+            return None
+        shape = Shape(key, *row)
+        self._remember(shape)
+        return shape
+
+    def _load_header(self, header: str) -> List[Shape]:
+        with connection() as conn:
+            with conn.cursor() as cur:
+                execute_prepared(cur, SHAPE_HEADER_LOOKUP, (header, SHAPE_HEADER_CANDIDATES))
+                rows = cur.fetchall()
+            conn.commit()
+        return [shape for shape in (Shape(*row) for row in rows) if shape.payee_varies]
+
+    def _header_shapes(self, header: str) -> List[Shape]:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._headers.get(header)
+        if entry is not None and now - entry[0] < SHAPE_HEADER_REFRESH_SECONDS:
+            return entry[1]
+        shapes = self._load_header(header)
+        with self._lock:
+            self._headers[header] = (now, shapes)
+            self._headers.move_to_end(header)
+            while len(self._headers) > self.max_size:
+                self._headers.popitem(last=False)
+        return shapes
+
+    def _match_header(self, address: Optional[str], text: str) -> Tuple[Optional[Shape], Optional[Dict]]:
+        """The first learned shape of this sender that fits `text` with another payee."""
+        try:
+            candidates = self._header_shapes(sender_header(address or ""))
+        except Exception as e:
+            logger.warning(f"Shape lookup failed: {e}")
+            self._count("errors")
+            return None, None
+        for shape in candidates:
+            result = shape.apply(text)
+            if result is not None:
+                return shape, result
+        return None, None
+
+    def lookup(self, address: Optional[str], text: str) -> Optional[Dict]:
+        """Fields from a learned shape, or None (the caller asks the LLM)."""
+        key, _ = shape_of(address, text)
+        self._count("lookups")
+        with self._lock:
+            shape = self._shapes.get(key)
+            if shape is not None:
+                self._shapes.move_to_end(key)
+        if shape is None:
+            try:
+                shape = self._load(key)
+            except Exception as e:
+                logger.warning(f"Shape lookup failed: {e}")
+                self._count("errors")
+                return None
+        result = shape.apply(text) if shape is not None else None
+        header_hit = False
+        if result is None:
+            # Same wording, another payee
+            shape, result = self._match_header(address, text)
+            header_hit = result is not None
+        if result is None:
+            return None
+        with self._lock:
+            self._stats["hits"] += 1
+            self._stats["header_hits"] += header_hit
+            self._pending_hits[shape.key] = self._pending_hits.get(shape.key, 0) + 1
+        return result
+
+    def _insert(self, shape: Shape, header: str) -> None:
+        with connection() as conn:
+            with conn.cursor() as cur:
+                execute_prepared(cur, SHAPE_INSERT, (
+                    shape.key, header, shape.template, shape.pattern,
+                    shape.bank, shape.transaction_type, shape.merchant,
+                ))
+            conn.commit()
+
+    def learn(self, address: Optional[str], text: str, fields: Dict) -> bool:
+        """Store the shape of an LLM-extracted message; False if it cannot be generalized."""
+        shape = derive(address, text, fields)
+        if shape is None:
+            self._count("unlearnable")
+            return False
+        header = sender_header(address or "")
+        try:
+            self._insert(shape, header)
+        except Exception as e:
+            logger.warning(f"Could not store shape: {e}")
+            self._count("errors")
+            return False
+        self._remember(shape)
+        with self._lock:
+            entry = self._headers.get(header)
+            if entry is not None and shape.payee_varies:
+                self._headers[header] = (entry[0], entry[1] + [shape])
+        self._count("learned")
+        logger.info(f"Learned shape {shape.key[:12]}: {shape.template[:80]}")
+        return True
+
+    def flush_hits(self) -> None:
+        """Add the hits counted since the last flush to sms_shapes.hits."""
+        with self._lock:
+            pending, self._pending_hits = self._pending_hits, {}
+        if not pending:
+            return
+        try:
+            with connection() as conn:
+                with conn.cursor() as cur:
+                    cur.executemany(
+                        "UPDATE sms_shapes SET hits = hits + %s, last_hit_at = CURRENT_TIMESTAMP WHERE shape_key = %s;",
+                        [(count, key) for key, count in pending.items()],
+                    )
+                conn.commit()
+        except Exception as e:
+            logger.warning(f"Could not record shape hits: {e}")
+
+    def stats(self) -> Dict:
+        with self._lock:
+            lookups = self._stats["lookups"]
+            return {
+                "enabled": SHAPE_CACHE_ENABLED,
+                "size": len(self._shapes),
+                "max_size": self.max_size,
+                **self._stats,
+                "llm_calls_avoided": self._stats["hits"],
+                "hit_rate": round(self._stats["hits"] / lookups, 3) if lookups else None,
+            }
+
+
+_cache = ShapeCache()
+
+
+def lookup_shape(address: Optional[str], text: str) -> Optional[Dict]:
+    return _cache.lookup(address, text) if SHAPE_CACHE_ENABLED else None
+
+
+def learn_shape(address: Optional[str], text: str, fields: Dict) -> bool:
+    return _cache.learn(address, text, fields) if SHAPE_CACHE_ENABLED else False
+
+
+def flush_shape_hits() -> None:
+    _cache.flush_hits()
+
+
+def get_shape_stats() -> Dict:
+    return _cache.stats()
+
+
+if __name__ == "__main__":
+    import argparse
+    from logging_config import setup_logging
+
+    parser = argparse.ArgumentParser(description="List learned SMS shapes by hits")
+    parser.add_argument("--limit", type=int, default=20)
+    args = parser.parse_args()
+
+    setup_logging()
+    with connection() as conn, conn.cursor() as cur:
+        cur.execute("SELECT COUNT(*), COALESCE(SUM(hits), 0) FROM sms_shapes;")
+        shapes, hits = cur.fetchone()
+        cur.execute(
+            "SELECT hits, bank, transaction_type, template FROM sms_shapes ORDER BY hits DESC, created_at LIMIT %s;",
+            (args.limit,),
+        )
+        rows = cur.fetchall()
+    print(f"shapes learned: {shapes}, LLM calls avoided: {hits}")
+    for hits, bank, transaction_type, template in rows:
+        print(f"{hits:>8}  {bank or '-':<8} {transaction_type or '-':<9} {template[:100]}")
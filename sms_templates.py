@@ -0,0 +1,238 @@
+"""Declarative per-bank SMS templates.
+
+The generic rules in extraction.py cover the common "Sent Rs.X / To Y"
+shapes. Formats they only half understand (credit card spends, NEFT/IMPS
+credits, ATM withdrawals, ...) used to fall through to a throttled LLM call.
+A template describes one such format exactly:
+
+    SmsTemplate(
+        "hdfc_card_spend", bank="HDFC", senders=["*-HDFCBK-*"],
+        pattern=r"Rs\\.?\\s*(?P<amount>[\\d,]+(?:\\.\\d+)?) spent on HDFC Bank Card x(?P<account>\\d+) at (?P<merchant>.+?) on",
+        transaction_type="debited",
+        sample="Rs.1,250.00 spent on HDFC Bank Card x1234 at AMAZON PAY INDIA on ...",
+    )
+
+- `senders` are glob patterns over the sender ID, case-insensitive.
+- `pattern` must capture `amount` and `merchant`, and may capture
+  `account`. It either captures `type` (a word mapped through
+  TYPE_WORDS) or the template fixes `transaction_type`.
+- `sample` is a real message in this format. tests/test_classify.py checks
+  that it parses and that classify.py tags it "financial"; a format the
+  classifier misses never reaches the convert pipeline.
+
+Templates are indexed by sender header (the HDFCBK in AX-HDFCBK-S), so a
+message is only tried against its own bank's templates. Globs without a
+fixed header are tried for every sender. A match that yields all four
+fields skips the LLM entirely. Messages with an exclusion keyword
+(reminders, offers, mandates, ...) are never templated, the same policy
+the rules and the LLM prompt follow. Per-template hit counts are reported
+by `get_template_stats()`.
+"""
+import fnmatch
+import re
+import threading
+from typing import Dict, List, Optional
+from classify import EXCLUSION_KEYWORDS
+
+# Words a template's `type` group may capture
+TYPE_WORDS = {
+    "debited": "debited", "spent": "debited", "withdrawn": "debited", "paid": "debited", "sent": "debited",
+    "credited": "credited", "received": "credited", "deposited": "credited",
+}
+
+
+class SmsTemplate:
+    """One bank SMS format: sender globs plus a named-group regex."""
+
+    def __init__(self, name: str, bank: str, senders: List[str], pattern: str,
+                 transaction_type: Optional[str] = None, sample: Optional[str] = None):
+        self.name = name
+        self.bank = bank
+        self.senders = [glob.upper() for glob in senders]
+        self.regex = re.compile(pattern, re.IGNORECASE | re.DOTALL)
+        self.transaction_type = transaction_type
+        self.sample = sample
+        groups = set(self.regex.groupindex)
+        missing = {"amount", "merchant"} - groups
+        if missing:
+            raise ValueError(f"Template {name} is missing groups: {', '.join(sorted(missing))}")
+        if transaction_type is None and "type" not in groups:
+            raise ValueError(f"Template {name} needs a 'type' group or a fixed transaction_type")
+
+    def headers(self) -> List[Optional[str]]:
+        """Index keys for this template's sender globs (None = no fixed header)."""
+        keys = []
+        for glob in self.senders:
+            header = sender_header(glob)
+            keys.append(header if header and not any(c in header for c in "*?[") else None)
+        return keys
+
+    def matches_sender(self, address_upper: str) -> bool:
+        return any(fnmatch.fnmatchcase(address_upper, glob) for glob in self.senders)
+
+    def parse(self, text: str) -> Optional[Dict]:
+        """Transaction fields from a matching message, or None."""
+        match = self.regex.search(text)
+        if not match:
+            return None
+        fields = match.groupdict()
+        try:
+            amount = float(fields["amount"].replace(",", ""))
+        except (AttributeError, ValueError):
+            return None
+        transaction_type = self.transaction_type or TYPE_WORDS.get((fields.get("type") or "").lower())
+        merchant = re.sub(r"\s+", " ", (fields.get("merchant") or "")).strip(" .,")
+        if not transaction_type or not merchant:
+            return None
+        return {
+            "bank": self.bank,
+            "amount": amount,
+            "transaction_type": transaction_type,
+            "merchant": merchant,
+            "account": fields.get("account"),
+        }
+
+
+def sender_header(address: str) -> str:
+    """The header part of a sender ID: HDFCBK for AX-HDFCBK-S or HDFCBK."""
+    parts = address.upper().split("-")
+    return parts[1] if len(parts) > 1 else parts[0]
+
+
+_AMOUNT = r"(?:Rs\.?|INR|₹)\s*(?P<amount>\d[\d,]*(?:\.\d+)?)"
+
+TEMPLATES = [
+    SmsTemplate(
+        "hdfc_card_spend", bank="HDFC", senders=["*-HDFCBK-*", "*-HDFCBK"],
+        pattern=_AMOUNT + r" spent on HDFC Bank Card x(?P<account>\d+) at (?P<merchant>.+?) on \d",
+        transaction_type="debited",
+        sample="Rs.1,250.00 spent on HDFC Bank Card x1234 at AMAZON PAY INDIA on 2025-08-10:12:30:45.Avl bal: Rs.10000",
+    ),
+    SmsTemplate(
+        "hdfc_card_spend_multiline", bank="HDFC", senders=["*-HDFCBK-*", "*-HDFCBK"],
+        pattern=r"^Spent " + _AMOUNT + r"\s*\nFrom HDFC Bank Card x(?P<account>\d+)\s*\nAt (?P<merchant>[^\n]+)\n",
+        transaction_type="debited",
+        sample="Spent Rs.1250.00\nFrom HDFC Bank Card x1234\nAt AMAZON PAY\nOn 2025-08-10:12:30:45\nNot You?\nCall 18002586161",
+    ),
+    SmsTemplate(
+        "hdfc_account_update", bank="HDFC", senders=["*-HDFCBK-*", "*-HDFCBK"],
+        pattern=r"Update! " + _AMOUNT + r" (?P<type>debited|credited) (?:from|to) HDFC Bank (?:A/c )?X*(?P<account>\d+)"
+                r" on \S+?\.? (?:Info|Desc):\s*(?P<merchant>.+?)\.?\s+Avl bal",
+        sample="Update! INR 5,000.00 debited from HDFC Bank XX1234 on 10-AUG-25. Info: ACH D- TP ACH ICICIPRU-123. Avl bal:INR 10,000.00",
+    ),
+    SmsTemplate(
+        "hdfc_neft_credit", bank="HDFC", senders=["*-HDFCBK-*", "*-HDFCBK"],
+        pattern=_AMOUNT + r" (?:has been )?credited to (?:your )?(?:HDFC Bank )?A/c X*(?P<account>\d+) .*?"
+                r"by (?:NEFT|IMPS|RTGS) from (?P<merchant>[^,.\n]+)",
+        transaction_type="credited",
+        sample="INR 25,000.00 credited to HDFC Bank A/c XX1234 on 10-AUG-25 by NEFT from ACME CORP PVT LTD. Avl bal INR 30,000.00",
+    ),
+    SmsTemplate(
+        "icici_card_spend", bank="ICICI", senders=["*-ICICIB-*", "*-ICICIB"],
+        pattern=_AMOUNT + r" spent (?:using|on) ICICI Bank Card X+(?P<account>\d+) on \S+ (?:on|at) (?P<merchant>.+?)\. Avl",
+        transaction_type="debited",
+        sample="INR 2,500.00 spent using ICICI Bank Card XX1234 on 10-Aug-25 on AMAZON.IN. Avl Limit: INR 1,00,000.00",
+    ),
+    SmsTemplate(
+        "icici_account_transfer", bank="ICICI", senders=["*-ICICIB-*", "*-ICICIB"],
+        pattern=r"ICICI Bank Acc(?:oun)?t X+(?P<account>\d+) (?P<type>debited|credited) (?:for|with) " + _AMOUNT
+                + r" on \S+;? (?P<merchant>[^;\n]+?) (?:credited|debited)\.",
+        sample="ICICI Bank Acct XX123 debited for Rs 500.00 on 10-Aug-25; SWIGGY credited. UPI:1234. Call 18002662 for dispute",
+    ),
+    SmsTemplate(
+        "sbi_card_spend", bank="SBI", senders=["*-SBICRD-*", "*-SBICRD"],
+        pattern=_AMOUNT + r" spent on your SBI Credit Card ending(?: with)? (?P<account>\d+) at (?P<merchant>.+?) on \d",
+        transaction_type="debited",
+        sample="Rs.1,299.00 spent on your SBI Credit Card ending with 1234 at FLIPKART on 10/08/25. Trxn. not done by you? Report at",
+    ),
+    SmsTemplate(
+        "sbi_neft_credit", bank="SBI", senders=["*-SBIINB-*", "*-SBIINB", "*-SBIPSG-*"],
+        pattern=r"Your A/C X+(?P<account>\d+) (?:has )?(?:been )?(?P<type>credited) (?:by|with) " + _AMOUNT
+                + r" on \S+ by (?:NEFT|IMPS|RTGS|transfer) from (?P<merchant>[^.\n]+?)(?:\.|\s+Ref|$)",
+        sample="Dear Customer, Your A/C XXXXX1234 has been credited by Rs.10,000.00 on 10Aug25 by NEFT from ACME CORP. Ref No 123",
+    ),
+    SmsTemplate(
+        "axis_card_spend", bank="AXIS", senders=["*-AXISBK-*", "*-AXISBK"],
+        pattern=r"^Spent\s*\nCard no\. XX(?P<account>\d+)\s*\n(?:INR|Rs\.?)\s*(?P<amount>\d[\d,]*(?:\.\d+)?)\s*\n[^\n]+\n(?P<merchant>[^\n]+)",
+        transaction_type="debited",
+        sample="Spent\nCard no. XX1234\nINR 500.00\n10-08-25 12:30:45\nSWIGGY\nAvl Lmt INR 50000",
+    ),
+    SmsTemplate(
+        "kotak_atm_withdrawal", bank="KOTAK", senders=["*-KOTAKB-*", "*-KOTAKB"],
+        pattern=_AMOUNT + r" (?P<type>withdrawn) from Kotak Bank a/c X+(?P<account>\d+) at (?P<merchant>ATM .+?) on \d",
+        sample="Rs.2000 withdrawn from Kotak Bank a/c XX1234 at ATM MG ROAD BANGALORE on 10-08-25. Avl bal Rs 500",
+    ),
+]
+
+
+class TemplateIndex:
+    """Sender header -> candidate templates, with hit counters."""
+
+    def __init__(self, templates: List[SmsTemplate]):
+        self.templates = list(templates)
+        self._by_header: Dict[str, List[SmsTemplate]] = {}
+        self._wildcard: List[SmsTemplate] = []
+        for template in self.templates:
+            for header in set(template.headers()):
+                if header is None:
+                    self._wildcard.append(template)
+                else:
+                    self._by_header.setdefault(header, []).append(template)
+        self._lock = threading.Lock()
+        self._hits = {template.name: 0 for template in self.templates}
+        self._stats = {"lookups": 0, "no_candidates": 0, "misses": 0, "excluded": 0}
+
+    def candidates(self, address: Optional[str]) -> List[SmsTemplate]:
+        if not address:
+            return []
+        address_upper = address.strip().upper()
+        pool = self._by_header.get(sender_header(address_upper), []) + self._wildcard
+        return [template for template in pool if template.matches_sender(address_upper)]
+
+    def match(self, address: Optional[str], text: str) -> Optional[Dict]:
+        """Fields from the first candidate template that parses `text`, or None."""
+        candidates = self.candidates(address)
+        text_lower = text.lower()
+        result = None
+        outcome = "no_candidates"
+        if candidates:
+            if any(keyword in text_lower for keyword in EXCLUSION_KEYWORDS):
+                outcome = "excluded"
+            else:
+                outcome = "misses"
+                for template in candidates:
+                    result = template.parse(text)
+                    if result:
+                        outcome = template.name
+                        break
+        with self._lock:
+            self._stats["lookups"] += 1
+            if outcome in self._hits:
+                self._hits[outcome] += 1
+            else:
+                self._stats[outcome] += 1
+        if result:
+            result["template"] = outcome
+        return result
+
+    def stats(self) -> Dict:
+        with self._lock:
+            hits = sum(self._hits.values())
+            return {
+                "templates": len(self.templates),
+                **self._stats,
+                "hits": hits,
+                "hit_rate": round(hits / self._stats["lookups"], 3) if self._stats["lookups"] else None,
+                "by_template": dict(self._hits),
+            }
+
+
+_index = TemplateIndex(TEMPLATES)
+
+
+def match_template(address: Optional[str], text: str) -> Optional[Dict]:
+    return _index.match(address, text)
+
+
+def get_template_stats() -> Dict:
+    return _index.stats()
@@ -0,0 +1,156 @@
+"""Registry of server-side prepared statements for the hottest queries.
+
+Modules register their hot SQL once at import time with `register(name, sql)`
+and run it with `execute()` (psycopg2) or `aexecute()` / `aexecutemany()`
+(psycopg 3). Each statement is prepared once per pooled connection and then
+executed by name, so Postgres skips parsing and planning on every reuse.
+
+Set DB_PREPARED_STATEMENTS=0 to run the same SQL unprepared; the counters
+from `get_statement_stats()` then show the latency of both modes side by side.
+"""
+import os
+import re
+import threading
+import time
+import weakref
+from typing import Dict, Iterable, Sequence, Set
+from logging_config import get_logger
+
+logger = get_logger("sms_sync.statements")
+
+PREPARED_STATEMENTS_ENABLED = os.getenv("DB_PREPARED_STATEMENTS", "1").lower() not in ("0", "false", "no")
+
+STATEMENTS: Dict[str, str] = {}
+
+_NAME = re.compile(r"^[a-z_][a-z0-9_]*$")
+_prepared: "weakref.WeakKeyDictionary[object, Set[str]]" = weakref.WeakKeyDictionary()
+_stats: Dict[str, Dict[str, float]] = {}
+_stats_lock = threading.Lock()
+
+
+def register(name: str, sql: str) -> str:
+    """Register `sql` (psycopg %s placeholders) under `name`; returns the name."""
+    if not _NAME.match(name):
+        raise ValueError(f"Invalid prepared statement name: {name!r}")
+    if name in STATEMENTS and STATEMENTS[name] != sql:
+        raise ValueError(f"Prepared statement {name!r} registered twice with different SQL")
+    STATEMENTS[name] = sql
+    _stats.setdefault(name, {
+        "prepares": 0,
+        "prepared_executions": 0,
+        "prepared_time": 0.0,
+        "unprepared_executions": 0,
+        "unprepared_time": 0.0,
+    })
+    return name
+
+
+def is_registered(name: str) -> bool:
+    return name in STATEMENTS
+
+
+def sql_for(name: str) -> str:
+    return STATEMENTS[name]
+
+
+def _record(name: str, prepared: bool, elapsed: float, executions: int = 1, prepares: int = 0) -> None:
+    with _stats_lock:
+        stats = _stats[name]
+        stats["prepares"] += prepares
+        if prepared:
+            stats["prepared_executions"] += executions
+            stats["prepared_time"] += elapsed
+        else:
+            stats["unprepared_executions"] += executions
+            stats["unprepared_time"] += elapsed
+
+
+def _to_positional(sql: str) -> str:
+    """Rewrite %s placeholders to $1..$n for PREPARE."""
+    counter = iter(range(1, sql.count("%s") + 1))
+    return re.sub(r"%s", lambda _: f"${next(counter)}", sql).rstrip().rstrip(";")
+
+
+def execute(cur, name: str, params: Sequence) -> None:
+    """Execute a registered statement on a psycopg2 cursor."""
+    sql = STATEMENTS[name]
+    start = time.perf_counter()
+    if not PREPARED_STATEMENTS_ENABLED:
+        cur.execute(sql, params)
+        _record(name, False, time.perf_counter() - start)
+        return
+
+    prepared = _prepared.setdefault(cur.connection, set())
+    prepares = 0
+    if name not in prepared:
+        cur.execute(f"PREPARE {name} AS {_to_positional(sql)};")
+        prepared.add(name)
+        prepares = 1
+    placeholders = ", ".join(["%s"] * len(params))
+    cur.execute(f"EXECUTE {name} ({placeholders});" if params else f"EXECUTE {name};", params)
+    _record(name, True, time.perf_counter() - start, prepares=prepares)
+
+
+async def aexecute(conn, name: str, params: Sequence):
+    """Execute a registered statement on a psycopg 3 async connection; returns the cursor.
+
+    psycopg 3 keeps its own per-connection prepared statement cache, so this
+    only has to ask for preparation and keep the counters.
+    """
+    sql = STATEMENTS[name]
+    start = time.perf_counter()
+    prepares = 0
+    if PREPARED_STATEMENTS_ENABLED:
+        prepared = _prepared.setdefault(conn, set())
+        if name not in prepared:
+            prepared.add(name)
+            prepares = 1
+    cur = await conn.execute(sql, params, prepare=PREPARED_STATEMENTS_ENABLED)
+    _record(name, PREPARED_STATEMENTS_ENABLED, time.perf_counter() - start, prepares=prepares)
+    return cur
+
+
+async def aexecutemany(cur, name: str, params_seq: Iterable[Sequence]) -> None:
+    """Run a registered statement for many parameter rows on a psycopg 3 async cursor.
+
+    executemany pipelines the rows; dropping the connection's prepare
+    threshold to 0 for the call makes psycopg prepare on the first row
+    instead of after its default five executions.
+    """
+    rows = params_seq if isinstance(params_seq, list) else list(params_seq)
+    conn = cur.connection
+    start = time.perf_counter()
+    if not PREPARED_STATEMENTS_ENABLED:
+        await cur.executemany(STATEMENTS[name], rows)
+        _record(name, False, time.perf_counter() - start, executions=len(rows))
+        return
+
+    prepared = _prepared.setdefault(conn, set())
+    prepares = 0 if name in prepared else 1
+    prepared.add(name)
+    threshold = conn.prepare_threshold
+    conn.prepare_threshold = 0
+    try:
+        await cur.executemany(STATEMENTS[name], rows)
+    finally:
+        conn.prepare_threshold = threshold
+    _record(name, True, time.perf_counter() - start, executions=len(rows), prepares=prepares)
+
+
+def get_statement_stats() -> Dict:
+    """Per-statement counters: prepares, executions by mode and mean latency."""
+    report = {"enabled": PREPARED_STATEMENTS_ENABLED, "statements": {}}
+    with _stats_lock:
+        for name, stats in _stats.items():
+            prepared_n = stats["prepared_executions"]
+            unprepared_n = stats["unprepared_executions"]
+            report["statements"][name] = {
+                "prepares": stats["prepares"],
+                "prepared_executions": prepared_n,
+                # Every prepared execution beyond the first on a connection skipped parse + plan
+                "plans_saved": max(prepared_n - stats["prepares"], 0),
+                "prepared_avg_ms": round(stats["prepared_time"] * 1000 / prepared_n, 3) if prepared_n else None,
+                "unprepared_executions": unprepared_n,
+                "unprepared_avg_ms": round(stats["unprepared_time"] * 1000 / unprepared_n, 3) if unprepared_n else None,
+            }
+    return report
@@ -12,7 +12,7 @@ import json
 # Add current directory to path for imports
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
-from convert import TestingSMSConverter, get_db_connection
+from convert import TestingSMSConverter
 
 
 class EnhancedTestingSMSConverter(TestingSMSConverter):
@@ -0,0 +1,9 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# chat.py builds its LLM client at import time and refuses to start without
+# a key; the tests never call the real APIs, so placeholders are enough
+os.environ.setdefault("OPENAI_APIKEY", "test")
+os.environ.setdefault("GEMINI_APIKEY", "test")
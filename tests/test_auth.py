@@ -0,0 +1,22 @@
+import pytest
+from auth import _token_secret, issue_token, verify_token
+
+
+def test_token_round_trip():
+    assert verify_token(issue_token("alice")) == "alice"
+
+
+@pytest.mark.parametrize("token", ["", "abc", "abc.", "abc.é", "é.é", "abc.\udcff", "\udcff.abc"])
+def test_malformed_tokens_are_rejected(token):
+    assert verify_token(token) is None
+
+
+def test_tampered_signature_is_rejected():
+    payload, _, signature = issue_token("alice").partition(".")
+    assert verify_token(f"{payload}.{signature[:-1]}é") is None
+
+
+def test_placeholder_secret_is_not_used():
+    assert _token_secret("change-me-to-a-long-random-string") != b"change-me-to-a-long-random-string"
+    assert _token_secret("") != _token_secret("")
+    assert _token_secret("s3cret") == b"s3cret"
@@ -0,0 +1,41 @@
+import pytest
+from classify import classify
+from sms_templates import TEMPLATES
+
+
+@pytest.mark.parametrize("template", TEMPLATES, ids=lambda template: template.name)
+def test_template_samples_are_financial(template):
+    assert template.sample, f"{template.name} has no sample message"
+    assert template.parse(template.sample), f"{template.name} does not parse its own sample"
+    assert classify(template.senders[0].replace("*", "AX"), template.sample) == "financial"
+    assert classify(None, template.sample) == "financial"
+
+
+@pytest.mark.parametrize("address, body", [
+    ("AX-HDFCBK-S", "Rs.500.00 debited from a/c **1234 on 10-08-25 to VPA merchant@okaxis (UPI Ref No 412345678901). "
+                    "Not you? Call 18002586161. Do not share OTP with anyone"),
+    ("AX-ICICIB-S", "ICICI Bank Acct XX123 debited for Rs 1,299.00 on 10-Aug-25; AMAZON credited. "
+                    "UPI:412345678901. Never share your OTP"),
+    ("VM-SBIINB-S", "INR 500 debited from A/c X1234 on 10Aug25 to ZOMATO. Ref 412345678901. "
+                    "If not done by you, call 1800111109. SBI never asks for it, do not share OTP"),
+    ("AX-HDFCBK-S", "Rs.2,499.00 spent on HDFC Bank Card x1234 at AMAZON PAY on 2025-08-10:12:30:45"),
+    ("VM-HDFCBK-S", "Spent Rs.450\nFrom HDFC Bank Card x1234\nAt SWIGGY\nOn 2025-08-10"),
+    ("JD-KOTAKB-S", "Your Kotak Credit Card x1234 has been charged INR 899.00 at NETFLIX on 10-08-25"),
+])
+def test_transactions_are_financial(address, body):
+    assert classify(address, body) == "financial"
+
+
+@pytest.mark.parametrize("body", [
+    "Your OTP is 482913. Valid for 10 minutes. Do not share it with anyone.",
+    "482913 is your OTP for login to the XYZ app",
+    "Your OTP for login: 4829",
+    "Use OTP 482913 to verify your mobile number",
+    "123456 is your verification code for Acme",
+])
+def test_otp_deliveries(body):
+    assert classify("AX-ACMEAP-S", body) == "otp"
+
+
+def test_otp_warning_alone_is_not_an_otp():
+    assert classify("AX-HDFCBK-S", "Never share your OTP, PIN or password with anyone. Call 18002586161") == "other"
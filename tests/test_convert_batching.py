@@ -0,0 +1,67 @@
+import asyncio
+import json
+from langchain_core.messages import AIMessage
+import pytest
+import convert
+import llm_provider
+from llm_cache import ResponseCache
+
+
+class _BatchLLM:
+    """Answers batch prompts (the merchant is the last word of each SMS) and single prompts."""
+
+    def __init__(self):
+        self.prompts = []
+
+    async def ainvoke(self, prompt):
+        self.prompts.append(prompt)
+        if "JSON array:" not in prompt:
+            return AIMessage(content=json.dumps({"bank": "HDFC", "amount": 10.0, "transaction_type": "debited"}))
+        items = json.loads(prompt.split("JSON array:", 1)[1].split("\n\nReturn ONLY", 1)[0])
+        return AIMessage(content=json.dumps([
+            {"id": item["id"], "bank": "HDFC", "amount": 10.0 * item["id"], "transaction_type": "debited",
+             "merchant": item["message"].split()[-1]}
+            for item in items
+        ]))
+
+
+@pytest.fixture
+def response_cache(monkeypatch):
+    """A fresh, memory-only cache (no llm_cache table) in place of the process-wide one."""
+    cache = ResponseCache(ttl=3600, max_rows=1000, memory_size=100, evict_every=1000)
+    monkeypatch.setattr(cache, "_load", lambda key: None)
+    monkeypatch.setattr(cache, "_store", cache._remember)
+    monkeypatch.setattr(llm_provider, "response_cache", cache)
+    return cache
+
+
+def test_batch_answers_are_cached_per_message(response_cache):
+    converter = convert.SMSToTransactionConverter()
+    llm = converter.llm_provider.primary_llm = _BatchLLM()
+    items = [("AX-HDFCBK-S", f"Your card was used for a purchase at {merchant}") for merchant in ("ZOMATO", "SWIGGY", "UBER")]
+    rules = converter._get_empty_transaction()
+
+    assert all(converter._resolve_from_cache(body, address, rules) is None for address, body in items)
+    results = asyncio.run(converter.aextract_batch(items))
+    assert [result["merchant"] for result in results] == ["ZOMATO", "SWIGGY", "UBER"]
+    assert len(llm.prompts) == 1
+
+    # The same SMS in any other batch is answered from the cache
+    address, body = items[1]
+    assert converter._resolve_from_cache(body, address, rules) == {
+        "bank": "HDFC", "amount": 20.0, "transaction_type": "debited", "merchant": "SWIGGY",
+    }
+    assert converter.llm_provider.generate_response(converter.build_prompt(address, body))
+    assert len(llm.prompts) == 1
+
+
+def test_single_message_counts_one_miss(response_cache):
+    converter = convert.SMSToTransactionConverter()
+    llm = converter.llm_provider.primary_llm = _BatchLLM()
+    rules = converter._get_empty_transaction()
+    address, body = "AX-HDFCBK-S", "Your card was used for a purchase at ZOMATO"
+    assert converter._resolve_from_cache(body, address, rules) is None
+    [result] = asyncio.run(converter.aextract_batch([(address, body)]))
+    assert result["amount"] == 10.0
+    assert len(llm.prompts) == 1
+    assert response_cache.stats()["misses"] == 1
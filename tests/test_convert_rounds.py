@@ -0,0 +1,104 @@
+import json
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+from langchain_openai import ChatOpenAI
+import convert
+import converter_worker
+
+
+class _ChatCompletions(BaseHTTPRequestHandler):
+    """Minimal OpenAI-compatible endpoint; keep-alive, like the real API."""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        body = json.dumps({
+            "id": "chatcmpl-1", "object": "chat.completion", "created": 0, "model": "gpt-4o-mini",
+            "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": "ok"}}],
+            "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2},
+        }).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class _LockConnection:
+    """Stands in for a pooled connection: the advisory lock is always free."""
+
+    @contextmanager
+    def cursor(self):
+        class Cursor:
+            def execute(self, *args):
+                pass
+
+            def fetchone(self):
+                return (True,)
+        yield Cursor()
+
+    def commit(self):
+        pass
+
+
+@pytest.fixture
+def openai_url():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _ChatCompletions)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}/v1"
+    server.shutdown()
+
+
+def test_back_to_back_rounds_reuse_async_clients(monkeypatch, openai_url):
+    # No http_async_client: langchain_openai shares one cached httpx client
+    # per process, bound to the event loop that first used it
+    llm = ChatOpenAI(model="gpt-4o-mini", api_key="x", base_url=openai_url, max_retries=0)
+
+    async def round_(limit):
+        response = await llm.ainvoke("hello")
+        return {"status": "success", "content": response.content}
+
+    monkeypatch.setattr(convert, "connection", contextmanager(lambda: (yield _LockConnection())))
+    monkeypatch.setattr(convert, "_convert_messages", round_)
+    for _ in range(3):
+        assert convert.convert_all_messages() == {"status": "success", "content": "ok"}
+
+
+def test_round_continues_past_batches_with_no_extracted_data(monkeypatch):
+    # Full batches of messages with nothing to extract: all failed, all marked
+    batches = [
+        {"status": "success", "processed_count": 0, "failed_count": 2, "marked_count": 2, "total_messages": 2},
+        {"status": "success", "processed_count": 1, "failed_count": 1, "marked_count": 2, "total_messages": 2},
+        {"status": "success", "processed_count": 0, "failed_count": 1, "marked_count": 1, "total_messages": 1},
+    ]
+    calls = []
+
+    def convert_all_messages(limit):
+        calls.append(limit)
+        return batches[len(calls) - 1]
+
+    monkeypatch.setattr(converter_worker, "CONVERT_BATCH_SIZE", 2)
+    monkeypatch.setattr(converter_worker, "convert_all_messages", convert_all_messages)
+    worker = converter_worker.ConverterWorker()
+    worker.convert_round("test")
+    assert calls == [2, 2, 2]
+
+
+def test_round_stops_when_a_batch_marks_nothing(monkeypatch):
+    calls = []
+
+    def convert_all_messages(limit):
+        calls.append(limit)
+        return {"status": "success", "processed_count": 0, "failed_count": 2, "marked_count": 0, "total_messages": 2}
+
+    monkeypatch.setattr(converter_worker, "CONVERT_BATCH_SIZE", 2)
+    monkeypatch.setattr(converter_worker, "convert_all_messages", convert_all_messages)
+    worker = converter_worker.ConverterWorker()
+    worker.convert_round("test")
+    assert calls == [2]
@@ -0,0 +1,22 @@
+import socket
+import time
+import psycopg2
+import pytest
+from db import ConnectionPool
+
+
+def test_connect_timeout_bounds_an_unresponsive_server():
+    # Accepts TCP connections but never answers the startup packet
+    server = socket.socket()
+    server.bind(("127.0.0.1", 0))
+    server.listen(8)
+    pool = ConnectionPool(
+        f"postgresql://postgres@127.0.0.1:{server.getsockname()[1]}/postgres",
+        min_size=0, max_size=1, timeout=1, health_check_idle=30, connect_timeout=2,
+    )
+    start = time.monotonic()
+    with pytest.raises(psycopg2.OperationalError):
+        pool.getconn()
+    assert time.monotonic() - start < 10
+    assert pool.stats()["in_use"] == 0
+    server.close()
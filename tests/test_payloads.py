@@ -0,0 +1,29 @@
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from routes.system_routes import system_router
+
+app = FastAPI()
+app.include_router(system_router)
+client = TestClient(app)
+
+
+@pytest.mark.parametrize("body", [
+    b'{"user_name": "alice", "messages": [],}',
+    b"\xff\xfe",
+    b'{"user_name": "alice", "messages": [{"id": "x"}]}',
+])
+def test_malformed_json_sync_body_is_422(body):
+    response = client.post("/sync", content=body, headers={"Content-Type": "application/json"})
+    assert response.status_code == 422
+    assert all("input" not in error for error in response.json()["detail"])
+
+
+@pytest.mark.parametrize("body, status_code", [
+    (b"\x81\x91\x01\x01", 400),  # {[1]: 1}: a list as a map key
+    (b"\x82\xa9user_name\xa5alice\xa8messages\xd6\xff\x00\x00\x00\x01", 422),  # messages is a Timestamp
+])
+def test_malformed_msgpack_sync_body(body, status_code):
+    pytest.importorskip("msgpack")
+    response = client.post("/sync", content=body, headers={"Content-Type": "application/msgpack"})
+    assert response.status_code == status_code
@@ -0,0 +1,71 @@
+import asyncio
+import json
+from langchain_core.messages import AIMessage
+import convert
+import llm_provider
+import shapes
+from llm_cache import ResponseCache
+
+ADDRESS = "VM-XYZBNK-S"
+
+
+def _sms(amount, payee, ref):
+    return f"Your a/c XX1234 was charged INR {amount} for a payment to {payee} on 01-05-24. Ref {ref}"
+
+
+class _MemoryShapeCache(shapes.ShapeCache):
+    """ShapeCache with a dict standing in for the sms_shapes table."""
+
+    def __init__(self):
+        super().__init__()
+        self.table = {}
+
+    def _load(self, key):
+        row = self.table.get(key)
+        return row and row[1]
+
+    def _load_header(self, header):
+        return [shape for row_header, shape in self.table.values() if row_header == header and shape.payee_varies]
+
+    def _insert(self, shape, header):
+        self.table.setdefault(shape.key, (header, shape))
+
+
+class _SingleLLM:
+    def __init__(self):
+        self.prompts = []
+
+    async def ainvoke(self, prompt):
+        self.prompts.append(prompt)
+        return AIMessage(content=json.dumps(
+            {"bank": "XYZ", "amount": "250.00", "transaction_type": "debited", "merchant": "BMTC BUS"}
+        ))
+
+
+def test_learned_shape_serves_another_payee(monkeypatch):
+    cache = _MemoryShapeCache()
+    monkeypatch.setattr(shapes, "_cache", cache)
+    monkeypatch.setattr(llm_provider, "response_cache", ResponseCache(ttl=0, max_rows=0, memory_size=0, evict_every=1))
+    converter = convert.SMSToTransactionConverter()
+    llm = converter.llm_provider.primary_llm = _SingleLLM()
+
+    first = {"address": ADDRESS, "body": _sms("250.00", "BMTC BUS", "412345678901")}
+    result, rules = converter._resolve_locally(first["body"], ADDRESS)
+    assert result is None
+    [(_, converted)] = asyncio.run(converter._aconvert_batch([(first, rules)]))
+    assert converted["merchant"] == "BMTC BUS"
+
+    second = _sms("1,299.50", "SWIGGY INSTAMART", "512345678902")
+    assert shapes.shape_of(ADDRESS, second)[0] != shapes.shape_of(ADDRESS, first["body"])[0]
+    result, _ = converter._resolve_locally(second, ADDRESS)
+    assert result == {"bank": "XYZ", "amount": 1299.5, "transaction_type": "debited", "merchant": "SWIGGY INSTAMART"}
+    assert len(llm.prompts) == 1
+    assert cache.stats()["header_hits"] == 1
+
+
+def test_other_wording_of_the_same_sender_is_not_matched():
+    cache = _MemoryShapeCache()
+    assert cache.learn(ADDRESS, _sms("250.00", "BMTC BUS", "412345678901"),
+                       {"bank": "XYZ", "amount": 250.0, "transaction_type": "debited", "merchant": "BMTC BUS"})
+    assert cache.lookup(ADDRESS, "Your a/c XX1234 was credited INR 250.00 by BMTC BUS on 01-05-24.") is None
+    assert cache.lookup("VM-OTHERB-S", _sms("99.00", "SWIGGY", "412345678903")) is None
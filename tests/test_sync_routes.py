@@ -0,0 +1,38 @@
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from auth import issue_token
+from routes.system_routes import system_router
+
+app = FastAPI()
+app.include_router(system_router)
+client = TestClient(app)
+
+
+@pytest.mark.parametrize("path", ["/sync/cursor", "/sync/progress"])
+def test_sync_state_requires_credentials(path):
+    assert client.get(path, params={"user_name": "alice"}).status_code == 401
+
+
+@pytest.mark.parametrize("path", ["/sync/cursor", "/sync/progress"])
+def test_sync_state_of_another_user_is_forbidden(path):
+    headers = {"Authorization": f"Bearer {issue_token('mallory')}"}
+    assert client.get(path, params={"user_name": "alice"}, headers=headers).status_code == 403
+
+
+def test_own_sync_progress():
+    headers = {"Authorization": f"Bearer {issue_token('alice')}"}
+    response = client.get("/sync/progress", params={"user_name": "alice"}, headers=headers)
+    assert response.status_code == 200
+    assert response.json() == {"user_name": "alice", "in_flight": []}
+
+
+def test_anonymous_sync_gets_no_cursor():
+    response = client.post("/sync", json={"user_name": "alice", "messages": []})
+    assert response.status_code == 202
+    assert "cursor" not in response.json()
+
+
+def test_convert_is_post_only():
+    headers = {"Authorization": f"Bearer {issue_token('alice')}"}
+    assert client.get("/convert", headers=headers).status_code == 405